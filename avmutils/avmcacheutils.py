@@ -0,0 +1,227 @@
+# avmcacheutils.py is a set of functions for managing a host-wide content
+# addressed file cache
+# Copyright (C) 2021, 2022 Michael Konrad
+
+# This file is part of Avium Utilities.
+
+# Avium Utilities is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Avium Utilities is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Avium Utilities. If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import time
+import yaml
+
+# Linux ioctl that clones a file's extents into another file (reflink)
+FICLONE = 0x40049409
+
+
+class ContentCache:
+    """
+    A cache of verified files shared by every configuration and user on a
+    host. Files are stored once under their digest, whatever URL they
+    came from, as a hard link to the caller's file, so storing copies
+    nothing, or as a reflink or a copy across file systems. They are
+    materialized into a working directory as a reflink, a hard link or,
+    failing both, a copy. A cached file is shared with the files it was
+    stored from or materialized to, so those are replaced, never written
+    to. The least recently used files are evicted once the cache grows
+    beyond its disk budget.
+
+    :param path: the cache directory, it is created if missing
+    :param max_size: the disk budget of the cache in bytes
+    """
+
+    __logger = logging.getLogger(__name__)
+
+    def __init__(self, path, max_size):
+        dir_mode = 0o0775
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.objects = os.path.join(self.path, r'objects')
+
+        os.makedirs(self.objects, dir_mode, exist_ok=True)
+
+    def object_path(self, digest, hash_ver='sha256'):
+        digest = digest.lower()
+        return os.path.join(self.objects, hash_ver, digest[:2], digest)
+
+    def lookup(self, digest, hash_ver='sha256'):
+        """
+        Return the cached file with the given digest and mark it as
+        recently used, or None if it is not cached.
+        """
+        obj = self.object_path(digest, hash_ver)
+
+        try:
+            self.__mark_used(obj)
+        except PermissionError:
+            self.__logger.debug("Unable to mark " + obj + " as used.")
+        except OSError:
+            return None
+
+        return obj
+
+    def contains(self, file_path, digest, hash_ver='sha256'):
+        """
+        Return True if file_path is the cached file with the given digest
+        itself, i.e. a hard link to it. This needs no hashing.
+        """
+        try:
+            return os.path.samefile(file_path,
+                                    self.object_path(digest, hash_ver))
+        except OSError:
+            return False
+
+    def store(self, file_path, url, digest, hash_ver='sha256'):
+        """
+        Add a verified file to the cache and evict old files, other than
+        this one, if the cache is over budget.
+
+        :param file_path: the verified file, it is left in place unchanged
+                          and shares its inode with the cached file
+        :param url: the URL the file was downloaded from
+        :param digest: the verified hex digest of the file
+        :param hash_ver: the hash algorithm of the digest
+        :return: the path of the cached file
+        """
+        obj = self.object_path(digest, hash_ver)
+
+        with self.__locked():
+            if not os.path.exists(obj):
+                os.makedirs(os.path.dirname(obj), 0o0775, exist_ok=True)
+                self.__link(file_path, obj, hard_link_first=True)
+                with contextlib.suppress(PermissionError):
+                    self.__mark_used(obj)
+                self.__logger.info("Cached " + url + " as " + digest)
+
+            self.__record_url(obj, url, hash_ver)
+            self.__evict(keep=obj)
+
+        return obj
+
+    def materialize(self, obj, target):
+        """
+        Place a cached file at target, replacing any existing file.
+        """
+        self.__link(obj, target)
+        self.__logger.info("Materialized " + os.path.basename(target) +
+                           " from the download cache.")
+
+    def size(self):
+        return sum(entry[2] for entry in self.__entries())
+
+    def __evict(self, keep=None):
+        entries = sorted(self.__entries(), key=lambda entry: entry[1])
+        total = sum(entry[2] for entry in entries)
+
+        for obj, atime, size in entries:
+            if total <= self.max_size:
+                break
+            if obj == keep:
+                continue
+            self.__logger.info("Evicting " + os.path.basename(obj) +
+                               " from the download cache.")
+            os.remove(obj)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(obj + '.yaml')
+            total -= size
+
+    def __entries(self):
+        for root, dirs, files in os.walk(self.objects):
+            for name in files:
+                if name.endswith('.yaml') or name.endswith('.tmp'):
+                    continue
+                obj = os.path.join(root, name)
+                with contextlib.suppress(FileNotFoundError):
+                    st = os.stat(obj)
+                    yield obj, st.st_atime, st.st_size
+
+    def __record_url(self, obj, url, hash_ver):
+        meta_path = obj + '.yaml'
+        meta = {'hash_ver': hash_ver, 'urls': []}
+
+        if os.path.isfile(meta_path):
+            with open(meta_path) as meta_file:
+                meta = yaml.safe_load(meta_file) or meta
+
+        if url not in meta['urls']:
+            meta['urls'].append(url)
+            with open(meta_path, 'w') as meta_file:
+                yaml.safe_dump(meta, meta_file)
+
+    @contextlib.contextmanager
+    def __locked(self):
+        # Serializes writers from every process and user sharing the cache
+        with open(os.path.join(self.path, r'.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __link(self, src, dst, hard_link_first=False):
+        tmp = dst + '.tmp'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+
+        links = (self.__hard_link, self.__reflink) if hard_link_first \
+            else (self.__reflink, self.__hard_link)
+        if not any(link(src, tmp) for link in links):
+            shutil.copyfile(src, tmp)
+
+        os.replace(tmp, dst)
+
+    @staticmethod
+    def __mark_used(obj):
+        # The access time orders the cache for eviction. The modification
+        # time is kept, as the file shares its inode with the files it was
+        # stored from and materialized to, whose digests are cached by it.
+        os.utime(obj, ns=(time.time_ns(), os.stat(obj).st_mtime_ns))
+
+    @staticmethod
+    def __hard_link(src, dst):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def __reflink(src, dst):
+        try:
+            with open(src, 'rb') as sf, open(dst, 'wb') as df:
+                fcntl.ioctl(df.fileno(), FICLONE, sf.fileno())
+            return True
+        except OSError:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(dst)
+            return False
+
+
+def open_cache(config, section='cache'):
+    """
+    Return the ContentCache described by a section of the app
+    configuration, app.cache for downloads or app.build_cache for custom
+    isos, or None if the cache is not enabled.
+    """
+    cache = config['app'].get(section, {})
+
+    if not cache.get('enabled', False):
+        return None
+
+    return ContentCache(os.path.expanduser(cache['path']),
+                        cache['max_size_mb'] * 1024 * 1024)
@@ -16,83 +16,611 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Avium Utilities. If not, see <https://www.gnu.org/licenses/>.
 
+import contextlib
+import copy
+import hashlib
 import logging
 import os
 import pycdlib
 import re
 import sys
+import time
+import yaml
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+
+from avmutils import avmcacheutils as cacheutils
 from avmutils import avmnetutils as netutils
+from avmutils import avmtplutils as tplutils
 from avmutils import avmvmutils as vmutils
 
-
-def build_custom_centos_iso(avium):
+# Bumped whenever the way the custom iso is put together changes, so
+# builds cached by an earlier version are not reused
+BUILD_FORMAT = 2
+
+# Volume label of the per-VM seed iso the installer reads ks.cfg from
+DEFAULT_SEED_LABEL = 'AVIUMSEED'
+
+# The kickstart location on the installer's boot command line
+KS_LOCATION = re.compile(r'inst\.ks=hd:LABEL=[^:\s]+:')
+
+# Names of the custom iso of each distro in each iso.mode
+CUSTOM_ISOS = {'centos_7': {'remaster': r'centos7_ks.iso',
+                            'seed': r'centos7_seed.iso',
+                            'http': r'centos7_http.iso'},
+               'centos_8': {'remaster': r'centos8_ks.iso',
+                            'seed': r'centos8_seed.iso',
+                            'http': r'centos8_http.iso'}}
+
+
+def build_custom_centos_iso(avium, iso_path=None, custom_iso=None,
+                            timings=None):
+    """
+    Build the custom CentOS iso of the configured distro. The build is
+    keyed by a digest of every input, see build_key. When the build cache
+    is enabled and holds an iso with the same key, it is placed in the iso
+    directory instead of being built again.
+
+    With iso.mode set to seed the iso only carries the files shared by
+    every VM, the Guest Additions iso and the avmutils wheel, and boots
+    the kickstart file from a seed iso, see build_seed_iso. With iso.mode
+    set to http only the boot configuration is changed, the kickstart
+    file and every other file are served by avmksutils.KickstartServer.
+    Otherwise the per-VM files are added to it as well.
+
+    The build runs in stages. The downloads run in the background while
+    the kickstart file and boot configuration are rendered, the iso is
+    opened and patched as soon as the distribution iso is ready and the
+    Guest Additions iso is only waited for when the build key needs it.
+    The seconds each stage took are logged.
+
+    :param avium: the avium application
+    :param iso_path: the distribution iso, downloaded if None
+    :param custom_iso: the file name of the custom iso, the name for the
+                       distro and iso.mode if None
+    :param timings: a dict the seconds each stage took are stored in
+    :return: the path of the custom iso
+    """
     __logger.info("Building custom CentOS iso...")
     config = avium.get_config()
     distro = config['iso']['distro']
+    mode = __iso_mode(config)
+    timings = {} if timings is None else timings
+    start = time.monotonic()
 
-    iso_path = download_distro(avium)
-    download_vbox_guest_additions(avium)
+    if distro not in CUSTOM_ISOS:
+        __logger.error("Exiting, distribution not supported. Custom iso \
+              not generated.")
+        sys.exit(1)
+    if custom_iso is None:
+        custom_iso = CUSTOM_ISOS[distro][mode]
 
-    iso_tmp = pycdlib.PyCdlib()
+    download = __configure_downloads(config)
+    custom_path = os.path.join(os.path.abspath(config['iso']['local_path']),
+                               custom_iso)
+    pool = ThreadPoolExecutor(max_workers=2)
+    iso_tmp = None
 
-    iso_tmp.open(iso_path)
+    try:
+        if iso_path is None:
+            iso_future = pool.submit(__download_stage, __distro_job, config,
+                                     download, timings, 'download_distro')
+        if iso_path is None and config['virtualbox']['enabled']:
+            vbox_future = pool.submit(__download_stage, __vbox_guest_job,
+                                      config, download, timings,
+                                      'download_vbox_guest')
+        else:
+            vbox_future = None
+
+        with __stage(timings, 'prepare'):
+            ks_content = None if 'remaster' != mode else \
+                render_kickstart(avium)
+            isolinux = __isolinux_replacements(config)
+
+        if iso_path is None:
+            iso_path = iso_future.result()
+
+        if vbox_future is not None and not vbox_future.done():
+            # Patch the iso while the Guest Additions iso downloads
+            with __stage(timings, 'open'):
+                iso_tmp = __open_iso(avium, iso_path, ks_content, isolinux)
+            vbox_future.result()
+
+        with __stage(timings, 'key'):
+            key = build_key(avium, iso_path, ks_content)
+            build_cache = cacheutils.open_cache(config, 'build_cache')
+            reused = __reuse_build(build_cache, key, custom_path)
+
+        if reused:
+            __log_stages(timings, start)
+            return custom_path
+
+        if iso_tmp is None:
+            with __stage(timings, 'open'):
+                iso_tmp = __open_iso(avium, iso_path, ks_content, isolinux)
+
+        if 'http' != mode:
+            with __stage(timings, 'vbox_guest'):
+                # Add VirtualBox Guest Additions to ISO
+                __add_vbox_guest_additions(config, iso_tmp)
+
+        # Save new iso image. It is written beside the previous iso and
+        # moved into place, as the previous iso may be a link into the
+        # build cache.
+        with __stage(timings, 'write'):
+            iso_tmp.write(custom_path + '.tmp')
+            iso_tmp.close()
+            iso_tmp = None
+            os.replace(custom_path + '.tmp', custom_path)
+
+            if build_cache is not None:
+                build_cache.store(custom_path, custom_iso, key)
+    finally:
+        if iso_tmp is not None:
+            iso_tmp.close()
+        # A download still running after an error finishes, or fails,
+        # before the error is raised, so it leaves no partial file behind
+        # a later build
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    __log_stages(timings, start)
+    __logger.info("Custom CentOS iso is ready.")
 
-    # Update boot configuration
-    __mod_isolinux(config, iso_tmp)
+    return custom_path
 
-    # Generate custom kickstart file
-    __mod_kickstart(avium, iso_tmp)
 
-    # Add local directory and configuration
+def build_seed_iso(avium, seed_path):
+    """
+    Build the seed iso of a VM. It holds only the files that differ
+    between VMs, the kickstart file, the configuration, the runner and the
+    public key, on a volume labeled iso.seed_label that the installer of
+    a seed mode custom iso reads its kickstart file from.
+
+    :param avium: the avium application
+    :param seed_path: the path to write the seed iso to
+    :return: the path of the seed iso
+    """
+    __logger.info("Building seed iso...")
+    config = avium.get_config()
+
+    ks_content = render_kickstart(avium)
+
+    iso_tmp = pycdlib.PyCdlib()
+    iso_tmp.new(interchange_level=3, rock_ridge='1.09',
+                vol_ident=__seed_label(config))
+
+    __mod_kickstart(ks_content, iso_tmp)
     iso_tmp.add_directory('/LOCAL', rr_name='local')
-    __add_avium_config(config, iso_tmp)
+    __add_vm_files(avium, iso_tmp)
 
-    # Add runner file
-    __add_runner(avium, iso_tmp)
+    iso_tmp.write(seed_path + '.tmp')
+    iso_tmp.close()
+    os.replace(seed_path + '.tmp', seed_path)
 
-    # Add User' public ssh key
-    __add_user_ssh_key(config, iso_tmp)
+    __logger.info("Seed iso " + seed_path + " is ready.")
+
+    return seed_path
+
+
+def render_kickstart(avium, asset_url=None):
+    """
+    Render the kickstart template of the configured distro for a VM.
+
+    :param avium: the avium application
+    :param asset_url: the URL the VM fetches its files from, it replaces
+                      kickstart.asset_url_key in the template
+    :return: the kickstart file, or None if the template is missing
+    """
+    __logger.info("Generating kickstart file...")
+    config = avium.get_config()
+    ks_fh = kickstart_path(avium)
+
+    # Type of node to build
+    node_type = config['vm']['node_type']
+
+    if not os.path.isfile(ks_fh):
+        __logger.error("Kickstart file, " + ks_fh + " not found.")
+        return None
+
+    with open(ks_fh, 'r') as ks:
+        ks_content = ks.read()
+
+    kickstart = config['kickstart']
+
+    if 'managed' == node_type:
+        package_value = kickstart['package_managed']
+    elif 'admin' == node_type:
+        package_value = kickstart['package_admin']
+    else:
+        package_value = kickstart['package_none']
+
+    replacements = [(kickstart['username_key'], config['user']['username']),
+                    (kickstart['fullname_key'], config['user']['fullname'])]
+
+    if asset_url is not None and 'asset_url_key' in kickstart:
+        replacements.append((kickstart['asset_url_key'], asset_url))
+
+    if 'seal_key' in kickstart:
+        # Only the golden image is installed from the iso, its %post
+        # clears what each clone must generate for itself and installs
+        # the unit that gives each clone its hostname on first boot
+        golden = config['vm'].get('golden_image', {}).get('enabled', False)
+        seal_value = kickstart['seal_value'] + '\n' + \
+            vmutils.CLONE_HOSTNAME_SEAL
+        replacements.append((kickstart['seal_key'],
+                             seal_value if golden else ''))
 
-    # Add VirtualBox Guest Additions to ISO
-    __add_vbox_guest_additions(config, iso_tmp)
+    replacements += [(kickstart['disk_use_key'], kickstart['disk_use_value']),
+                     (kickstart['disk_part_key'],
+                      kickstart['disk_part_value']),
+                     (kickstart['disk_add_key'], kickstart['disk_add_value']),
+                     (kickstart['package_key'], package_value)]
 
-    # Add avmutils library
-    __add_avmutils(config, iso_tmp)
+    ks_content = tplutils.render(ks_content, replacements)[0]
+
+    return ks_content
+
+
+def kickstart_path(avium):
+    """
+    Return the path of the kickstart template of the configured distro.
+    """
+    config = avium.get_config()
+    distro = config['iso']['distro']
 
-    # Save new iso image
-    iso_wd = config['iso']['local_path']
-    os.chdir(iso_wd)
     if 'centos_7' == distro:
-        iso_tmp.write('centos7_ks.iso')
+        ks_fh = os.path.join(avium.get_conf_home(), r'local',
+                             config['centos_7']['kickstart'])
+        __logger.debug("CentOS 7 kickstart file..." + ks_fh)
     elif 'centos_8' == distro:
-        iso_tmp.write('centos8_ks.iso')
+        ks_fh = os.path.join(avium.get_conf_home(), r'local',
+                             config['centos_8']['kickstart'])
+        __logger.debug("CentOS 8 kickstart file..." + ks_fh)
     else:
-        __logger.error("Exiting, distribution not supported. Custom iso \
-              not generated.")
+        __logger.error("Exiting, Linux distribution not supported.")
         sys.exit(1)
 
-    iso_tmp.close()
-    __logger.info("Custom CentOS iso is ready.")
+    return ks_fh
+
+
+def local_files(avium):
+    """
+    Return the files a VM is provisioned with, by the lower case name of
+    each on the custom iso's /LOCAL directory. Missing files are left out.
+    """
+    config = avium.get_config()
+    files = {r'runner.py': __runner_path(avium),
+             r'pubkey.pub': config['user']['public_key'],
+             r'vbguest.iso': __vbox_guest_path(config),
+             r'avmutils.whl': __avmutils_path(config)}
+
+    return {name: os.path.abspath(path) for name, path in files.items()
+            if path is not None and os.path.isfile(path)}
+
+
+def build_key(avium, iso_path, ks_content=None):
+    """
+    Return the sha256 digest of every input of a custom iso build: the
+    base iso, the configuration, which determines the patched
+    isolinux.cfg, the rendered kickstart file, the runner, the public key,
+    the VirtualBox Guest Additions iso and the avmutils wheel. Files are
+    digested through the persistent digest cache, so unchanged inputs are
+    not hashed again.
+
+    :param avium: the avium application
+    :param iso_path: the path of the base distribution iso
+    :param ks_content: the rendered kickstart file, rendered if None
+    :return: the hex digest of the build inputs, in seed mode only the
+             inputs shared by every VM
+    """
+    config = avium.get_config()
+    mode = __iso_mode(config)
+    files = [('vbox_guest', __vbox_guest_path(config)),
+             ('avmutils', __avmutils_path(config))]
+
+    inputs = [('format', str(BUILD_FORMAT)),
+              ('base_iso', netutils.file_digest(iso_path))]
+
+    if 'http' == mode:
+        # Only the boot configuration goes into the custom iso
+        inputs.append(('config', yaml.safe_dump(
+            {'isolinux': config['isolinux'], 'distro': config['iso']['distro'],
+             'ks_url': __ks_url(config)}, sort_keys=True)))
+        files = []
+    elif 'seed' == mode:
+        # The per-VM files are on the seed iso, only the boot
+        # configuration and the shared files go into the custom iso
+        inputs.append(('config', yaml.safe_dump(
+            {'isolinux': config['isolinux'], 'distro': config['iso']['distro'],
+             'seed_label': __seed_label(config)}, sort_keys=True)))
+    else:
+        if ks_content is None:
+            ks_content = render_kickstart(avium)
+        inputs.append(('config', yaml.safe_dump(config, sort_keys=True)))
+        inputs.append(('kickstart', ks_content or ''))
+        files = [('runner', __runner_path(avium)),
+                 ('public_key', config['user']['public_key'])] + files
+
+    for name, path in files:
+        if path is not None and os.path.isfile(path):
+            inputs.append((name, netutils.file_digest(path)))
+        else:
+            inputs.append((name, ''))
+
+    key = hashlib.sha256()
+    for name, value in inputs:
+        key.update(name.encode('utf-8') + b'\0' + value.encode('utf-8') +
+                   b'\0')
+
+    return key.hexdigest()
+
+
+def download_artifacts(avium):
+    """
+    Download the distribution iso and, if enabled, the VirtualBox Guest
+    Additions iso with overlapping transfers. Both are verified against
+    their checksum files as they download.
+
+    :return: the path of the distribution iso
+    """
+    iso_path, error = __download_artifacts([avium.get_config()])[0]
+
+    if error is not None:
+        raise RuntimeError(error)
+
+    return iso_path
+
+
+def build_many(avium, variants, workers=None):
+    """
+    Build several custom isos concurrently in a process pool. The
+    distribution isos and the Guest Additions iso the variants need are
+    each downloaded and verified once before the builds start. A variant
+    that fails does not stop the others.
+
+    Each iso is named after the custom iso of its distro and mode with
+    the node type appended, e.g. centos7_ks_admin.iso.
+
+    :param avium: the avium application the variants are based on
+    :param variants: (distro, node_type) or (distro, node_type, overrides)
+                     tuples, overrides is a dict merged into a copy of the
+                     configuration
+    :param workers: the number of build processes, the number of CPUs if
+                    None
+    :return: a dict per variant, in order, with the distro, node_type,
+             path of the iso, the seconds its build took, the seconds of
+             each build stage and the error, None if it was built
+    """
+    results = []
+    builds = []
+
+    for variant in variants:
+        distro, node_type = variant[0], variant[1]
+        config = copy.deepcopy(avium.get_config())
+        merge_config(config, variant[2] if len(variant) > 2 else {})
+        config['iso']['distro'] = distro
+        config['vm']['node_type'] = node_type
+
+        result = {'distro': distro, 'node_type': node_type, 'path': None,
+                  'seconds': 0.0, 'stages': {}, 'error': None}
+        results.append(result)
+
+        try:
+            mode = __iso_mode(config)
+            if distro not in CUSTOM_ISOS:
+                raise RuntimeError('Distribution ' + distro +
+                                   ' is not supported.\n')
+        except RuntimeError as err:
+            result['error'] = str(err).strip()
+            continue
+
+        custom_iso = CUSTOM_ISOS[distro][mode].replace(
+            r'.iso', r'_' + node_type + r'.iso')
+        builds.append((result, BuildVariant(avium.get_conf_home(), config),
+                       custom_iso))
+
+    downloads = __download_artifacts([variant.get_config()
+                                      for result, variant, name in builds])
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for (result, variant, name), (iso_path, error) in zip(builds,
+                                                              downloads):
+            if error is not None:
+                result['error'] = error.strip()
+                continue
+            futures[pool.submit(__build_variant, variant, iso_path,
+                                name)] = result
+
+        for future in as_completed(futures):
+            futures[future].update(future.result())
+
+    for result in results:
+        if result['error'] is None:
+            __logger.info("Built " + result['path'] + " in " +
+                          str(round(result['seconds'], 1)) + " s.")
+        else:
+            __logger.error("Build of " + result['distro'] + " " +
+                           result['node_type'] + " failed: " +
+                           result['error'])
+
+    return results
+
+
+def merge_config(config, overrides):
+    """
+    Merge a dict of overrides into a configuration in place. Nested dicts
+    are merged key by key, any other value replaces the configured one.
+    """
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            merge_config(config[key], value)
+        else:
+            config[key] = copy.deepcopy(value)
+
+
+class BuildVariant:
+    """
+    The configuration of one variant of a batch build, standing in for
+    the avium application in the build process.
+    """
+
+    def __init__(self, conf_home, config):
+        self.conf_home = conf_home
+        self.config = config
+
+    def get_conf_home(self):
+        return self.conf_home
+
+    def get_config(self):
+        return self.config
 
 
 def download_vbox_guest_additions(avium):
     config = avium.get_config()
 
     if config['virtualbox']['enabled']:
-        ga_checksum_file = config['virtualbox']['ga_checksum_file']
-        ga_iso_file_base = config['virtualbox']['ga_iso_file']
-        ga_iso_file = ga_iso_file_base + vmutils.get_vbox_version() + r'.iso'
-        iso_url = config['virtualbox']['iso_url']
-        vbox_path = config['virtualbox']['local_path']
-
-        netutils.download_file(vbox_path, iso_url + r'/' + ga_iso_file)
-        netutils.download_file(vbox_path, iso_url + r'/' + ga_checksum_file)
-        netutils.verify_hash(vbox_path, ga_iso_file, ga_checksum_file, 'SHA26')
+        download = __configure_downloads(config)
+        __download(__vbox_guest_job(config, download))
 
 
 def download_distro(avium):
     config = avium.get_config()
+    download = __configure_downloads(config)
+    job = __distro_job(config, download)
+
+    __download(job)
+
+    return __job_path(job)
+
+
+def __download_artifacts(configs):
+    # Download the artifacts of every configuration at once, each distinct
+    # URL once, and return the distribution iso path and the download
+    # error, or None, of each configuration
+    if not configs:
+        return []
+
+    download = __configure_downloads(configs[0])
+    jobs = {}
+    needs = []
+
+    for config in configs:
+        config_jobs = [__distro_job(config, download)]
+        if config['virtualbox']['enabled']:
+            config_jobs.append(__vbox_guest_job(config, download))
+        for job in config_jobs:
+            jobs.setdefault(job['url'], job)
+        needs.append([job['url'] for job in config_jobs])
+
+    results = netutils.download_many(
+        list(jobs.values()),
+        max_downloads=download.get('max_downloads',
+                                   netutils.DEFAULT_MAX_DOWNLOADS),
+        per_host=download.get('per_host', netutils.DEFAULT_PER_HOST))
+    errors = {result['url']: result['error'] for result in results
+              if result['error'] is not None}
+
+    artifacts = []
+    for urls in needs:
+        failed = [url + ' (' + errors[url] + ')' for url in urls
+                  if url in errors]
+        error = 'Download failed: ' + ', '.join(failed) + '\n' \
+            if failed else None
+        artifacts.append((__job_path(jobs[urls[0]]), error))
+
+    return artifacts
+
+
+def __build_variant(variant, iso_path, custom_iso):
+    # Runs in a build process, so errors are returned rather than raised
+    result = {'path': None, 'seconds': 0.0, 'stages': {}, 'error': None}
+    start = time.monotonic()
+
+    try:
+        result['path'] = build_custom_centos_iso(
+            variant, iso_path, custom_iso, result['stages'])
+    except SystemExit as err:
+        result['error'] = 'Build exited with status ' + str(err.code)
+    except Exception as err:
+        result['error'] = str(err).strip() or type(err).__name__
+
+    result['seconds'] = time.monotonic() - start
+
+    return result
+
+
+def __download_stage(make_job, config, download, timings, stage):
+    # Runs on a pipeline thread while the build prepares its payloads
+    with __stage(timings, stage):
+        job = make_job(config, download)
+        __download(job)
+
+    return __job_path(job)
+
+
+@contextlib.contextmanager
+def __stage(timings, stage):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[stage] = time.monotonic() - start
+
+
+def __log_stages(timings, start):
+    timings['total'] = time.monotonic() - start
+    __logger.info("Build stages: " + ', '.join(
+        stage + ' ' + str(round(seconds, 2)) + ' s'
+        for stage, seconds in timings.items()) + ".")
+
+
+def __open_iso(avium, iso_path, ks_content, isolinux):
+    # Open the distribution iso and patch in everything but the Guest
+    # Additions iso, which may still be downloading
+    config = avium.get_config()
+    mode = __iso_mode(config)
+    iso_tmp = pycdlib.PyCdlib()
+
+    iso_tmp.open(iso_path)
+
+    # Update boot configuration
+    __mod_isolinux(isolinux, iso_tmp)
+
+    if 'http' != mode:
+        # Add local directory
+        iso_tmp.add_directory('/LOCAL', rr_name='local')
+
+    if 'remaster' == mode:
+        # Add custom kickstart file and the per-VM files
+        __mod_kickstart(ks_content, iso_tmp)
+        __add_vm_files(avium, iso_tmp)
+
+    if 'http' != mode:
+        # Add avmutils library
+        __add_avmutils(config, iso_tmp)
+
+    return iso_tmp
+
+
+def __reuse_build(build_cache, key, custom_path):
+    if build_cache is None:
+        return False
+
+    cached_iso = build_cache.lookup(key)
+    if cached_iso is None:
+        return False
+
+    if not build_cache.contains(custom_path, key):
+        build_cache.materialize(cached_iso, custom_path)
+    __logger.info("Custom CentOS iso is unchanged, build " + key +
+                  " reused.")
+
+    return True
+
+
+def __distro_job(config, download):
     distro = config['iso']['distro']
 
     if 'centos_7' == distro:
@@ -110,11 +638,100 @@ def download_distro(avium):
         sys.exit(1)
 
     __logger.debug("CentOS path..." + centos_path)
-    netutils.download_file(centos_path, iso_url + r'/' + iso_file)
-    netutils.download_file(centos_path, iso_url + r'/' + checksum_file)
-    netutils.verify_hash(centos_path, iso_file, checksum_file, 'SHA26')
 
-    return os.path.join(centos_path, iso_file)
+    # iso_url is a single mirror or a list of mirrors to rank
+    if isinstance(iso_url, str):
+        iso_url = [iso_url]
+    mirrors = netutils.rank_mirrors(
+        [mirror + r'/' + iso_file for mirror in iso_url],
+        ttl=download.get('mirror_ttl', netutils.DEFAULT_MIRROR_TTL))
+    best_url = mirrors[0].rsplit('/', 1)[0]
+
+    # The iso is verified against the checksum file of the fastest mirror
+    # as it downloads, the other mirrors are failed over to in order
+    return {'url': mirrors[0],
+            'loc': centos_path,
+            'checksum_url': best_url + r'/' + checksum_file,
+            'mirrors': mirrors[1:],
+            'hash_ver': 'sha256',
+            'segments': download.get('segments', 1),
+            'retries': download.get('segment_retries', 3),
+            'cache': cacheutils.open_cache(config),
+            'force_verify': download.get('force_verify', False),
+            'revalidate': download.get('revalidate', True)}
+
+
+def __vbox_guest_job(config, download):
+    ga_checksum_file = config['virtualbox']['ga_checksum_file']
+    ga_iso_file_base = config['virtualbox']['ga_iso_file']
+    ga_iso_file = ga_iso_file_base + vmutils.get_vbox_version() + r'.iso'
+    iso_url = config['virtualbox']['iso_url']
+    vbox_path = config['virtualbox']['local_path']
+
+    # The iso is verified against the checksum file as it downloads
+    return {'url': iso_url + r'/' + ga_iso_file,
+            'loc': vbox_path,
+            'checksum_url': iso_url + r'/' + ga_checksum_file,
+            'hash_ver': 'sha256',
+            'cache': cacheutils.open_cache(config),
+            'force_verify': download.get('force_verify', False),
+            'revalidate': download.get('revalidate', True)}
+
+
+def __download(job):
+    options = {key: value for key, value in job.items()
+               if key not in ('url', 'loc')}
+
+    return netutils.download_file(job['loc'], job['url'], **options)
+
+
+def __job_path(job):
+    return os.path.join(job['loc'], job['url'].rsplit('/', 1)[1])
+
+
+def __configure_downloads(config):
+    download = config['app'].get('download', {})
+
+    netutils.configure_session(
+        pool_size=download.get('pool_size', netutils.DEFAULT_POOL_SIZE),
+        retries=download.get('http_retries', netutils.DEFAULT_HTTP_RETRIES))
+    netutils.configure_digest_cache(os.path.expanduser(
+        download.get('digest_cache', netutils.DEFAULT_DIGEST_CACHE)))
+    netutils.configure_mirror_cache(os.path.expanduser(
+        download.get('mirror_cache', netutils.DEFAULT_MIRROR_CACHE)))
+
+    return download
+
+
+def __iso_mode(config):
+    mode = config['iso'].get('mode', 'remaster')
+
+    if mode not in ('remaster', 'seed', 'http'):
+        raise RuntimeError('Unsupported iso mode ' + mode + '.\n')
+
+    return mode
+
+
+def __seed_label(config):
+    return config['iso'].get('seed_label', DEFAULT_SEED_LABEL)
+
+
+def __ks_url(config):
+    ks_server = config['app']['ks_server']
+    return 'http://' + ks_server['host'] + ':' + str(ks_server['port'])
+
+
+def __add_vm_files(avium, iso_tmp):
+    config = avium.get_config()
+
+    # Add configuration
+    __add_avium_config(config, iso_tmp)
+
+    # Add runner file
+    __add_runner(avium, iso_tmp)
+
+    # Add User' public ssh key
+    __add_user_ssh_key(config, iso_tmp)
 
 
 def __add_avium_config(config, iso_tmp):
@@ -131,49 +748,25 @@ def __add_avium_config(config, iso_tmp):
 
 
 def __add_runner(avium, iso_tmp):
-    try:
-        from cStringIO import StringIO as BytesIO
-    except ImportError:
-        from io import BytesIO
-
-    runner_file_name = r'runner.py'
-    runner_path = os.path.join(avium.get_conf_home(), r'local',
-                               runner_file_name)
+    runner_path = __runner_path(avium)
 
     if os.path.isfile(runner_path):
-        with open(runner_path, 'r') as run:
-            runner_content = run.read()
+        __add_local_file(iso_tmp, runner_path, '/LOCAL/RUNNER.PY;1',
+                         os.path.basename(runner_path))
 
-            runner_bytes = bytes(str(runner_content), 'utf-8')
-            runner_bio = BytesIO(runner_bytes)
 
-            iso_tmp.add_fp(runner_bio, len(runner_bytes),
-                           iso_path='/LOCAL/RUNNER.PY;1',
-                           rr_name=runner_file_name)
+def __runner_path(avium):
+    return os.path.join(avium.get_conf_home(), r'local', r'runner.py')
 
 
 def __add_user_ssh_key(config, iso_tmp):
-    try:
-        from cStringIO import StringIO as BytesIO
-    except ImportError:
-        from io import BytesIO
-
     __logger.info("Adding SSH public key file to iso image...")
     ssh_pub_key_path = config['user']['public_key']
     path, pub_key_file_name = os.path.split(ssh_pub_key_path)
 
     if os.path.isfile(ssh_pub_key_path):
-        with open(ssh_pub_key_path, 'r') as pubkey:
-            pubkey_content = pubkey.read()
-
-            pubkey_bytes = bytes(str(pubkey_content), 'utf-8')
-            pubkey_bio = BytesIO(pubkey_bytes)
-
-            iso_tmp.add_fp(pubkey_bio, len(pubkey_bytes),
-                           iso_path='/LOCAL/PUBKEY.PUB;1',
-                           rr_name=pub_key_file_name)
-
-        pubkey.close()
+        __add_local_file(iso_tmp, ssh_pub_key_path, '/LOCAL/PUBKEY.PUB;1',
+                         pub_key_file_name)
         __logger.info("Public key added to the iso image.")
 
     else:
@@ -184,72 +777,104 @@ def __add_user_ssh_key(config, iso_tmp):
 def __add_vbox_guest_additions(config, iso_tmp):
     if config['virtualbox']['enabled']:
 
-        try:
-            from cStringIO import StringIO as BytesIO
-        except ImportError:
-            from io import BytesIO
-
         __logger.info("Adding Virtual Box Guest Additions installer to "
                       "iso image.")
 
-        ga_filename = config['virtualbox']['ga_iso_file'] + \
-            vmutils.get_vbox_version() + r'.iso'
-
-        vbox_guest_path = os.path.join(config['virtualbox']['local_path'],
-                                       ga_filename)
+        vbox_guest_path = __vbox_guest_path(config)
 
         if os.path.isfile(vbox_guest_path):
-            with open(vbox_guest_path, 'rb') as ga:
-                ga_content = ga.read()
-
-                ga_bytes = bytes(str(ga_content), 'utf-8')
-                ga_bio = BytesIO(ga_bytes)
-
-                iso_tmp.add_fp(ga_bio, len(ga_bytes),
-                               iso_path='/LOCAL/VBGUEST.ISO;1',
-                               rr_name=ga_filename)
+            __add_local_file(iso_tmp, vbox_guest_path,
+                             '/LOCAL/VBGUEST.ISO;1',
+                             os.path.basename(vbox_guest_path))
 
             __logger.info("Vitual Box Guest Additions installer added to \
                           the iso image.")
-            ga.close()
         else:
             __logger.error("Virtual Box Guest Additions iso, " +
                            vbox_guest_path + " not found.")
 
 
 def __add_avmutils(config, iso_tmp):
-    try:
-        from cStringIO import StringIO as BytesIO
-    except ImportError:
-        from io import BytesIO
-
     __logger.info("Adding Avium Utilities to the iso image.")
 
-    avmutils_filename = config['app']['avmutils']['wheel_name']
-    avmutils_path = os.path.join(config['app']['fs']['wd_path'], r'avmutils',
-                                 avmutils_filename)
+    avmutils_path = __avmutils_path(config)
 
     if os.path.isfile(avmutils_path):
-        with open(avmutils_path, 'rb') as au:
-            au_content = au.read()
-
-            au_bytes = bytes(str(au_content), 'utf-8')
-            au_bio = BytesIO(au_bytes)
-
-            iso_tmp.add_fp(au_bio, len(au_bytes),
-                           iso_path='/LOCAL/AVMUTILS.WHL;1',
-                           rr_name=avmutils_filename)
+        __add_local_file(iso_tmp, avmutils_path, '/LOCAL/AVMUTILS.WHL;1',
+                         os.path.basename(avmutils_path))
 
         __logger.info("Avium utilities added to the iso image.")
-        au.close()
     else:
         __logger.error("Avium utilities, " + avmutils_path + " not found.")
 
 
-def __mod_isolinux(config, iso_tmp):
+def __vbox_guest_path(config):
+    if not config['virtualbox']['enabled']:
+        return None
+
+    ga_filename = config['virtualbox']['ga_iso_file'] + \
+        vmutils.get_vbox_version() + r'.iso'
+
+    return os.path.join(config['virtualbox']['local_path'], ga_filename)
+
+
+def __avmutils_path(config):
+    return os.path.join(config['app']['fs']['wd_path'], r'avmutils',
+                        config['app']['avmutils']['wheel_name'])
+
+
+def __add_local_file(iso_tmp, file_path, iso_path, rr_name):
+    # pycdlib records the path and its size now and copies the contents
+    # from disk in blocks when the iso is written, so no payload is ever
+    # held in memory and binary files are added byte for byte. The path
+    # is made absolute as pycdlib only opens it at write time.
+    __logger.debug("Adding " + file_path + " (" +
+                   str(os.path.getsize(file_path)) + " bytes) as " + iso_path)
+    iso_tmp.add_file(os.path.abspath(file_path), iso_path=iso_path,
+                     rr_name=rr_name)
+
+
+def __isolinux_replacements(config):
+    # The keys and values of isolinux.cfg, ready before the iso is open
     distro = config['iso']['distro']
     __logger.debug("Distro..." + distro)
 
+    if 'centos_7' == distro:
+        label_value = config['isolinux']['label_7_value']
+    elif 'centos_8' == distro:
+        label_value = config['isolinux']['label_8_value']
+    else:
+        __logger.error("Exiting, distro " + distro + " not supported.")
+        sys.exit(1)
+
+    ks_location = None
+    if 'seed' == __iso_mode(config):
+        # Read the kickstart file from the seed iso
+        ks_location = 'inst.ks=hd:LABEL=' + __seed_label(config) + ':'
+    elif 'http' == __iso_mode(config):
+        # Fetch the kickstart file from the kickstart server, which knows
+        # each VM by the MAC addresses sent with it
+        ks_location = 'inst.ks.sendmac inst.ks=' + __ks_url(config)
+
+    if ks_location is not None:
+        label_value, count = KS_LOCATION.subn(lambda match: ks_location,
+                                              label_value)
+        if 0 == count:
+            # The installer would otherwise look for the kickstart file
+            # on the remastered iso, which does not hold it
+            raise RuntimeError('No inst.ks=hd:LABEL=...: location found in '
+                               'the isolinux label value of ' + distro +
+                               ' to point at the ' + __iso_mode(config) +
+                               ' kickstart file.\n')
+
+    return [(config['isolinux']['timeout_key'],
+             config['isolinux']['timeout_value']),
+            (config['isolinux']['menu_key'],
+             config['isolinux']['menu_value']),
+            (config['isolinux']['label_key'], label_value)]
+
+
+def __mod_isolinux(replacements, iso_tmp):
     try:
         from cStringIO import StringIO as BytesIO
     except ImportError:
@@ -263,23 +888,12 @@ def __mod_isolinux(config, iso_tmp):
                                  iso_path='/ISOLINUX/ISOLINUX.CFG;1')
     isolinux_cfg = ext_isolinux_cfg.getvalue().decode('utf-8')
 
-    isolinux_mod = re.sub(config['isolinux']['timeout_key'],
-                          config['isolinux']['timeout_value'], isolinux_cfg)
+    isolinux_mod, matched = tplutils.render(isolinux_cfg, replacements)
 
-    isolinux_mod = re.sub(config['isolinux']['menu_key'],
-                          config['isolinux']['menu_value'], isolinux_mod)
-
-    if 'centos_7' == distro:
-        isolinux_mod = re.sub(config['isolinux']['label_key'],
-                              config['isolinux']['label_7_value'],
-                              isolinux_mod)
-    elif 'centos_8' == distro:
-        isolinux_mod = re.sub(config['isolinux']['label_key'],
-                              config['isolinux']['label_8_value'],
-                              isolinux_mod)
-    else:
-        __logger.error("Exiting, distro " + distro + " not supported.")
-        sys.exit(1)
+    label_key = replacements[-1][0]
+    if not matched[label_key]:
+        __logger.warning("No " + label_key + " entry in isolinux.cfg, the "
+                         "kickstart boot entry was not added.")
 
     # Remove existing file
     iso_tmp.rm_file(iso_path='/ISOLINUX/ISOLINUX.CFG;1')
@@ -293,79 +907,20 @@ def __mod_isolinux(config, iso_tmp):
     __logger.info("Isolinux.cfg updated on iso image.")
 
 
-def __mod_kickstart(avium, iso_tmp):
-    __logger.info("Generating kickstart file...")
-    config = avium.get_config()
-
-    distro = config['iso']['distro']
-
+def __mod_kickstart(ks_content, iso_tmp):
     try:
         from cStringIO import StringIO as BytesIO
     except ImportError:
         from io import BytesIO
 
-    # Add custom kickstart file to ISO
-    if 'centos_7' == distro:
-        ks_fh = os.path.join(avium.get_conf_home(), r'local',
-                             config['centos_7']['kickstart'])
-        __logger.debug("CentOS 7 kickstart file..." + ks_fh)
-    elif 'centos_8' == distro:
-        ks_fh = os.path.join(avium.get_conf_home(), r'local',
-                             config['centos_8']['kickstart'])
-        __logger.debug("CentOS 8 kickstart file..." + ks_fh)
-    else:
-        __logger.error("Exiting, Linux distribution not supported.")
-        sys.exit(1)
+    if ks_content is not None:
+        kickstart_bytes = bytes(ks_content, 'utf-8')
+        kickstart_bio = BytesIO(kickstart_bytes)
 
-    # Type of node to build
-    node_type = config['vm']['node_type']
+        iso_tmp.add_fp(kickstart_bio, len(kickstart_bytes),
+                       '/KS.CFG;1', rr_name='ks.cfg')
 
-    if os.path.isfile(ks_fh):
-        with open(ks_fh, 'r') as ks:
-            ks_content = ks.read()
-            ks.seek(0)
-
-            ks_content = re.sub(config['kickstart']['username_key'],
-                                config['user']['username'], ks_content)
-
-            ks_content = re.sub(config['kickstart']['fullname_key'],
-                                config['user']['fullname'], ks_content)
-
-            ks_content = re.sub(config['kickstart']['disk_use_key'],
-                                config['kickstart']['disk_use_value'],
-                                ks_content)
-
-            ks_content = re.sub(config['kickstart']['disk_part_key'],
-                                config['kickstart']['disk_part_value'],
-                                ks_content)
-
-            ks_content = re.sub(config['kickstart']['disk_add_key'],
-                                config['kickstart']['disk_add_value'],
-                                ks_content)
-
-            if 'managed' == node_type:
-                ks_content = re.sub(config['kickstart']['package_key'],
-                                    config['kickstart']
-                                    ['package_managed'], ks_content)
-            elif 'admin' == node_type:
-                ks_content = re.sub(config['kickstart']['package_key'],
-                                    config['kickstart']
-                                    ['package_admin'], ks_content)
-            else:
-                ks_content = re.sub(config['kickstart']['package_key'],
-                                    config['kickstart']
-                                    ['package_none'], ks_content)
-
-            ks.close()
-            kickstart_bytes = bytes(ks_content, 'utf-8')
-            kickstart_bio = BytesIO(kickstart_bytes)
-
-            iso_tmp.add_fp(kickstart_bio, len(kickstart_bytes),
-                           '/KS.CFG;1', rr_name='ks.cfg')
-
-            __logger.info("Kickstart file generated and added to iso image.")
-    else:
-        __logger.error("Kickstart file, " + ks_fh + " not found.")
+        __logger.info("Kickstart file generated and added to iso image.")
 
 
 __logger = logging.getLogger(__name__)
@@ -0,0 +1,261 @@
+# avmksutils.py is a set of functions for serving kickstart files and
+# provisioning files to virtual machines over HTTP
+# Copyright (C) 2021, 2022 Michael Konrad
+
+# This file is part of Avium Utilities.
+
+# Avium Utilities is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Avium Utilities is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Avium Utilities. If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import logging
+import os
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from avmutils import avmisoutils as isoutils
+
+# Headers anaconda sends with the MAC address of every interface when the
+# boot command line has inst.ks.sendmac, e.g. "eth0 08:00:27:ab:cd:ef"
+MAC_HEADER = re.compile(r'^X-RHN-Provisioning-MAC-\d+$', re.IGNORECASE)
+
+
+class KickstartServer:
+    """
+    A threaded HTTP server that renders and serves the kickstart file and
+    the provisioning files of each registered VM, so a change to a VM
+    needs no iso to be built again. A VM is known by the MAC addresses
+    anaconda sends with inst.ks.sendmac or, failing those, by its IP
+    address. It is served:
+
+    /ks.cfg the rendered kickstart file
+    /local/avium.yaml the configuration
+    /local/<name> the files returned by avmisoutils.local_files
+
+    Rendered files are cached until the VM is registered again or its
+    kickstart template changes. Other files are sent with sendfile.
+
+    :param host: the address to listen on, the host's host-only address
+    :param port: the port to listen on, 0 for an ephemeral port
+    """
+
+    __logger = logging.getLogger(__name__)
+
+    def __init__(self, host, port=0):
+        self.httpd = ThreadingHTTPServer((host, port), KickstartHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.ks_server = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.__vms = {}
+        self.__lock = threading.Lock()
+
+    def url(self, path=''):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{0}:{1}/{2}'.format(host, port, path.lstrip('/'))
+
+    def register(self, avium, mac=None, ip=None):
+        """
+        Serve the kickstart file and files of a VM.
+
+        :param avium: the avium application configured for the VM, its
+                      configuration is copied so later changes to it,
+                      e.g. by the next VM of a fleet, are not served
+        :param mac: the MAC address of the VM's host-only interface, in
+                    any of the usual notations
+        :param ip: the IP address the VM requests files from
+        """
+        keys = self.__keys(mac, ip)
+        if not keys:
+            raise RuntimeError('A VM needs a MAC or IP address to be '
+                               'served.\n')
+
+        avium = isoutils.BuildVariant(avium.get_conf_home(),
+                                      copy.deepcopy(avium.get_config()))
+        vm = {'avium': avium, 'files': isoutils.local_files(avium),
+              'rendered': {}}
+
+        with self.__lock:
+            for key in keys:
+                self.__vms[key] = vm
+
+        self.__logger.info("Serving the kickstart file of " +
+                           avium.get_config()['vm']['hostname'] + " to " +
+                           ', '.join(keys) + ".")
+
+    def unregister(self, mac=None, ip=None):
+        with self.__lock:
+            for key in self.__keys(mac, ip):
+                self.__vms.pop(key, None)
+
+    def lookup(self, macs, ip):
+        """
+        Return the VM with one of the MAC addresses, else the VM with
+        the IP address, or None if neither is registered.
+        """
+        with self.__lock:
+            for mac in macs:
+                vm = self.__vms.get(self.__normalize_mac(mac))
+                if vm is not None:
+                    return vm
+            return self.__vms.get(ip)
+
+    def render(self, vm, name):
+        """
+        Return the rendered ks.cfg or avium.yaml of a VM as bytes, or None
+        if its kickstart template is missing.
+        """
+        avium = vm['avium']
+
+        if r'ks.cfg' == name:
+            ks_path = isoutils.kickstart_path(avium)
+            try:
+                st = os.stat(ks_path)
+                stamp = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                return None
+        else:
+            stamp = None
+
+        with self.__lock:
+            cached = vm['rendered'].get(name)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+
+        if r'ks.cfg' == name:
+            content = isoutils.render_kickstart(avium, self.url('local'))
+            if content is None:
+                return None
+        else:
+            # The same form as avium.yaml on a custom iso
+            content = str(avium.get_config())
+        rendered = bytes(content, 'utf-8')
+
+        with self.__lock:
+            vm['rendered'][name] = (stamp, rendered)
+
+        return rendered
+
+    def start(self):
+        self.thread.start()
+        self.__logger.info("Kickstart server listening on " + self.url() +
+                           ".")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __keys(self, mac, ip):
+        keys = []
+        if mac is not None:
+            keys.append(self.__normalize_mac(mac))
+        if ip is not None:
+            keys.append(ip)
+        return keys
+
+    @staticmethod
+    def __normalize_mac(mac):
+        # VirtualBox writes 080027ABCDEF, anaconda 08:00:27:ab:cd:ef
+        digits = re.sub(r'[^0-9a-f]', '', mac.split()[-1].lower())
+        return ':'.join(digits[i:i + 2] for i in range(0, len(digits), 2))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+class KickstartHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    __logger = logging.getLogger(__name__)
+
+    def do_HEAD(self):
+        self.__send(head_only=True)
+
+    def do_GET(self):
+        self.__send(head_only=False)
+
+    def log_message(self, format, *args):
+        self.__logger.debug(self.address_string() + " " + format % args)
+
+    def __send(self, head_only):
+        ks_server = self.server.ks_server
+        macs = [value for name, value in self.headers.items()
+                if MAC_HEADER.match(name)]
+        vm = ks_server.lookup(macs, self.client_address[0])
+        path = urlparse(self.path).path
+
+        if vm is None:
+            self.send_error(404, 'Unknown VM')
+            return
+
+        if r'/ks.cfg' == path:
+            body = ks_server.render(vm, r'ks.cfg')
+        elif r'/local/avium.yaml' == path:
+            body = ks_server.render(vm, r'avium.yaml')
+        elif path.startswith(r'/local/') and \
+                path[len(r'/local/'):] in vm['files']:
+            self.__send_file(vm['files'][path[len(r'/local/'):]], head_only)
+            return
+        else:
+            body = None
+
+        if body is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if not head_only:
+            self.wfile.write(body)
+
+    def __send_file(self, file_path, head_only):
+        try:
+            local_file = open(file_path, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+
+        with local_file:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length',
+                             str(os.fstat(local_file.fileno()).st_size))
+            self.end_headers()
+
+            if not head_only:
+                # The kernel copies the file straight to the socket
+                self.wfile.flush()
+                self.connection.sendfile(local_file)
+
+
+def start_server(config):
+    """
+    Start the KickstartServer described by the app.ks_server section of
+    the configuration, or return None if it is not enabled.
+    """
+    ks_server = config['app'].get('ks_server', {})
+
+    if not ks_server.get('enabled', False):
+        return None
+
+    return KickstartServer(ks_server['host'], ks_server['port']).start()
@@ -16,129 +16,1410 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Avium Utilities. If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import fcntl
 import hashlib
 import logging
+import mmap
 import os
 import re
 import requests
+import threading
+import time
+import urllib3
+import yaml
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 
+# Size of the buffer each response is read into while downloading. Large
+# reads keep the number of Python level read/write calls per ISO small.
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
 
-def download_file(loc, url, overwrite=False):
+# Bytes downloaded between saves of a .part file's progress metadata
+PROGRESS_INTERVAL = 64 * 1024 * 1024
+
+# Smallest byte range a segmented download splits a file into
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Keep-alive connections kept open per host by the shared session
+DEFAULT_POOL_SIZE = 10
+
+# Times a request is retried on a connection error or a 5xx response
+DEFAULT_HTTP_RETRIES = 3
+
+# Concurrent downloads of a DownloadManager, overall and per host
+DEFAULT_MAX_DOWNLOADS = 4
+DEFAULT_PER_HOST = 2
+
+# Hex digest lengths of the supported hash algorithms
+HASH_LENGTHS = {'md5': 32, 'sha1': 40, 'sha256': 64, 'sha512': 128,
+                'blake2b': 128}
+
+# Checksum manifest lines, "<hash>  <name>" as written by sha256sum and
+# friends (binary mode prefixes the name with *) and the BSD tagged
+# "SHA256 (<name>) = <hash>" form used by the CentOS 8 CHECKSUM file
+GNU_CHECKSUM_LINE = re.compile(r'^([0-9a-fA-F]{32,128}) [ *]?(.+)$')
+BSD_CHECKSUM_LINE = re.compile(r'^([A-Za-z0-9-]+) \((.+)\) = ([0-9a-fA-F]+)$')
+
+# Persistent store of file digests keyed by path, inode, size and mtime
+DEFAULT_DIGEST_CACHE = os.path.join(os.path.expanduser('~'), r'.cache',
+                                    r'avium', r'digests.yaml')
+
+# Persistent store of mirror rankings and the seconds a ranking is used
+# before the mirrors are probed again
+DEFAULT_MIRROR_CACHE = os.path.join(os.path.expanduser('~'), r'.cache',
+                                    r'avium', r'mirrors.yaml')
+DEFAULT_MIRROR_TTL = 3600
+
+# Bytes fetched from each mirror to sample its throughput
+MIRROR_SAMPLE_SIZE = 1024 * 1024
+
+
+def configure_session(pool_size=DEFAULT_POOL_SIZE,
+                      retries=DEFAULT_HTTP_RETRIES, backoff=0.5):
+    """
+    Configure the HTTP session shared by every download in the package.
+    The session keeps a pool of keep-alive connections for each host, so
+    files fetched from the same mirror reuse one TCP/TLS connection.
+
+    Calling it again with the same settings keeps the existing session
+    and its open connections.
+
+    :param pool_size: the number of connections kept open per host, it
+                      should be at least the number of download segments
+    :param retries: the number of times a request is retried after a
+                    connection error or a 5xx response
+    :param backoff: the backoff factor in seconds between retries
+    :return: the shared requests.Session
+    """
+    global __session, __session_settings
+
+    settings = (pool_size, retries, backoff)
+
+    with __session_lock:
+        if __session is not None and __session_settings == settings:
+            return __session
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=['GET', 'HEAD'],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if __session is not None:
+            __session.close()
+
+        __session = session
+        __session_settings = settings
+
+    return session
+
+
+def get_session():
+    """
+    Return the shared HTTP session, creating it with the default settings
+    on first use.
+    """
+    if __session is None:
+        return configure_session()
+
+    return __session
+
+
+def download_file(loc, url, overwrite=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                  digest=None, checksum_url=None, hash_ver='sha256',
+                  segments=1, retries=3, cache=None, force_verify=False,
+                  callback=None, revalidate=False, mirrors=None):
     """
     Download a file from the specified url to the specified
     directory. Set overwrite to True to download and
-    overwrite an existing file.
+    overwrite an existing file. The working directory is not
+    changed, so several downloads may run on different threads.
 
     If the file is existing and overwrite is false, the file
     will not be downloaded again.
 
+    When a digest or a checksum manifest URL is given the file is hashed
+    while it streams to disk. A download that does not match is removed
+    and a RuntimeError is raised. An existing file that does not match is
+    downloaded again.
+
+    The ETag, Last-Modified and Content-Length of every download are
+    saved to <file>.http.yaml. With revalidate set an existing file, or
+    checksum manifest, is refreshed with a conditional GET and is only
+    transferred again if the server reports it changed.
+
+    If a transfer from url fails the download fails over to each of the
+    mirrors in turn. When the digest is known a partial download is
+    resumed from the next mirror rather than started again.
+
     :param loc: the local directory to save the file to
     :param url: the complete URL including the file to be downloaded
     :param overwrite: set to True to overwrite a previously
                       downloaded file that exists locally
+    :param chunk_size: the size in bytes of the buffer the download
+                       is read into
+    :param digest: the expected hex digest of the file
+    :param checksum_url: the URL of a checksum file that lists the
+                         expected digest of the file, it is saved to loc
+    :param hash_ver: the hash algorithm of the digest, e.g. sha256
+    :param segments: the number of byte ranges to download concurrently,
+                     see dlf_segmented
+    :param retries: the number of times a failed segment is retried
+    :param cache: an avmcacheutils.ContentCache, verified files are taken
+                  from it instead of being downloaded and added to it
+                  after they are downloaded
+    :param force_verify: set to True to hash an existing file even if
+                         the digest cache knows it is unchanged
+    :param callback: called with the bytes received so far and the total
+                     size (0 if unknown) as the download progresses
+    :param revalidate: set to True to refresh an existing file that has
+                       no expected digest, and the checksum manifest,
+                       with a conditional GET
+    :param mirrors: complete URLs of the same file on other mirrors, in
+                    the order they are tried if url fails, see
+                    rank_mirrors. A checksum manifest in the same
+                    directory as url is failed over to the same mirrors
+    :return: the download statistics returned by dlf with the url the
+             file was downloaded from, or None if the file was not
+             downloaded
     """
 
     __logger.debug("Download location..." + loc)
-    os.chdir(loc)
 
     furl = urlparse(url)
 
     if furl.scheme == '' and furl.netloc == '' and furl.path == '':
         raise Exception('The given URL will not work here.\n')
     else:
-        url_path = furl.path
-        path_parts = re.split('/', url_path)
-        path_len = len(path_parts)
-        file_name = path_parts[path_len - 1]
+        file_name = __url_file_name(furl)
 
-        wd = os.path.abspath(r'.')
+        wd = os.path.abspath(loc)
         a_file = os.path.join(wd, file_name)
 
-        if overwrite:
-            dlf(file_name, url)
+        if checksum_url is not None:
+            digest = __manifest_digest(
+                __checksum_urls(url, checksum_url, mirrors), wd, file_name,
+                hash_ver, chunk_size, revalidate)
+
+        # Only verified files are taken from or added to the cache
+        use_cache = cache is not None and digest is not None
+        validators = None
+
+        if not overwrite:
+            # A file with a digest is checked against it, anything else
+            # can only be checked with the server
+            if revalidate and digest is None:
+                validators = __load_validators(a_file, url)
+            if validators is None and __is_current(a_file, digest, hash_ver,
+                                                   cache, use_cache,
+                                                   force_verify):
+                return None
+            if validators is None and os.path.exists(a_file):
+                __logger.warning(file_name + " does not match its "
+                                 "checksum, downloading it again.")
+
+        urls = [url] + list(mirrors or [])
+
+        for index, mirror in enumerate(urls):
+            try:
+                if segments > 1 and validators is None:
+                    stats = dlf_segmented(a_file, mirror, segments,
+                                          chunk_size, digest, hash_ver,
+                                          retries, callback)
+                else:
+                    stats = dlf(a_file, mirror, chunk_size, digest, hash_ver,
+                                callback, validators)
+                break
+            except (requests.RequestException, urllib3.exceptions.HTTPError,
+                    RuntimeError) as err:
+                if index == len(urls) - 1:
+                    raise
+                __logger.warning("Download from " + mirror + " failed, " +
+                                 "trying " + urls[index + 1] + ": " +
+                                 str(err).strip())
+                # Validators only apply to the mirror they came from
+                validators = None
+                if digest is not None:
+                    __hand_over(a_file, urls[index + 1])
+
+        if stats is None:
+            __logger.info(file_name + " is unchanged on the server.")
+            return None
+
+        stats['url'] = mirror
+        __save_validators(a_file, mirror, stats)
+
+        if stats['digest'] is not None:
+            __remember_digest(a_file, hash_ver, stats['digest'])
+
+        if use_cache:
+            cache.store(a_file, mirror, digest, hash_ver)
+
+        return stats
+
+    return None
+
+
+def rank_mirrors(urls, sample_size=MIRROR_SAMPLE_SIZE,
+                 ttl=DEFAULT_MIRROR_TTL, timeout=10):
+    """
+    Order the URLs of a file on several mirrors from the fastest to the
+    slowest. Every mirror is probed concurrently with a HEAD request,
+    which times its latency, and a ranged GET of the first sample_size
+    bytes, which samples its throughput. Mirrors are ranked by the time
+    they would take to deliver the whole file, those that fail the probe
+    come last. The ranking is persisted and reused for ttl seconds.
+
+    :param urls: complete URLs of the same file on different mirrors
+    :param sample_size: the number of bytes fetched to sample throughput
+    :param ttl: the seconds a persisted ranking is reused, 0 to probe
+    :param timeout: the seconds a mirror has to answer each request
+    :return: the URLs, fastest first
+    """
+    urls = list(urls)
+    if len(urls) < 2:
+        return urls
+
+    key = '\n'.join(sorted(urls))
+    ranking = __load_rankings().get(key)
+    if ranking is not None and time.time() - ranking['time'] < ttl:
+        return ranking['urls']
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        probes = list(pool.map(lambda url: __probe_mirror(
+            url, sample_size, timeout), urls))
+
+    probes.sort(key=lambda probe: (probe['error'] is not None,
+                                   probe['estimate']))
+
+    for probe in probes:
+        if probe['error'] is None:
+            __logger.info("Mirror " + probe['url'] + ": " +
+                          str(round(probe['latency'] * 1000)) + " ms, " +
+                          __format_rate(probe['throughput']) + ".")
         else:
-            if not os.path.exists(a_file):
-                dlf(file_name, url)
+            __logger.warning("Mirror " + probe['url'] + " failed its " +
+                             "probe: " + probe['error'])
+
+    ranked = [probe['url'] for probe in probes]
+    __store_ranking(key, ranked)
+
+    return ranked
+
+
+def configure_mirror_cache(path=DEFAULT_MIRROR_CACHE):
+    """
+    Set the file used to persist mirror rankings, None disables it.
+    """
+    global __mirror_cache
 
+    __mirror_cache = path
 
-def verify_hash(loc, file_name, checksum_file, hash_ver):
+
+def verify_hash(loc, file_name, checksum_file, hash_ver, force=False):
     """
     Verifies the hash of a downloaded file. Supports SHA1, SHA256, SHA512,
-    and md5.
+    BLAKE2b and md5.
 
     :param loc: the local directory of the downloaded file
                 and the checksum file
     :param file_name: the name of the file to verify
     :param checksum_file: the name of the file that contains
                           the hash to verify against
-    :param hash_ver: Must be specified as: sha1, sha256, sha512, md5
+    :param hash_ver: Must be specified as: sha1, sha256, sha512, blake2b,
+                     md5
+    :param force: set to True to hash the file even if the digest cache
+                  knows it is unchanged
     :return: returns True if the hash is verified, returns False
              if the hash is not verified
     """
 
-    os.chdir(loc)
-
-    hash_func = ''
-    hash_len = 0
-    # Set hash
-    if 'sha1' == hash_ver:
-        hash_len = 40
-        hash_func = hashlib.sha1()
-    elif 'sha256' == hash_ver:
-        hash_len = 64
-        hash_func = hashlib.sha256()
-    elif 'sha512' == hash_ver:
-        hash_len = 128
-        hash_func = hashlib.sha512()
-    elif 'md5' == hash_ver:
-        hash_len = 16
-        hash_func = hashlib.md5()
+    result = __verify_one(os.path.join(loc, file_name),
+                          os.path.join(loc, checksum_file), hash_ver, force)
+
+    if result['verified']:
+        __logger.info("Checksum... " + result['expected'] + " verified.\n")
+
+    return result['verified']
+
+
+def verify_many(jobs, workers=None, processes=False, force=False):
+    """
+    Verify several files against their checksum manifests concurrently.
+    The working directory is not changed, relative paths are resolved
+    against it.
+
+    :param jobs: a list of (path, manifest, hash_ver) tuples, the file's
+                 base name is looked up in the manifest
+    :param workers: the number of concurrent verifications, defaults to
+                    the number of jobs capped at the number of CPUs
+    :param processes: set to True to verify on a process pool instead of
+                      a thread pool, hashlib releases the GIL so threads
+                      are usually enough
+    :param force: set to True to hash the files even if the digest cache
+                  knows they are unchanged
+    :return: a list with a result dict per job, in the order of jobs,
+             holding the path, manifest, hash_ver, expected and actual
+             digests, verified, seconds and error
+    """
+    if not jobs:
+        return []
+
+    if workers is None:
+        workers = min(len(jobs), os.cpu_count() or 1)
+
+    pool_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+    with pool_type(max_workers=workers) as pool:
+        futures = [pool.submit(__verify_one, os.path.abspath(path),
+                               os.path.abspath(manifest), hash_ver, force)
+                   for path, manifest, hash_ver in jobs]
+        results = [future.result() for future in futures]
+
+    for result in results:
+        if not result['verified']:
+            __logger.warning("Verification of " + result['path'] +
+                             " failed: " + str(result['error']))
+
+    return results
+
+
+def file_digest(path, hash_ver='sha256', force=False):
+    """
+    Return the hex digest of a file. Digests are kept in a persistent
+    cache keyed by the file's path, inode, size and modification time, so
+    an unchanged file is not hashed again. Any change to those keys
+    invalidates the cached digest.
+
+    :param path: the file to hash
+    :param hash_ver: the hash algorithm, e.g. sha256
+    :param force: set to True to hash the file even if its digest is
+                  cached
+    :return: the hex digest of the file
+    """
+    return file_digests(path, [hash_ver], force)[hash_ver]
+
+
+def file_digests(path, hash_vers, force=False):
+    """
+    Return several hex digests of a file computed in a single pass. The
+    file is memory mapped and every algorithm walks the mapping on its
+    own thread, hashlib releases the GIL while it hashes, so memory use
+    does not grow with the file size. Digests found in the persistent
+    digest cache are not computed again, see file_digest.
+
+    :param path: the file to hash
+    :param hash_vers: the hash algorithms, any of md5, sha1, sha256,
+                      sha512 and blake2b
+    :param force: set to True to hash the file even if its digests are
+                  cached
+    :return: a dict of hash algorithm to hex digest
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    digests = {}
+
+    if not force:
+        entry = __load_digests().get(path)
+        if entry is not None and entry['key'] == __digest_key(st):
+            digests = {hash_ver: entry['digests'][hash_ver]
+                       for hash_ver in hash_vers
+                       if hash_ver in entry['digests']}
+            if digests:
+                __logger.debug("Using cached " + ", ".join(digests) +
+                               " of " + path)
+
+    missing = [hash_ver for hash_ver in hash_vers if hash_ver not in digests]
+    if missing:
+        computed = __hash_file_multi(path, missing)
+        # The key is taken before hashing, a file changed meanwhile is
+        # hashed again next time
+        __store_digests(path, st, computed)
+        digests.update(computed)
+
+    return digests
+
+
+def read_manifest(checksum_file):
+    """
+    Parse a checksum manifest such as SHA256SUMS or CHECKSUM into an
+    index of file name to (hash algorithm, hex digest). Both the
+    "<hash>  <name>" and the BSD "SHA256 (<name>) = <hash>" forms are
+    understood, other lines (comments, PGP signatures) are skipped. The
+    index is cached until the manifest's modification time or size
+    changes.
+
+    :param checksum_file: the path of the checksum manifest
+    :return: a dict of file name to a (hash_ver, digest) tuple
+    """
+    path = os.path.abspath(checksum_file)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+
+    with __manifest_lock:
+        cached = __manifests.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+    # Algorithms of untagged 128 character digests can only be told by
+    # the manifest's name, e.g. BLAKE2SUMS or b2sums.txt
+    base_name = os.path.basename(path).lower()
+    if 'b2' in base_name or 'blake2' in base_name:
+        long_hash = 'blake2b'
     else:
-        return False
-
-    ck_hash = ''
-    # Open the checksum and get the relevant hash
-    if os.path.exists(checksum_file) and os.path.exists(file_name):
-        with open(checksum_file, 'r') as cf:
-            cf_lines = cf.readlines()
-            for line in cf_lines:
-                tmp = line.strip().split(' ')
-                if len(tmp) == 2:
-                    if re.search(file_name, tmp[1]):
-                        ck_hash = tmp[0]
-                        __logger.debug("Retrieved checksum: %s", ck_hash)
-                        __logger.debug("Length of checksum: %s", len(ck_hash))
-
-    hf_hash = ''
-    if os.path.exists(file_name):
-        with open(file_name, 'rb') as hf:
-            hf_content = hf.read()
-            hash_func.update(hf_content)
-            hf_hash = hash_func.hexdigest()
-            __logger.debug("Calculated checksum:  %s", hf_hash)
-            __logger.debug("Length of checksum: %s", len(hf_hash))
-
-    if len(ck_hash) == hash_len and len(hf_hash) == hash_len:
-        if ck_hash == hf_hash:
-            __logger.info("Checksum... " + ck_hash + " verified.\n")
+        long_hash = 'sha512'
+    by_length = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: long_hash}
+
+    index = {}
+    with open(path, 'r') as cf:
+        for line in cf:
+            line = line.strip()
+
+            bsd = BSD_CHECKSUM_LINE.match(line)
+            if bsd is not None:
+                hash_ver = bsd.group(1).lower().replace('-', '')
+                index[bsd.group(2)] = (hash_ver, bsd.group(3).lower())
+                continue
+
+            gnu = GNU_CHECKSUM_LINE.match(line)
+            if gnu is not None and len(gnu.group(1)) in by_length:
+                index[gnu.group(2)] = (by_length[len(gnu.group(1))],
+                                       gnu.group(1).lower())
+
+    with __manifest_lock:
+        __manifests[path] = (key, index)
+
+    return index
+
+
+def configure_digest_cache(path=DEFAULT_DIGEST_CACHE):
+    """
+    Set the file used to persist file digests, None disables the cache.
+    """
+    global __digest_cache
+
+    __digest_cache = path
+
+
+def dlf(file_name, furl, chunk_size=DEFAULT_CHUNK_SIZE, digest=None,
+        hash_ver='sha256', callback=None, validators=None):
+    """
+    Stream a URL to a local file. The response body is read into a
+    single reused buffer of chunk_size bytes and the local file is
+    preallocated when the server reports a Content-Length.
+
+    The download is written to <file_name>.part and its progress is
+    recorded in <file_name>.part.yaml. An interrupted download is resumed
+    with a Range request when the server supports it, otherwise it is
+    restarted. The file is only renamed into place once it is complete.
+
+    :param file_name: the local file to write
+    :param furl: the complete URL of the file to download
+    :param chunk_size: the size in bytes of the read buffer
+    :param digest: the expected hex digest, the file is removed and a
+                   RuntimeError raised if the download does not match
+    :param hash_ver: the hash algorithm of the digest, e.g. sha256
+    :param callback: called with the bytes received so far and the total
+                     size (0 if unknown) after every read
+    :param validators: a dict with the etag and last_modified of a copy
+                       of the file already on disk, the request is made
+                       conditional on the file having changed
+    :return: a dict with the bytes transferred, the elapsed seconds, the
+             achieved throughput in bytes per second, the hex digest and
+             the etag, last_modified and content_length validators, or
+             None if the validators show the file is unchanged
+    """
+    __logger.info("Downloading file... " + file_name)
+    part_file = file_name + '.part'
+    meta_file = part_file + '.yaml'
+
+    progress = __load_progress(meta_file)
+    offset = __resume_offset(part_file, progress, furl)
+
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes=' + str(offset) + '-'
+        if progress.get('etag'):
+            headers['If-Range'] = progress['etag']
+    elif validators is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    file_stream = __get(furl, headers)
+
+    if 304 == file_stream.status_code:
+        file_stream.close()
+        return None
+
+    if offset > 0 and not __is_resumed(file_stream, offset):
+        __logger.info("Server did not resume " + file_name +
+                      ", restarting the download.")
+        offset = 0
+    elif offset > 0:
+        __logger.info("Resuming " + file_name + " at byte " + str(offset))
+
+    length = int(file_stream.headers.get('Content-Length', 0))
+    progress = {'url': furl,
+                'size': offset + length if length else 0,
+                'etag': file_stream.headers.get('ETag', ''),
+                'received': offset}
+    __save_progress(meta_file, progress)
+
+    hash_func = hashlib.new(hash_ver)
+    start = time.monotonic()
+
+    with open(part_file, 'r+b' if offset > 0 else 'wb') as local_file:
+        __hash_prefix(local_file, offset, hash_func, chunk_size)
+        __preallocate(local_file, progress['size'])
+        try:
+            __copy_stream(file_stream.raw, local_file, chunk_size,
+                          hash_func, progress, meta_file, callback)
+        finally:
+            local_file.flush()
+            __save_progress(meta_file, progress)
+            # A fully read response has already released its connection
+            # back to the session's pool, closing drops anything else
+            file_stream.close()
+        # Drop any preallocated space the server did not fill
+        local_file.truncate(progress['received'])
+
+    if progress['received'] < progress['size']:
+        raise RuntimeError('Download of ' + file_name + ' is incomplete, ' +
+                           str(progress['received']) + ' of ' +
+                           str(progress['size']) + ' bytes received. ' +
+                           'Download again to resume.\n')
+
+    stats = __transfer_stats(progress['received'] - offset,
+                             time.monotonic() - start)
+    stats['digest'] = hash_func.hexdigest()
+    stats.update(__response_validators(file_stream, progress['received']))
+
+    if digest is not None and stats['digest'] != digest.lower():
+        os.remove(part_file)
+        os.remove(meta_file)
+        raise RuntimeError('Checksum mismatch for ' + file_name +
+                           ', expected ' + digest + ' got ' +
+                           stats['digest'] + '. Download removed.\n')
+
+    os.replace(part_file, file_name)
+    os.remove(meta_file)
+
+    __logger.info(file_name + " download completed, " +
+                  __format_rate(stats['throughput']) + ".")
+
+    return stats
+
+
+def dlf_segmented(file_name, furl, segments, chunk_size=DEFAULT_CHUNK_SIZE,
+                  digest=None, hash_ver='sha256', retries=3, callback=None):
+    """
+    Download a URL as several byte ranges fetched concurrently, each one
+    written at its offset of a preallocated <file_name>.part file. The
+    progress of every segment is recorded in <file_name>.part.yaml so an
+    interrupted download resumes where each segment stopped.
+
+    Servers that ignore Range requests, and files too small to split,
+    are downloaded with dlf as a single stream. A requested digest is
+    computed in file order while the download runs: every time a segment
+    completes, the completed segments that continue the hashed prefix are
+    read back, while they are still in the page cache, and hashed.
+
+    :param file_name: the local file to write
+    :param furl: the complete URL of the file to download
+    :param segments: the maximum number of concurrent byte ranges
+    :param chunk_size: the size in bytes of each segment's read buffer
+    :param digest: the expected hex digest, the file is removed and a
+                   RuntimeError raised if the download does not match
+    :param hash_ver: the hash algorithm of the digest, e.g. sha256
+    :param retries: the number of times a failed segment is retried
+    :param callback: called with the bytes received so far and the total
+                     size as the segments progress
+    :return: a dict with the bytes transferred, the elapsed seconds, the
+             achieved throughput in bytes per second, the hex digest,
+             which is None when no digest was requested, and the etag,
+             last_modified and content_length validators
+    """
+    size, probe = __probe_range(furl)
+    etag = probe.headers.get('ETag', '') if probe is not None else ''
+    count = min(segments, size // MIN_SEGMENT_SIZE)
+
+    if count < 2:
+        __logger.info("Segmented download not available for " + file_name +
+                      ", using a single stream.")
+        return dlf(file_name, furl, chunk_size, digest, hash_ver, callback)
+
+    part_file = file_name + '.part'
+    meta_file = part_file + '.yaml'
+
+    progress = __load_progress(meta_file)
+    if not __can_resume_segments(part_file, progress, furl, size, etag):
+        progress = {'url': furl, 'size': size, 'etag': etag,
+                    'segments': __split_ranges(size, count)}
+        with open(part_file, 'wb') as local_file:
+            __preallocate(local_file, size)
+            local_file.truncate(size)
+    progress['etag'] = etag
+    __save_progress(meta_file, progress)
+
+    pending = [seg for seg in progress['segments']
+               if seg['received'] < seg['end'] - seg['start'] + 1]
+    resumed = size - sum(seg['end'] - seg['start'] + 1 - seg['received']
+                         for seg in pending)
+
+    __logger.info("Downloading file... " + file_name + " in " +
+                  str(len(pending)) + " segments")
+
+    lock = threading.Lock()
+    start = time.monotonic()
+    hash_func = hashlib.new(hash_ver) if digest is not None else None
+    hashed = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(pending) or 1) as pool, \
+                open(part_file, 'rb') as hash_file:
+            futures = [pool.submit(__fetch_segment, part_file, furl, seg,
+                                   chunk_size, retries, progress,
+                                   meta_file, lock, callback)
+                       for seg in pending]
+            if hash_func is not None:
+                # Segments completed before a resume are hashed first
+                hashed = __hash_segments(hash_file, progress, hashed,
+                                         hash_func, chunk_size, lock)
+            for future in as_completed(futures):
+                future.result()
+                if hash_func is not None:
+                    hashed = __hash_segments(hash_file, progress, hashed,
+                                             hash_func, chunk_size, lock)
+    finally:
+        with lock:
+            __save_progress(meta_file, progress)
+
+    stats = __transfer_stats(size - resumed, time.monotonic() - start)
+    stats['digest'] = None
+    stats.update(__response_validators(probe, size))
+
+    if digest is not None:
+        stats['digest'] = hash_func.hexdigest()
+        if hashed != size or stats['digest'] != digest.lower():
+            os.remove(part_file)
+            os.remove(meta_file)
+            raise RuntimeError('Checksum mismatch for ' + file_name +
+                               ', expected ' + digest + ' got ' +
+                               stats['digest'] + '. Download removed.\n')
+
+    os.replace(part_file, file_name)
+    os.remove(meta_file)
+
+    __logger.info(file_name + " download completed, " +
+                  __format_rate(stats['throughput']) + ".")
+
+    return stats
+
+
+class DownloadManager:
+    """
+    Runs a batch of downloads with overlapping transfers on an asyncio
+    event loop. Each download is a download_file call on a worker thread,
+    a global and a per-host semaphore bound how many run at once.
+
+    Progress is kept in the progress dict, keyed by URL, and
+    wait_progress can be awaited for the next change.
+
+    :param max_downloads: the number of downloads running at once
+    :param per_host: the number of downloads running at once per host
+    :param options: keyword arguments passed to every download_file call
+    """
+
+    __logger = logging.getLogger(__name__)
+
+    def __init__(self, max_downloads=DEFAULT_MAX_DOWNLOADS,
+                 per_host=DEFAULT_PER_HOST, **options):
+        self.max_downloads = max_downloads
+        self.per_host = per_host
+        self.options = options
+        self.progress = {}
+        self.__loop = None
+        self.__changed = None
+
+    async def run(self, jobs):
+        """
+        Download every job and return a list with a result dict per job,
+        in the order of jobs, holding the url, loc, stats, seconds and
+        error (None on success).
+
+        :param jobs: a list of (url, loc) tuples or dicts with url and
+                     loc keys plus any download_file keyword arguments
+        """
+        self.__loop = asyncio.get_running_loop()
+        if self.__changed is None:
+            self.__changed = asyncio.Event()
+        limit = asyncio.Semaphore(self.max_downloads)
+        hosts = {}
+
+        jobs = [job if isinstance(job, dict) else
+                {'url': job[0], 'loc': job[1]} for job in jobs]
+        for job in jobs:
+            self.progress[job['url']] = {'loc': job['loc'],
+                                         'state': 'queued',
+                                         'received': 0, 'total': 0}
+            host = urlparse(job['url']).netloc
+            if host not in hosts:
+                hosts[host] = asyncio.Semaphore(self.per_host)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_downloads)
+        try:
+            return await asyncio.gather(
+                *[self.__run_job(job, limit,
+                                 hosts[urlparse(job['url']).netloc],
+                                 executor) for job in jobs])
+        finally:
+            executor.shutdown(wait=False)
+
+    async def wait_progress(self):
+        """
+        Wait for the next progress change and return a copy of the
+        progress dict.
+        """
+        if self.__changed is None:
+            self.__changed = asyncio.Event()
+        await self.__changed.wait()
+        return {url: dict(entry) for url, entry in self.progress.items()}
+
+    async def __run_job(self, job, limit, host_limit, executor):
+        url = job['url']
+        options = dict(self.options)
+        options.update({key: value for key, value in job.items()
+                        if key not in ('url', 'loc')})
+        options['callback'] = self.__callback(url)
+        result = {'url': url, 'loc': job['loc'], 'stats': None,
+                  'seconds': 0.0, 'error': None}
+
+        # The host slot is taken first, a job waiting for a busy host must
+        # not hold a global slot another host could use
+        async with host_limit, limit:
+            self.__update(url, state='downloading')
+            start = time.monotonic()
+            try:
+                result['stats'] = await self.__loop.run_in_executor(
+                    executor, lambda: download_file(job['loc'], url,
+                                                    **options))
+                self.__update(url, state='done')
+            except (OSError, RuntimeError, requests.RequestException,
+                    urllib3.exceptions.HTTPError) as err:
+                result['error'] = str(err)
+                self.__update(url, state='failed')
+                self.__logger.error("Download of " + url + " failed: " +
+                                    str(err))
+            result['seconds'] = time.monotonic() - start
+
+        return result
+
+    def __callback(self, url):
+        # Called on a download thread, the update is handed to the loop
+        def callback(received, total):
+            self.__loop.call_soon_threadsafe(
+                lambda: self.__update(url, received=received, total=total))
+
+        return callback
+
+    def __update(self, url, **changes):
+        self.progress[url].update(changes)
+        # Wake every waiter and start a new round of waiting
+        self.__changed.set()
+        self.__changed = asyncio.Event()
+
+
+def download_many(jobs, max_downloads=DEFAULT_MAX_DOWNLOADS,
+                  per_host=DEFAULT_PER_HOST, **options):
+    """
+    Download a batch of files with overlapping transfers and wait for
+    them to finish, see DownloadManager.
+
+    :param jobs: a list of (url, loc) tuples or dicts with url and loc
+                 keys plus any download_file keyword arguments
+    :param max_downloads: the number of downloads running at once
+    :param per_host: the number of downloads running at once per host
+    :param options: keyword arguments passed to every download_file call
+    :return: a list with a result dict per job, see DownloadManager.run
+    """
+    manager = DownloadManager(max_downloads, per_host, **options)
+    return asyncio.run(manager.run(jobs))
+
+
+def __fetch_segment(part_file, furl, segment, chunk_size, retries, progress,
+                    meta_file, lock, callback):
+    attempt = 0
+    while True:
+        try:
+            __copy_segment(part_file, furl, segment, chunk_size, progress,
+                           meta_file, lock, callback)
+            return
+        except (requests.RequestException, urllib3.exceptions.HTTPError,
+                RuntimeError) as err:
+            attempt += 1
+            if attempt > retries:
+                raise
+            __logger.warning("Segment at byte " + str(segment['start']) +
+                             " failed, retry " + str(attempt) + " of " +
+                             str(retries) + ": " + str(err))
+
+
+def __copy_segment(part_file, furl, segment, chunk_size, progress, meta_file,
+                   lock, callback):
+    first = segment['start'] + segment['received']
+    headers = {'Range': 'bytes=' + str(first) + '-' + str(segment['end'])}
+
+    file_stream = __get(furl, headers)
+    remaining = segment['end'] - first + 1
+    try:
+        if not __is_resumed(file_stream, first):
+            raise RuntimeError('Server did not return the range starting '
+                               'at byte ' + str(first) + '.\n')
+
+        raw = file_stream.raw
+        # The range is of the bytes on the server, never decode them
+        raw.decode_content = False
+        view = memoryview(bytearray(chunk_size))
+        unsaved = 0
+
+        with open(part_file, 'r+b') as local_file:
+            local_file.seek(first)
+            while remaining > 0:
+                count = raw.readinto(view[:min(chunk_size, remaining)])
+                if not count:
+                    break
+                local_file.write(view[:count])
+                remaining -= count
+                unsaved += count
+
+                with lock:
+                    segment['received'] += count
+                    if unsaved >= PROGRESS_INTERVAL:
+                        __save_progress(meta_file, progress)
+                        unsaved = 0
+                    if callback is not None:
+                        callback(__segments_received(progress),
+                                 progress['size'])
+    finally:
+        file_stream.close()
+
+    if remaining > 0:
+        raise RuntimeError('Segment ended ' + str(remaining) +
+                           ' bytes early.\n')
+
+
+def __hash_segments(hash_file, progress, offset, hash_func, chunk_size,
+                    lock):
+    # Hash the completed segments that continue the hashed prefix at
+    # offset and return the new end of the prefix. A completed segment's
+    # file handle is closed, so its bytes are all visible.
+    for segment in sorted(progress['segments'], key=lambda seg: seg['start']):
+        if segment['end'] < offset:
+            continue
+        with lock:
+            complete = segment['received'] == \
+                segment['end'] - segment['start'] + 1
+        if not complete:
+            break
+
+        hash_file.seek(offset)
+        remaining = segment['end'] + 1 - offset
+        while remaining > 0:
+            block = hash_file.read(min(chunk_size, remaining))
+            if not block:
+                break
+            hash_func.update(block)
+            remaining -= len(block)
+        offset = segment['end'] + 1 - remaining
+
+        if remaining:
+            break
+
+    return offset
+
+
+def __get(furl, headers=None):
+    # Files are fetched byte for byte, a compressed response would neither
+    # fit the read buffers nor match Content-Length and byte ranges
+    headers = dict(headers or {})
+    headers.setdefault('Accept-Encoding', 'identity')
+    file_stream = get_session().get(furl, headers=headers, stream=True)
+    if not file_stream.ok:
+        file_stream.close()
+        file_stream.raise_for_status()
+
+    return file_stream
+
+
+def __segments_received(progress):
+    return sum(seg['received'] for seg in progress['segments'])
+
+
+def __probe_range(furl):
+    # A one byte range request tells whether ranges work and the file size.
+    # A server that ignores the range sends the whole file, so the body is
+    # never read, only the status and headers are kept.
+    with get_session().get(furl, stream=True, headers={
+            'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'}) \
+            as file_stream:
+        pass
+
+    content_range = file_stream.headers.get('Content-Range', '')
+    total = content_range.rpartition('/')[2]
+
+    if 206 != file_stream.status_code or not total.isdigit():
+        return 0, None
+
+    return int(total), file_stream
+
+
+def __split_ranges(size, count):
+    step = size // count
+    ranges = []
+    for index in range(count):
+        start = index * step
+        end = size - 1 if index == count - 1 else start + step - 1
+        ranges.append({'start': start, 'end': end, 'received': 0})
+
+    return ranges
+
+
+def __can_resume_segments(part_file, progress, furl, size, etag):
+    # A download handed over from another mirror has no etag to match
+    return progress.get('url') == furl and progress.get('size') == size \
+        and progress.get('etag') in (None, etag) and 'segments' in progress \
+        and os.path.isfile(part_file) \
+        and os.path.getsize(part_file) == size
+
+
+def __copy_stream(raw, local_file, chunk_size, hash_func, progress,
+                  meta_file, callback):
+    # The file is requested without Content-Encoding. Decoding would
+    # return more bytes than fit the buffer and break the byte counts.
+    raw.decode_content = False
+
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    unsaved = 0
+
+    while True:
+        count = raw.readinto(view)
+        if not count:
+            break
+        local_file.write(view[:count])
+        hash_func.update(view[:count])
+        progress['received'] += count
+
+        if callback is not None:
+            callback(progress['received'], progress['size'])
+
+        unsaved += count
+        if unsaved >= PROGRESS_INTERVAL:
+            local_file.flush()
+            __save_progress(meta_file, progress)
+            unsaved = 0
+
+
+def __hash_prefix(local_file, offset, hash_func, chunk_size):
+    # A resumed download hashes the bytes already on disk first
+    remaining = offset
+    while remaining > 0:
+        block = local_file.read(min(chunk_size, remaining))
+        if not block:
+            break
+        hash_func.update(block)
+        remaining -= len(block)
+
+    local_file.seek(offset)
+
+
+def __is_resumed(file_stream, offset):
+    content_range = file_stream.headers.get('Content-Range', '')
+
+    return 206 == file_stream.status_code and \
+        content_range.startswith('bytes ' + str(offset) + '-')
+
+
+def __load_progress(meta_file):
+    if not os.path.isfile(meta_file):
+        return {}
+
+    with open(meta_file) as meta:
+        progress = yaml.safe_load(meta)
+
+    return progress if isinstance(progress, dict) else {}
+
+
+def __resume_offset(part_file, progress, furl):
+    if progress.get('url') != furl or not os.path.isfile(part_file):
+        return 0
+
+    return min(int(progress.get('received', 0)),
+               os.path.getsize(part_file))
+
+
+def __hand_over(a_file, url):
+    # Let the next mirror resume the partial download. The etag of the
+    # previous mirror means nothing to it, so it is dropped and the
+    # digest alone vouches for the bytes already received.
+    meta_file = a_file + '.part.yaml'
+    progress = __load_progress(meta_file)
+
+    if progress:
+        progress['url'] = url
+        progress['etag'] = None
+        __save_progress(meta_file, progress)
+
+
+def __save_progress(meta_file, progress):
+    tmp_file = meta_file + '.tmp'
+    with open(tmp_file, 'w') as meta:
+        yaml.safe_dump(progress, meta)
+
+    os.replace(tmp_file, meta_file)
+
+
+def __verify_one(path, manifest, hash_ver, force):
+    result = {'path': path, 'manifest': manifest, 'hash_ver': hash_ver,
+              'expected': '', 'actual': '', 'verified': False,
+              'seconds': 0.0, 'error': None}
+    start = time.monotonic()
+
+    try:
+        if hash_ver not in HASH_LENGTHS:
+            raise ValueError('Unsupported hash ' + hash_ver)
+
+        entry = read_manifest(manifest).get(os.path.basename(path))
+        if entry is None or entry[0] != hash_ver:
+            raise LookupError('No ' + hash_ver + ' checksum for ' +
+                              os.path.basename(path) + ' in ' + manifest)
+
+        result['expected'] = entry[1]
+        result['actual'] = file_digest(path, hash_ver, force)
+
+        if result['expected'] == result['actual']:
+            result['verified'] = True
+        else:
+            result['error'] = 'checksum mismatch'
+    except (OSError, ValueError, LookupError) as err:
+        result['error'] = str(err)
+
+    result['seconds'] = time.monotonic() - start
+
+    return result
+
+
+def __is_current(a_file, digest, hash_ver, cache, use_cache, force_verify):
+    exists = os.path.exists(a_file)
+
+    if exists and digest is None:
+        return True
+    if use_cache:
+        if exists and cache.contains(a_file, digest, hash_ver):
             return True
+        obj = cache.lookup(digest, hash_ver)
+        if obj is not None:
+            cache.materialize(obj, a_file)
+            __remember_digest(a_file, hash_ver, digest.lower())
+            return True
+
+    return exists and \
+        file_digest(a_file, hash_ver, force_verify) == digest.lower()
+
+
+def __digest_key(st):
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def __load_digests():
+    if __digest_cache is None or not os.path.isfile(__digest_cache):
+        return {}
+
+    with open(__digest_cache) as dc:
+        digests = yaml.safe_load(dc)
+
+    return digests if isinstance(digests, dict) else {}
+
+
+def __remember_digest(path, hash_ver, digest):
+    path = os.path.abspath(path)
+    __store_digests(path, os.stat(path), {hash_ver: digest})
+
+
+def __store_digests(path, st, new_digests):
+    if __digest_cache is None:
+        return
+
+    os.makedirs(os.path.dirname(__digest_cache), 0o0750, exist_ok=True)
+
+    # The file lock serializes processes sharing the cache, the thread
+    # lock the threads of this one
+    with __digest_lock, open(__digest_cache + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        digests = __load_digests()
+        # Files deleted since they were hashed are dropped
+        digests = {cached: entry for cached, entry in digests.items()
+                   if cached == path or os.path.exists(cached)}
+        entry = digests.get(path)
+        key = __digest_key(st)
+
+        if entry is None or entry['key'] != key:
+            entry = {'key': key, 'digests': {}}
+            digests[path] = entry
+        entry['digests'].update(new_digests)
+
+        tmp_file = __digest_cache + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_file, 'w') as dc:
+            yaml.safe_dump(digests, dc)
+        os.replace(tmp_file, __digest_cache)
+
+
+def __hash_file_multi(path, hash_vers, chunk_size=DEFAULT_CHUNK_SIZE):
+    hash_funcs = {hash_ver: hashlib.new(hash_ver) for hash_ver in hash_vers}
+
+    with open(path, 'rb') as hf:
+        try:
+            mapped = mmap.mmap(hf.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files and some file systems cannot be mapped
+            __hash_chunks(hf, hash_funcs.values(), chunk_size)
         else:
-            return False
-    else:
-        return False
+            with mapped:
+                __hash_mapped(mapped, hash_funcs.values(), chunk_size)
 
+    return {hash_ver: hash_func.hexdigest()
+            for hash_ver, hash_func in hash_funcs.items()}
 
-def dlf(file_name, furl):
-    __logger.info("Downloading file... " + file_name)
-    file_stream = requests.get(furl, stream=True)
 
-    with open(file_name, 'wb') as local_file:
-        for data in file_stream:
-            local_file.write(data)
+def __hash_mapped(mapped, hash_funcs, chunk_size):
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+    view = memoryview(mapped)
+
+    def feed(hash_func):
+        for offset in range(0, len(view), chunk_size):
+            hash_func.update(view[offset:offset + chunk_size])
+
+    try:
+        if len(hash_funcs) == 1:
+            feed(next(iter(hash_funcs)))
+        else:
+            # The threads read the same pages, so the file is only read
+            # from disk once
+            with ThreadPoolExecutor(max_workers=len(hash_funcs)) as pool:
+                for future in [pool.submit(feed, hash_func)
+                               for hash_func in hash_funcs]:
+                    future.result()
+    finally:
+        view.release()
+
+
+def __hash_chunks(hf, hash_funcs, chunk_size):
+    view = memoryview(bytearray(chunk_size))
+
+    while True:
+        count = hf.readinto(view)
+        if not count:
+            break
+        for hash_func in hash_funcs:
+            hash_func.update(view[:count])
+
+
+def __checksum_urls(url, checksum_url, mirrors):
+    # A manifest beside the file is looked for beside it on every mirror
+    base_url, checksum_name = checksum_url.rsplit('/', 1)
+    if base_url != url.rsplit('/', 1)[0]:
+        return [checksum_url]
+
+    return [checksum_url] + [mirror.rsplit('/', 1)[0] + '/' + checksum_name
+                             for mirror in mirrors or []]
+
+
+def __manifest_digest(checksum_urls, wd, file_name, hash_ver, chunk_size,
+                      revalidate):
+    checksum_file = os.path.join(wd,
+                                 __url_file_name(urlparse(checksum_urls[0])))
+
+    validators = None
+    if revalidate:
+        validators = __load_validators(checksum_file, checksum_urls[0])
+
+    if validators is not None or not os.path.exists(checksum_file):
+        for index, checksum_url in enumerate(checksum_urls):
+            try:
+                stats = dlf(checksum_file, checksum_url, chunk_size,
+                            validators=validators)
+                break
+            except (requests.RequestException,
+                    urllib3.exceptions.HTTPError, RuntimeError) as err:
+                if index == len(checksum_urls) - 1:
+                    raise
+                __logger.warning("Download from " + checksum_url +
+                                 " failed, trying " +
+                                 checksum_urls[index + 1] + ": " +
+                                 str(err).strip())
+                # Validators only apply to the mirror they came from
+                validators = None
+        if stats is not None:
+            __save_validators(checksum_file, checksum_url, stats)
+
+    entry = read_manifest(checksum_file).get(file_name)
+    if entry is None:
+        raise RuntimeError('No checksum for ' + file_name + ' found in ' +
+                           checksum_file + '.\n')
+    if entry[0] != hash_ver:
+        raise RuntimeError(checksum_file + ' lists a ' + entry[0] +
+                           ' checksum for ' + file_name + ', not ' +
+                           hash_ver + '.\n')
+
+    __logger.debug("Retrieved checksum: %s", entry[1])
+    return entry[1]
+
+
+def __probe_mirror(url, sample_size, timeout):
+    probe = {'url': url, 'latency': 0.0, 'throughput': 0.0,
+             'estimate': float('inf'), 'error': None}
+
+    try:
+        start = time.monotonic()
+        head = get_session().head(url, timeout=timeout, allow_redirects=True)
+        probe['latency'] = time.monotonic() - start
+        head.raise_for_status()
+        size = int(head.headers.get('Content-Length', 0))
+
+        file_stream = get_session().get(
+            url, stream=True, timeout=timeout,
+            headers={'Range': 'bytes=0-' + str(sample_size - 1)})
+        # The latency is already known, only time the body
+        start = time.monotonic()
+        try:
+            file_stream.raise_for_status()
+            # A server that ignores the range must not send the whole file
+            received = len(file_stream.raw.read(sample_size))
+        finally:
+            file_stream.close()
+        elapsed = time.monotonic() - start
+
+        probe['throughput'] = received / elapsed if elapsed > 0 else 0.0
+        if probe['throughput'] > 0:
+            probe['estimate'] = probe['latency'] + \
+                (size or received) / probe['throughput']
+    except (requests.RequestException, urllib3.exceptions.HTTPError,
+            ValueError) as err:
+        probe['error'] = str(err)
+
+    return probe
+
+
+def __load_rankings():
+    if __mirror_cache is None or not os.path.isfile(__mirror_cache):
+        return {}
+
+    with open(__mirror_cache) as mc:
+        rankings = yaml.safe_load(mc)
+
+    return rankings if isinstance(rankings, dict) else {}
+
+
+def __store_ranking(key, urls):
+    if __mirror_cache is None:
+        return
+
+    with __mirror_lock:
+        rankings = __load_rankings()
+        rankings[key] = {'time': time.time(), 'urls': urls}
+
+        os.makedirs(os.path.dirname(__mirror_cache), 0o0750, exist_ok=True)
+        tmp_file = __mirror_cache + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_file, 'w') as mc:
+            yaml.safe_dump(rankings, mc)
+        os.replace(tmp_file, __mirror_cache)
+
+
+def __response_validators(file_stream, size):
+    return {'etag': file_stream.headers.get('ETag', ''),
+            'last_modified': file_stream.headers.get('Last-Modified', ''),
+            'content_length': size}
+
+
+def __load_validators(a_file, url):
+    # Validators only apply to the file as it was downloaded from url
+    meta_file = a_file + '.http.yaml'
+
+    if not os.path.isfile(a_file) or not os.path.isfile(meta_file):
+        return None
+
+    with open(meta_file) as meta:
+        validators = yaml.safe_load(meta)
+
+    if not isinstance(validators, dict) or validators.get('url') != url or \
+            validators.get('content_length') != os.path.getsize(a_file):
+        return None
+    if not validators.get('etag') and not validators.get('last_modified'):
+        return None
+
+    return validators
+
+
+def __save_validators(a_file, url, stats):
+    validators = {'url': url,
+                  'etag': stats['etag'],
+                  'last_modified': stats['last_modified'],
+                  'content_length': stats['content_length']}
+
+    with open(a_file + '.http.yaml', 'w') as meta:
+        yaml.safe_dump(validators, meta)
+
+
+def __url_file_name(furl):
+    path_parts = re.split('/', furl.path)
+    return path_parts[len(path_parts) - 1]
+
+
+def __preallocate(local_file, size):
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+
+    try:
+        os.posix_fallocate(local_file.fileno(), 0, size)
+    except OSError as err:
+        # Not every file system supports fallocate, the download still works
+        __logger.debug("Unable to preallocate " + local_file.name + ": " +
+                       str(err))
+
+
+def __transfer_stats(received, elapsed):
+    if elapsed > 0:
+        throughput = received / elapsed
+    else:
+        throughput = 0.0
+
+    return {'bytes': received, 'seconds': elapsed, 'throughput': throughput}
+
 
-    local_file.close()
-    __logger.info(file_name + " download completed.")
+def __format_rate(throughput):
+    return "{0:.2f} MiB/s".format(throughput / (1024 * 1024))
 
 
 __logger = logging.getLogger(__name__)
+__session = None
+__session_settings = None
+__session_lock = threading.Lock()
+__digest_cache = DEFAULT_DIGEST_CACHE
+__digest_lock = threading.Lock()
+__manifests = {}
+__manifest_lock = threading.Lock()
+__mirror_cache = DEFAULT_MIRROR_CACHE
+__mirror_lock = threading.Lock()
@@ -23,6 +23,8 @@ import re
 import shutil
 import subprocess
 
+from avmutils import avmtplutils as tplutils
+
 
 def enable_docker(avium):
     config = avium.get_config()
@@ -164,29 +166,14 @@ def set_sshd_config(avium):
 
             sshd_conf.close()
 
-        sshd_mod = re.sub(config['sshd']['pass_auth_key'],
-                          config['sshd']['pass_auth_value'],
-                          sshd_conf_content)
-
-        sshd_mod = re.sub(config['sshd']['pubkey_auth_key'],
-                          config['sshd']['pubkey_auth_value'],
-                          sshd_mod)
-
-        sshd_mod = re.sub(config['sshd']['client_ai_key'],
-                          config['sshd']['client_ai_value'],
-                          sshd_mod)
-
-        sshd_mod = re.sub(config['sshd']['client_ai_count_key'],
-                          config['sshd']['client_ai_count_value'],
-                          sshd_mod)
-
-        sshd_mod = re.sub(config['sshd']['tcp_keep_key'],
-                          config['sshd']['tcp_keep_value'],
-                          sshd_mod)
-
-        sshd_mod = re.sub(config['sshd']['banner_key'],
-                          config['sshd']['banner_value'],
-                          sshd_mod)
+        sshd = config['sshd']
+        sshd_mod = tplutils.render(sshd_conf_content, [
+            (sshd['pass_auth_key'], sshd['pass_auth_value']),
+            (sshd['pubkey_auth_key'], sshd['pubkey_auth_value']),
+            (sshd['client_ai_key'], sshd['client_ai_value']),
+            (sshd['client_ai_count_key'], sshd['client_ai_count_value']),
+            (sshd['tcp_keep_key'], sshd['tcp_keep_value']),
+            (sshd['banner_key'], sshd['banner_value'])])[0]
 
         with open(sshd_config_file, 'w') as sshd_conf:
             sshd_conf.write(sshd_mod)
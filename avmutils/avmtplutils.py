@@ -0,0 +1,176 @@
+# avmtplutils.py is a set of functions for rendering configuration templates
+# Copyright (C) 2021, 2022 Michael Konrad
+
+# This file is part of Avium Utilities.
+
+# Avium Utilities is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Avium Utilities is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Avium Utilities. If not, see <https://www.gnu.org/licenses/>.
+
+import functools
+import logging
+import re
+
+# Compiled templates kept for reuse, one per template and list of keys
+TEMPLATE_CACHE_SIZE = 128
+
+
+class Template:
+    """
+    A template compiled against a list of keys, so that it is rendered in
+    one pass with any values.
+
+    The keys are regular expressions, as in the configuration's *_key
+    entries. They are searched for once, with a single alternation of a
+    named group per key, and the template is split into its literal text
+    and the slots where a key matched. Rendering only fills the slots and
+    joins the parts, so rendering the template for many VMs does not
+    search it again.
+
+    Where several keys match at the same position the first one listed
+    wins. The values are expanded like re.sub replacement strings, so
+    escapes such as \\n and \\\\ keep working. Replaced text is not
+    searched again.
+
+    Keys that cannot be part of the alternation, those with groups of
+    their own or inline flags, are substituted afterwards, in order, with
+    re.sub over the rendered text. Their values may refer to their
+    groups and their matches are counted in the template.
+
+    :param text: the template
+    :param keys: the keys in order of precedence
+    """
+
+    def __init__(self, text, keys):
+        self.keys = list(keys)
+        self.__parts = [text]
+        self.__slots = []
+        self.__sequential = []
+
+        if self.keys:
+            self.__compile(text)
+
+        self.matched = dict.fromkeys(self.keys, 0)
+        for index in self.__slots:
+            self.matched[self.keys[index]] += 1
+        for index, pattern in self.__sequential:
+            self.matched[self.keys[index]] += sum(
+                1 for match in pattern.finditer(text))
+
+    def render(self, values):
+        """
+        Fill every slot of the template with the value of its key.
+
+        :param values: the value of each key, in the order of the keys
+        :return: the rendered text
+        """
+        rendered = self.__parts[0]
+
+        if self.__slots:
+            # A value that refers to the match, \g<0>, is expanded per
+            # slot, any other once
+            expanded = {index: None if '\\g' in values[index]
+                        else self.__empty.expand(values[index])
+                        for index in set(self.__slots)}
+            parts = self.__parts[:]
+            parts[1::2] = [expanded[index] for index in self.__slots]
+            if None in expanded.values():
+                for slot, index in enumerate(self.__slots, 1):
+                    if expanded[index] is None:
+                        parts[2 * slot - 1] = self.__whole.fullmatch(
+                            self.__parts[2 * slot - 1]).expand(values[index])
+            rendered = ''.join(parts)
+
+        for index, pattern in self.__sequential:
+            rendered = pattern.sub(values[index], rendered)
+
+        return rendered
+
+    def __compile(self, text):
+        alternatives = []
+
+        for index, key in enumerate(self.keys):
+            if self.__combinable(key):
+                alternatives.append('(?P<k' + str(index) + '>' + key + ')')
+            else:
+                self.__sequential.append((index, re.compile(key)))
+
+        if not alternatives:
+            return
+
+        pattern = re.compile('|'.join(alternatives))
+        parts = []
+        position = 0
+
+        # Literal text and slots alternate, starting and ending with text
+        for match in pattern.finditer(text):
+            parts.append(text[position:match.start()])
+            parts.append(match.group())
+            # Each alternative is one group, the one that matched names
+            # its key
+            self.__slots.append(int(match.lastgroup[1:]))
+            position = match.end()
+
+        parts.append(text[position:])
+        self.__parts = parts
+
+    @staticmethod
+    def __combinable(key):
+        # A key's own groups would be renumbered, breaking its back
+        # references, and inline flags would apply to every key
+        if re.compile(key).groups:
+            return False
+        try:
+            re.compile('|(?:' + key + ')')
+        except re.error:
+            return False
+        return True
+
+    # Expanding against an empty match processes the escapes of a
+    # replacement string the way re.sub does, expanding against a match
+    # of all of a slot's text also fills in the match
+    __empty = re.compile('').match('')
+    __whole = re.compile('.*', re.DOTALL)
+
+
+def render(text, replacements):
+    """
+    Render a template with a key/value map in one pass, see Template.
+    The compiled template is cached, so rendering it again for another
+    VM, whose values differ, neither compiles nor searches it again.
+
+    :param text: the template
+    :param replacements: (key, value) pairs in order of precedence
+    :return: the rendered text and a dict with the number of times each
+             key matched
+    """
+    template = compile_template(text, tuple(
+        key for key, value in replacements))
+    rendered = template.render([value for key, value in replacements])
+
+    unmatched = [key for key, count in template.matched.items()
+                 if not count]
+    if unmatched:
+        __logger.debug("Template keys not found: " + ', '.join(unmatched))
+
+    return rendered, dict(template.matched)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text, keys):
+    """
+    Return the cached Template of a text and a tuple of keys.
+    """
+    return Template(text, keys)
+
+
+__logger = logging.getLogger(__name__)
@@ -157,9 +157,8 @@ def __write_vimrc(home, vimrc_content):
 
 
 def __load_vim_plug(vim_autoload, vim_plug_url):
-    plug_vim = os.path.join(vim_autoload, r'plug.vim')
-    if not os.path.exists(plug_vim):
-        netutils.download_file(vim_autoload, vim_plug_url)
+    # An existing plug.vim is only downloaded again if it has changed
+    netutils.download_file(vim_autoload, vim_plug_url, revalidate=True)
 
 
 def __load_vim_pymode(vim_plugged, vim_pymode_url, git_path):
@@ -17,16 +17,102 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Avium Utilities. If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import contextlib
+import copy
 import logging
 import os
 import random
 import re
 import shutil
+import socket
 import subprocess
 import sys
+import threading
 import time
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
+
+from avmutils import avmisoutils as isoutils
+
+# A "Key: value" line of the vboxmanage list -l vms and showvminfo output.
+# Some versions print a key without its colon, e.g. "Memory size  2048MB".
+VM_INFO_LINE = re.compile(r'^(\S.*?)(?::\s*|\s{2,})(.*)$')
+
+# A key="value" line of showvminfo --machinereadable, storage keys are
+# quoted, e.g. "SATA-0-0"="/vms/avium01/disk1.vdi"
+VM_INFO_FIELD = re.compile(r'^("?)(.+?)\1=(.*)$')
+
+# Seconds a parsed showvminfo is served from the cache
+VM_INFO_TTL = 2.0
+
+# Fleet provisioning defaults, see the app.fleet section
+DEFAULT_FLEET_WORKERS = 4
+DEFAULT_MAX_DISK_CREATES = 2
+DEFAULT_MAX_STARTS = 4
+DEFAULT_ADDRESS_TIMEOUT = 300
+
+# Seconds to wait for the install of the golden image to power it off
+DEFAULT_INSTALL_TIMEOUT = 3600
+
+# States a VM does not leave without help, a wait for another state fails
+FAILED_STATES = ('aborted', 'gurumeditation', 'stuck')
+
+# Seconds to wait for a VM to reach a state
+DEFAULT_STATE_TIMEOUT = 120
+
+# The first and the longest interval between state polls, in seconds. The
+# interval doubles after every poll.
+STATE_POLL_INTERVAL = 0.25
+STATE_POLL_MAX_INTERVAL = 4.0
+
+# The guest property with the address of the host-only interface, the
+# guest's first, once the Guest Additions report it
+HOSTONLY_IPV4_PROPERTY = '/VirtualBox/GuestInfo/Net/0/V4/IP'
+
+# The guest property clone_vm sets to the hostname of a clone, which the
+# guest applies with apply_clone_hostname
+HOSTNAME_PROPERTY = '/Avium/Hostname'
+
+# The %post commands the golden image's kickstart runs after its seal,
+# see render_kickstart. They install a unit that runs
+# apply_clone_hostname on every boot, once the Guest Additions are up,
+# so each clone takes the hostname clone_vm set for it
+CLONE_HOSTNAME_UNIT = 'avium-clone-hostname.service'
+CLONE_HOSTNAME_SEAL = '''cat > /etc/systemd/system/{unit} << 'EOF'
+[Unit]
+Description=Set the hostname of this clone of the golden image
+After=vboxadd-service.service
+Wants=vboxadd-service.service
+
+[Service]
+Type=oneshot
+ExecStart=/usr/bin/python3 -c "from avmutils import avmvmutils; \
+avmvmutils.apply_clone_hostname()"
+
+[Install]
+WantedBy=multi-user.target
+EOF
+systemctl enable {unit}'''.format(unit=CLONE_HOSTNAME_UNIT)
+
+# The property vboxmanage guestproperty wait prints once it changes
+GUEST_PROPERTY = re.compile(
+    r'^Name: (?P<name>.*?), value: (?P<value>.*?)(?:, flags: (?P<flags>.*))?$',
+    re.MULTILINE)
+
+# The fields of a USB device filter in vboxmanage list -l vms, or
+# showvminfo, output, listed after USB Device Filters:
+USB_FILTER_FIELDS = ('Index', 'Active', 'Name', 'VendorId', 'ProductId',
+                     'Revision', 'Manufacturer', 'Product', 'Remote',
+                     'Serial Number', 'Port', 'MaskedInterfaces')
+
+# Human readable VM states whose machine readable form, as returned by
+# get_vm_state, is not the state with its spaces removed
+VM_STATES = {'powered off': 'poweroff',
+             'guru meditation': 'gurumeditation',
+             'deleting snapshot': 'deletingsnapshotlive'}
+
 
 ##############################################################################
 # Create functions
@@ -74,61 +160,219 @@ def create_hostonly_net(avium):
                           stdout.decode().strip())
 
 
-def create_vm(avium):
-    # Create VM Shell verifies hostname
-    vbox_home = create_vm_shell(avium)
-    config = avium.get_config()
+def create_vm(avium, ks_server=None):
+    """
+    Create and register the virtual machine described by the
+    configuration. With iso.mode set to http the VM is registered with
+    ks_server, an avmksutils.KickstartServer, by its host-only MAC address.
+    """
+    __check_ks_server(avium.get_config(), ks_server)
+    vbox_home = __create_vm(avium)
+    __attach_media(avium, vbox_home, ks_server)
 
-    __logger.info("Creating virtual machine...")
-    # Generate VirtualBox machine
-    subprocess.call(["vboxmanage", "modifyvm", config['vm']['hostname'],
-                     "--memory", str(config['vm']['ram']), "--vram",
-                     str(config['vm']['vram']), "--cpus",
-                     str(config['vm']['cpu']),
-                     "--defaultfrontend", config['vm']['frontend'],
-                     "--graphicscontroller", "vmsvga", "--nic1",
-                     config['vm']['nic1'], "--hostonlyadapter1",
-                     config['vm']['hostonlynet'], "--nic2",
-                     config['vm']['nic2'], "--boot1", "dvd", "--boot2", "disk",
-                     "--boot3", "net"])
+    __logger.info("Virtual machine created.")
 
-    # Create SATA controller
-    subprocess.call(["vboxmanage", "storagectl", config['vm']['hostname'],
-                    "--name", "SATA", "--add", "sata", "--bootable", "on"])
 
-    # Add disk(s)
-    disk_path = [None] * 2
-    disk_path[0] = os.path.join(vbox_home, r'disk1.vdi')
-    if 'managed' == config['vm']['node_type']:
-        disk_path[1] = os.path.join(vbox_home, r'disk2.vdi')
+def provision_fleet(avium, specs, ks_server=None):
+    """
+    Create, attach the media of, start and record many VMs at once on a
+    bounded pool of workers. The app.fleet section of the configuration
+    sets the number of workers, how many disks are created at once and
+    how many VMs are started at once, as both load the host's disk and
+    CPU, how long a start is waited for and, with app.dnsmasq enabled,
+    how long the guest's host-only address is waited for. A VM whose
+    address is not reported in time is recorded without a DHCP record.
+
+    With vm.golden_image enabled the golden image is built first, unless
+    it exists, and each VM is a linked clone of it, see clone_vm, so its
+    create and attach stages are replaced by a clone stage.
+
+    A VM that fails does not stop the others, its remaining stages are
+    skipped.
+
+    :param avium: the avium application the VMs are based on
+    :param specs: a dict per VM merged into a copy of the vm section of
+                  the configuration, e.g. {'hostname': 'node01',
+                  'node_type': 'managed'}
+    :param ks_server: the avmksutils.KickstartServer of iso.mode http
+    :return: a dict per VM, in the order of specs, with the hostname,
+             state, the seconds of each stage, create, attach or clone,
+             start and record, the seconds in total and the error, None
+             if the VM was provisioned
+    """
+    fleet = avium.get_config()['app'].get('fleet', {})
+    disk_limit = threading.Semaphore(fleet.get('max_disk_creates',
+                                               DEFAULT_MAX_DISK_CREATES))
+    start_limit = threading.Semaphore(fleet.get('max_starts',
+                                                DEFAULT_MAX_STARTS))
+    timeout = fleet.get('start_timeout', DEFAULT_STATE_TIMEOUT)
+    address_timeout = fleet.get('address_timeout', DEFAULT_ADDRESS_TIMEOUT)
+    members = []
+
+    if avium.get_config()['vm'].get('golden_image', {}).get('enabled',
+                                                            False):
+        build_golden_image(avium, ks_server)
+
+    for spec in specs:
+        config = copy.deepcopy(avium.get_config())
+        isoutils.merge_config(config['vm'], spec)
+        members.append(isoutils.BuildVariant(avium.get_conf_home(), config))
+
+    __logger.info("Provisioning " + str(len(members)) +
+                  " virtual machines...")
+
+    with ThreadPoolExecutor(max_workers=fleet.get(
+            'workers', DEFAULT_FLEET_WORKERS)) as pool:
+        results = list(pool.map(
+            lambda member: __provision_member(member, ks_server, disk_limit,
+                                              start_limit, timeout,
+                                              address_timeout),
+            members))
+
+    failed = [result for result in results if result['error'] is not None]
+    for result in failed:
+        __logger.error("Provisioning of " + result['hostname'] +
+                       " failed: " + result['error'])
+    __logger.info("Provisioned " + str(len(results) - len(failed)) + " of " +
+                  str(len(results)) + " virtual machines.")
+
+    return results
+
+
+def build_golden_image(avium, ks_server=None):
+    """
+    Build the golden image VMs are cloned from, unless it exists. The
+    base VM, vm.golden_image.base_vm, is created from the custom iso like
+    any VM, started and waited for until its kickstart powers it off at
+    the end of the install. The kickstart template's %post should hold
+    kickstart.seal_key, which is rendered for the golden image only,
+    clears its machine-id, SSH host keys and hostname and installs
+    CLONE_HOSTNAME_UNIT, see clone_vm. A
+    base VM that exists without the snapshot is waited for in the same
+    way. The installer and seed isos are then ejected, the VM is set to
+    boot from its disk and the disk is frozen by the snapshot
+    vm.golden_image.snapshot.
+
+    :param avium: the avium application
+    :param ks_server: the avmksutils.KickstartServer of iso.mode http
+    :return: a dict with the base_vm, snapshot, whether it was created
+             and the seconds it took
+    """
+    golden = avium.get_config()['vm']['golden_image']
+    base_vm, snapshot = golden['base_vm'], golden['snapshot']
+    start = time.monotonic()
 
-    index = 0
-    for dp in disk_path:
-        subprocess.call(["vboxmanage", "createmedium", "disk", "--filename",
-                         dp, "--size", str(config['vm']['hd_size']),
-                         "--variant", "Standard"])
-        subprocess.call(["vboxmanage", "storageattach",
-                         config['vm']['hostname'],
-                         "--storagectl", "SATA", "--port", str(index),
-                         "--type", "hdd", "--medium", dp])
-        index += 1
+    try:
+        info = get_vm_info(base_vm, ttl=0)
+    except RuntimeError:
+        info = None
+
+    if info is not None and snapshot in info.snapshots:
+        __logger.info("Golden image " + base_vm + " " + snapshot +
+                      " exists.")
+        return {'base_vm': base_vm, 'snapshot': snapshot, 'created': False,
+                'seconds': time.monotonic() - start}
+
+    if info is None:
+        __logger.info("Building golden image " + base_vm + "...")
+        config = copy.deepcopy(avium.get_config())
+        config['vm']['hostname'] = base_vm
+        create_vm(isoutils.BuildVariant(avium.get_conf_home(), config),
+                  ks_server)
+
+        started = start_vm(base_vm)
+        if not started.reached:
+            raise RuntimeError(started.error + '\n')
+
+    # A base VM that already exists may still be installing, its disk is
+    # only consistent once the install has powered it off
+    installed = wait_for_state(
+        base_vm, 'poweroff', golden.get('install_timeout',
+                                        DEFAULT_INSTALL_TIMEOUT),
+        max_interval=30.0)
+    if not installed.reached:
+        raise RuntimeError('The install of golden image ' + base_vm +
+                           ' did not finish: ' + installed.error + '\n')
+
+    # Clones boot the installed disk, not the installer or seed iso
+    for disk in get_vm_info(base_vm, ttl=0).disks:
+        if 'SATA' == disk['controller'] and disk['port'] in (2, 3):
+            subprocess.call(["vboxmanage", "storageattach", base_vm,
+                             "--storagectl", "SATA", "--port",
+                             str(disk['port']), "--device",
+                             str(disk['device']), "--type", "dvddrive",
+                             "--medium", "emptydrive"])
+    subprocess.call(["vboxmanage", "modifyvm", base_vm, "--boot1", "disk",
+                     "--boot2", "none"])
+    invalidate_vm_info(base_vm)
+
+    subprocess.call(["vboxmanage", "snapshot", base_vm, "take", snapshot,
+                     "--description", "Avium golden image"])
+    invalidate_vm_info(base_vm)
+
+    if snapshot not in get_vm_info(base_vm).snapshots:
+        raise RuntimeError('Unable to take snapshot ' + snapshot + ' of ' +
+                           base_vm + '.\n')
+
+    __logger.info("Golden image " + base_vm + " " + snapshot + " is ready.")
+
+    return {'base_vm': base_vm, 'snapshot': snapshot, 'created': True,
+            'seconds': time.monotonic() - start}
+
+
+def clone_vm(avium):
+    """
+    Create the configured VM as a linked clone of the golden image, see
+    build_golden_image. The clone shares the base VM's disk, its own disk
+    only holds what it changes, so it is created in seconds.
+
+    What is made unique: VirtualBox gives the clone a new UUID and new
+    MAC addresses, and its memory and CPUs are set from the
+    configuration. The hostname is set as the guest property
+    HOSTNAME_PROPERTY, which the guest applies at boot with
+    apply_clone_hostname, run by CLONE_HOSTNAME_UNIT. With app.dnsmasq
+    enabled, the DHCP record also hands the guest its hostname. The
+    machine-id and the SSH host keys are generated by the guest on its
+    first boot, provided the golden image's kickstart cleared them, see
+    kickstart.seal_key. The host records are written by save_vm_record
+    and save_dhcp_record, as for any VM.
+
+    What is not: everything else on the golden image's disk is shared,
+    e.g. users, their passwords and keys, installed packages and any
+    state the install left behind.
+
+    :param avium: the avium application
+    """
+    config = avium.get_config()
+    golden = config['vm']['golden_image']
+    hostname = __check_hostname(config['vm']['hostname'])
+    config['vm']['hostname'] = hostname
 
-    if config['iso']['required']:
-        # Add iso path
-        if 'centos_7' == config['iso']['distro']:
-            iso_path = os.path.join(config['app']['fs']['wd_path'], r'iso',
-                                    config['centos_7']['custom_iso'])
-        elif 'centos_8' == config['iso']['distro']:
-            iso_path = os.path.join(config['app']['fs']['wd_path'], r'iso',
-                                    config['centos_8']['custom_iso'])
+    __logger.info("Cloning virtual machine " + hostname + " from " +
+                  golden['base_vm'] + " " + golden['snapshot'] + "...")
 
-        # Attach iso installer
-        subprocess.call(["vboxmanage", "storageattach",
-                         config['vm']['hostname'], "--storagectl", "SATA",
-                         "--port", "2", "--type", "dvddrive",
-                         "--medium", iso_path])
+    vm_out = subprocess.Popen(["vboxmanage", "clonevm", golden['base_vm'],
+                               "--snapshot", golden['snapshot'],
+                               "--options", "link", "--name", hostname,
+                               "--register"],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
 
-    __logger.info("Virtual machine created.")
+    stdout, stderr = vm_out.communicate()
+    invalidate_vm_info(hostname)
+
+    if vm_out.returncode:
+        raise RuntimeError('Unable to clone ' + hostname + ': ' +
+                           stdout.decode().strip() + '\n')
+
+    subprocess.call(["vboxmanage", "modifyvm", hostname,
+                     "--memory", str(config['vm']['ram']),
+                     "--cpus", str(config['vm']['cpu'])])
+    subprocess.call(["vboxmanage", "guestproperty", "set", hostname,
+                     HOSTNAME_PROPERTY, hostname])
+    invalidate_vm_info(hostname)
+
+    __logger.info("Virtual machine " + hostname + " cloned.")
 
 
 def create_vm_shell(avium):
@@ -145,6 +389,7 @@ def create_vm_shell(avium):
                               stderr=subprocess.STDOUT)
 
     stdout, stderr = vm_out.communicate()
+    invalidate_vm_info(hostname)
 
     try:
         vbox_settings = re.split(':', re.search('Settings file.*vbox?',
@@ -182,6 +427,12 @@ def save_dhcp_record(avium):
 
         rec.close()
 
+        if host_info['vm'].get('hostonly_ipv4') is None:
+            __logger.warning("No host-only IPv4 address is recorded for " +
+                             config['vm']['hostname'] +
+                             ", its DHCP record is not saved.")
+            return
+
         # Filename format: <hostname>.yaml
         # Entry format: <hw:ma:ca:dd:re:ss>, <ipv.4ad.res.snn>, <hostname>
         sep_mac = ':'.join(host_info['vm']['hostonly_mac'][i:i + 2]
@@ -201,8 +452,9 @@ def save_dhcp_record(avium):
                       dhcp_path)
 
 
-def save_vm_record(avium):
-    # Saving a vm record is done on the host
+def save_vm_record(avium, hostonly_ipv4=None):
+    # Saving a vm record is done on the host, the address is only known
+    # once the guest reports it
     config = avium.get_config()
     # Get the hostonly inteface mac address
     hostonly_mac = __get_hostonly_mac_host(config['vm']['hostname'])
@@ -221,6 +473,8 @@ def save_vm_record(avium):
     record['vm']['dns_domain'] = config['vm']['dns_domain']
     record['vm']['hostonly_mac'] = hostonly_mac
     record['vm']['purpose'] = config['vm']['purpose']
+    if hostonly_ipv4 is not None:
+        record['vm']['hostonly_ipv4'] = hostonly_ipv4
 
     record_path = os.path.join(config['app']['fs']['wd_path'], r'db',
                                config['vm']['hostname'] + ".yaml")
@@ -256,65 +510,463 @@ def get_vbox_version():
     return tmp[0].strip()
 
 
-def get_vm_state(hostname):
+def get_vm_state(hostname, ttl=VM_INFO_TTL):
+    return get_vm_info(hostname, ttl).state
+
+
+def get_vm_info(hostname, ttl=VM_INFO_TTL):
+    """
+    Return the VMInfo of a VM, from the cache if it was read less than
+    ttl seconds ago, else from a new showvminfo call. Functions that
+    change a VM call invalidate_vm_info. A VM is cached once, by its
+    UUID, whether it is read by its name or its UUID.
+
+    :param hostname: the name or UUID of the VM
+    :param ttl: the age in seconds of a cached VMInfo that is still
+                served, 0 to always read it again
+    :return: the VMInfo
+    """
+    with __vm_info_lock:
+        info = __vm_infos.get(__vm_info_aliases.get(hostname))
+
+    if info is not None and time.monotonic() - info.read_at < ttl:
+        return info
+
     vm_out = subprocess.Popen(["vboxmanage", "showvminfo", hostname,
                                "--details", "--machinereadable"],
                               stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT)
+                              stderr=subprocess.PIPE)
 
     stdout, stderr = vm_out.communicate()
-    state_tmp = re.split('=', re.search('VMState=.*',
-                                        stdout.decode()).group(0))
 
-    state = state_tmp[1].strip('""')
+    if vm_out.returncode:
+        raise RuntimeError('Unable to read virtual machine ' + hostname +
+                           ': ' + stderr.decode().strip() + '\n')
 
-    return state
+    info = VMInfo(hostname, stdout.decode('utf-8', 'replace'))
+    uuid = info.get('UUID', hostname)
 
+    with __vm_info_lock:
+        __vm_infos[uuid] = info
+        # The VM is found again by the name it was read by, its own name
+        # and its UUID
+        for alias in (hostname, info.get('name'), uuid):
+            if alias is not None:
+                __vm_info_aliases[alias] = uuid
 
-def list_vms():
-    vm_out = subprocess.Popen(["vboxmanage", "list", "vms"],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT)
+    return info
 
-    stdout, stderr = vm_out.communicate()
 
-    tmp_list = stdout.decode().split("\n")
-    idx = 0
-    for vm in tmp_list:
-        if not vm:
-            tmp_list.pop(idx)
-        idx += 1
+def invalidate_vm_info(hostname=None):
+    """
+    Drop the cached VMInfo of a VM, by its name or UUID, or of every VM
+    if hostname is None, after a command changed it.
+    """
+    with __vm_info_lock:
+        if hostname is None:
+            __vm_infos.clear()
+            __vm_info_aliases.clear()
+        else:
+            uuid = __vm_info_aliases.get(hostname, hostname)
+            __vm_infos.pop(uuid, None)
+            for alias in [alias for alias, aliased in
+                          __vm_info_aliases.items() if aliased == uuid]:
+                del __vm_info_aliases[alias]
+
+
+class VMInfo:
+    """
+    The output of showvminfo --machinereadable for a VM, parsed once into
+    a dict of its keys and unquoted values. The settings a provisioning
+    flow reads are taken from it:
+
+    state the machine readable state, e.g. running or poweroff
+    nics a dict per enabled NIC with its index, attachment, mac, adapter,
+    type and whether its cable is connected
+    macs the MAC addresses of the enabled NICs
+    disks a dict per attached medium with its controller, port, device,
+    path and uuid
+    snapshots the names of the VM's snapshots
+
+    :param hostname: the name or UUID the VM was read by
+    :param output: the showvminfo output
+    """
+
+    def __init__(self, hostname, output):
+        self.hostname = hostname
+        self.fields = self.__parse(output)
+        self.read_at = time.monotonic()
+
+        self.state = self.fields.get('VMState')
+        self.nics = self.__nics()
+        self.macs = [nic['mac'] for nic in self.nics]
+        self.disks = self.__disks()
+        self.snapshots = [value for key, value in self.fields.items()
+                          if re.match(r'^SnapshotName(-\d+)*$', key)]
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    @staticmethod
+    def __parse(output):
+        fields = {}
+        pending = None
+
+        for line in output.splitlines():
+            if pending is not None:
+                # A quoted value continued on the next line
+                key, value = pending
+                value += '\n' + line
+            else:
+                match = VM_INFO_FIELD.match(line)
+                if match is None:
+                    continue
+                key, value = match.group(2), match.group(3)
+
+            if value.startswith('"') and \
+                    (len(value) < 2 or not value.endswith('"')):
+                pending = (key, value)
+                continue
+
+            pending = None
+            fields[key] = value[1:-1] if value.startswith('"') else value
+
+        return fields
+
+    def __nics(self):
+        nics = []
+
+        for key, attachment in self.fields.items():
+            match = re.match(r'^nic(\d+)$', key)
+            if match is None or 'none' == attachment:
+                continue
+            index = match.group(1)
+            adapter = next((self.fields[name + index] for name in
+                            ('hostonlyadapter', 'bridgeadapter', 'intnet',
+                             'natnet') if name + index in self.fields), None)
+            nics.append({'index': int(index), 'attachment': attachment,
+                         'mac': self.fields.get('macaddress' + index),
+                         'adapter': adapter,
+                         'type': self.fields.get('nictype' + index),
+                         'cable': 'on' == self.fields.get(
+                             'cableconnected' + index)})
+
+        return sorted(nics, key=lambda nic: nic['index'])
+
+    def __disks(self):
+        disks = []
+        controllers = [value for key, value in self.fields.items()
+                       if re.match(r'^storagecontrollername\d+$', key)]
+
+        for controller in controllers:
+            slot = re.compile('^' + re.escape(controller) +
+                              r'-(\d+)-(\d+)$')
+            for key, path in self.fields.items():
+                match = slot.match(key)
+                if match is None or path in ('none', 'emptydrive'):
+                    continue
+                port, device = match.groups()
+                disks.append({'controller': controller, 'port': int(port),
+                              'device': int(device), 'path': path,
+                              'uuid': self.fields.get(
+                                  controller + '-ImageUUID-' + port + '-' +
+                                  device)})
+
+        return disks
 
-    vm_list = []
 
-    idx = 0
-    for vm in tmp_list:
-        name = tmp_list[idx].split(' ')[0].strip('""')
-        name += ', ' + get_vm_state(name)
-        vm_list.append(name)
-        idx += 1
+def list_vms():
+    """
+    Print the name and state of every VM and return the inventory, see
+    vm_inventory.
+    """
+    vms = vm_inventory()
 
     print("VM Name,      State")
     print("===================")
-    for vm in vm_list:
-        print(vm)
+    for vm in vms:
+        print(vm['name'] + ', ' + vm['state'])
+
+    return vms
+
+
+def vm_inventory():
+    """
+    Return a record of every registered VM from a single
+    vboxmanage list -l vms call, parsed as it streams in rather than with
+    a showvminfo call per VM.
+
+    :return: a list of dicts, see parse_vm_list
+    """
+    vm_out = subprocess.Popen(["vboxmanage", "list", "-l", "vms"],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+
+    with vm_out:
+        vms = list(parse_vm_list(line.decode('utf-8', 'replace')
+                                 for line in vm_out.stdout))
+
+    if vm_out.returncode:
+        raise RuntimeError('vboxmanage list -l vms exited with status ' +
+                           str(vm_out.returncode) + '.\n')
+
+    return vms
 
 
-def start_vm(vm_name):
+def parse_vm_list(lines):
+    """
+    Parse the lines of vboxmanage list -l vms, or showvminfo, output and
+    yield a record per VM as soon as its last line has been read.
+
+    A record is a dict with the name, uuid, state, in the machine
+    readable form get_vm_state returns, memory in MB, cpus and nics, a
+    list of dicts with the index, mac and attachment of each enabled NIC,
+    and macs, the MAC addresses of the enabled NICs.
+
+    :param lines: an iterable of output lines
+    """
+    vm = None
+    usb_filters = False
+    previous = None
+
+    for line in lines:
+        match = VM_INFO_LINE.match(line.rstrip('\r\n'))
+        if match is None:
+            # Blank and indented lines, e.g. snapshots, hold no VM fields
+            continue
+        key, value = match.group(1), match.group(2).strip()
+
+        # USB device filters have a name too, it follows their Active line
+        if 'USB Device Filters' == key:
+            usb_filters = True
+        elif key not in USB_FILTER_FIELDS:
+            usb_filters = False
+        usb_filter = usb_filters and 'Active' == previous
+        previous = key
+
+        if 'Name' == key and not value.startswith("'") and not usb_filter:
+            # Every VM starts with its name, shared folders are listed as
+            # Name: 'share', Host path: ...
+            if vm is not None:
+                yield vm
+            vm = __vm_record(value)
+        elif vm is None:
+            continue
+        elif 'UUID' == key and vm['uuid'] is None:
+            vm['uuid'] = value
+        elif 'State' == key:
+            state = value.split(' (since ')[0].strip()
+            vm['state'] = VM_STATES.get(state, state.replace(' ', ''))
+        elif 'Memory size' == key:
+            vm['memory'] = int(re.sub(r'\D', '', value) or 0)
+        elif 'Number of CPUs' == key:
+            vm['cpus'] = int(value)
+        elif key.startswith('NIC ') and key[4:].isdigit() and \
+                value.startswith('MAC:'):
+            nic = __parse_nic(int(key[4:]), value)
+            vm['nics'].append(nic)
+            vm['macs'].append(nic['mac'])
+
+    if vm is not None:
+        yield vm
+
+
+def start_vm(vm_name, timeout=DEFAULT_STATE_TIMEOUT):
+    """
+    Start a VM headless and wait for it to run, see wait_for_state.
+
+    :return: the StateResult of the wait
+    """
     subprocess.call(["vboxmanage", "startvm", vm_name,
                      "--type", "headless"])
+    invalidate_vm_info(vm_name)
 
     # Check state
-    result = get_vm_state(vm_name)
-    while 'running' != result:
-        time.sleep(0.500)
-        result = get_vm_state(vm_name)
-        if 'stuck' == result:
-            __logger.error("Virtual machine, " + vm_name + " is in stuck \
-                           state. Review virtual machine to troubleshoot.")
-            sys.exit(3)
+    result = wait_for_state(vm_name, 'running', timeout)
+
+    if result.reached:
+        __logger.info("Virtual machine, " + vm_name + " is now..." +
+                      result.state)
+    else:
+        __logger.error(result.error + " Review virtual machine to "
+                       "troubleshoot.")
+
+    return result
+
+
+class StateResult:
+    """
+    The outcome of waiting for a VM to reach a state:
+
+    vm the name of the VM
+    wanted the states waited for
+    state the last state read, None if the VM could not be read
+    outcome reached, timeout or failed, when the VM entered one of
+    FAILED_STATES or could not be read
+    reached True if the outcome is reached
+    seconds how long the wait took
+    error what went wrong, None if the state was reached
+    """
+
+    def __init__(self, vm, wanted, state, outcome, seconds, error=None):
+        self.vm = vm
+        self.wanted = wanted
+        self.state = state
+        self.outcome = outcome
+        self.reached = 'reached' == outcome
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self):
+        return 'StateResult(' + self.vm + ', ' + self.outcome + ', ' + \
+            str(self.state) + ')'
+
+
+def wait_for_state(vm_name, states, timeout=DEFAULT_STATE_TIMEOUT,
+                   interval=STATE_POLL_INTERVAL,
+                   max_interval=STATE_POLL_MAX_INTERVAL):
+    """
+    Wait for a VM to reach one of several states. The state is polled
+    with an interval that doubles up to max_interval, so a VM that takes
+    long costs few vboxmanage calls. To wait for many VMs use wait_many.
+
+    :param vm_name: the name or UUID of the VM
+    :param states: a state, as returned by get_vm_state, or a list of
+                   states
+    :param timeout: the seconds to wait at most
+    :param interval: the seconds before the second poll
+    :param max_interval: the longest interval between polls
+    :return: a StateResult
+    """
+    wanted = __wanted_states(states)
+    start = time.monotonic()
+    deadline = start + timeout
+
+    while True:
+        try:
+            state = get_vm_state(vm_name, ttl=0)
+        except RuntimeError as err:
+            return StateResult(vm_name, wanted, None, 'failed',
+                               time.monotonic() - start, str(err).strip())
+
+        result = __state_result(vm_name, wanted, state, start, deadline)
+        if result is not None:
+            return result
+
+        time.sleep(max(0.0, min(interval, deadline - time.monotonic())))
+        interval = min(interval * 2, max_interval)
+
+
+async def wait_many(vm_names, states, timeout=DEFAULT_STATE_TIMEOUT,
+                    interval=STATE_POLL_INTERVAL,
+                    max_interval=STATE_POLL_MAX_INTERVAL):
+    """
+    Wait for many VMs to reach one of several states with one shared
+    poller. Every poll reads the state of all VMs with a single
+    vboxmanage list -l vms call, see vm_inventory, and backs off like
+    wait_for_state.
+
+    :param vm_names: the names or UUIDs of the VMs
+    :param states: a state or a list of states each VM is waited for
+    :param timeout: the seconds to wait at most
+    :param interval: the seconds before the second poll
+    :param max_interval: the longest interval between polls
+    :return: a StateResult per VM, in the order of vm_names
+    """
+    wanted = __wanted_states(states)
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    deadline = start + timeout
+    results = dict.fromkeys(vm_names)
+
+    while None in results.values():
+        try:
+            vms = await loop.run_in_executor(None, vm_inventory)
+        except (OSError, RuntimeError) as err:
+            for vm_name, result in results.items():
+                if result is None:
+                    results[vm_name] = StateResult(
+                        vm_name, wanted, None, 'failed',
+                        time.monotonic() - start, str(err).strip())
+            break
+
+        current = {}
+        for vm in vms:
+            current[vm['name']] = current[vm['uuid']] = vm['state']
+
+        for vm_name, result in results.items():
+            if result is not None:
+                continue
+            if vm_name not in current:
+                results[vm_name] = StateResult(
+                    vm_name, wanted, None, 'failed',
+                    time.monotonic() - start,
+                    'Virtual machine ' + vm_name + ' is not registered.')
+                continue
+            results[vm_name] = __state_result(vm_name, wanted,
+                                              current[vm_name], start,
+                                              deadline)
+
+        if None in results.values():
+            await asyncio.sleep(
+                max(0.0, min(interval, deadline - time.monotonic())))
+            interval = min(interval * 2, max_interval)
+
+    return list(results.values())
+
+
+def get_guest_property(vm_name, name):
+    """
+    Return the value of a guest property of a VM, or None if it is not
+    set.
+    """
+    vm_out = subprocess.run(["vboxmanage", "guestproperty", "get", vm_name,
+                             name],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+
+    match = re.search(r'^Value: (.*)$',
+                      vm_out.stdout.decode('utf-8', 'replace'), re.MULTILINE)
+
+    if vm_out.returncode or match is None:
+        return None
+
+    return match.group(1).strip()
+
+
+def wait_guest_property(vm_name, pattern='*', timeout=DEFAULT_STATE_TIMEOUT):
+    """
+    Block until a guest property of a running VM matching pattern
+    changes, e.g. /VirtualBox/GuestInfo/Net/* once the guest has an
+    address. vboxmanage guestproperty wait is notified by VirtualBox, so
+    nothing is polled. The guest needs the Guest Additions.
+
+    Only a change ends the wait, a property that is already set is not
+    reported, read it with get_guest_property first.
+
+    :param vm_name: the name or UUID of the VM
+    :param pattern: the property names to wait for, with * and ? wildcards
+    :param timeout: the seconds to wait at most
+    :return: a dict with the name, value and flags of the property, or
+             None if none changed before the timeout
+    """
+    try:
+        vm_out = subprocess.run(["vboxmanage", "guestproperty", "wait",
+                                 vm_name, pattern, "--timeout",
+                                 str(int(timeout * 1000))],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                timeout=timeout + 10)
+    except subprocess.TimeoutExpired:
+        return None
+
+    match = GUEST_PROPERTY.search(vm_out.stdout.decode('utf-8', 'replace'))
+
+    if vm_out.returncode or match is None:
+        return None
 
-    __logger.info("Virtual machine, " + vm_name + " is now..." + result)
+    return {'name': match.group('name'), 'value': match.group('value'),
+            'flags': match.group('flags') or ''}
 
 
 ##############################################################################
@@ -366,6 +1018,38 @@ def update_vm_record_ipv4_guest(avium):
         __logger.info("VM record updated.")
 
 
+def apply_clone_hostname():
+    """
+    Set the hostname of a clone of the golden image, run in the guest at
+    boot by the unit CLONE_HOSTNAME_SEAL installs. The host sets it as
+    the guest property HOSTNAME_PROPERTY, see clone_vm. This depends on
+    the Guest Additions.
+
+    :return: the hostname set, or None if it was already set or the
+             property is missing
+    """
+    vm_out = subprocess.Popen(["VBoxControl", "guestproperty", "get",
+                               HOSTNAME_PROPERTY],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+
+    stdout, stderr = vm_out.communicate()
+    match = re.search(r'^Value: (\S+)', stdout.decode(), re.MULTILINE)
+
+    if vm_out.returncode or match is None:
+        __logger.debug("No hostname is set for this clone.")
+        return None
+
+    hostname = match.group(1)
+    if hostname == socket.gethostname():
+        return None
+
+    subprocess.call(["hostnamectl", "set-hostname", hostname])
+    __logger.info("Hostname set to " + hostname + ".")
+
+    return hostname
+
+
 def install_vbox_guest_additions(avium):
     """
     Install VirtualBox Guest Additions.
@@ -410,6 +1094,16 @@ def install_vbox_guest_additions(avium):
 ##############################################################################
 
 
+def __check_ks_server(config, ks_server):
+    # Checked before the VM is created, an http mode VM without a
+    # kickstart server would boot an installer nothing answers
+    if config['iso']['required'] and ks_server is None and \
+            'http' == config['iso'].get('mode', 'remaster'):
+        raise RuntimeError('iso.mode http needs a kickstart server to '
+                           'register ' + config['vm']['hostname'] +
+                           ' with.\n')
+
+
 def __check_hostname(hostname):
     if 'random' == hostname:
         ran_name = 'tmp'
@@ -451,20 +1145,194 @@ def __get_hostonly_mac_guest():
 
 
 def __get_hostonly_mac_host(hostname):
+    return get_vm_info(hostname).get('macaddress1')
 
-    vm_out = subprocess.Popen(["vboxmanage", "showvminfo", hostname,
-                               "--machinereadable"],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT)
 
-    stdout, stderr = vm_out.communicate()
+def __create_vm(avium):
+    # Create VM Shell verifies hostname
+    vbox_home = create_vm_shell(avium)
+    config = avium.get_config()
+
+    __logger.info("Creating virtual machine...")
+    # Generate VirtualBox machine
+    subprocess.call(["vboxmanage", "modifyvm", config['vm']['hostname'],
+                     "--memory", str(config['vm']['ram']), "--vram",
+                     str(config['vm']['vram']), "--cpus",
+                     str(config['vm']['cpu']),
+                     "--defaultfrontend", config['vm']['frontend'],
+                     "--graphicscontroller", "vmsvga", "--nic1",
+                     config['vm']['nic1'], "--hostonlyadapter1",
+                     config['vm']['hostonlynet'], "--nic2",
+                     config['vm']['nic2'], "--boot1", "dvd", "--boot2", "disk",
+                     "--boot3", "net"])
+    invalidate_vm_info(config['vm']['hostname'])
+
+    # Create SATA controller
+    subprocess.call(["vboxmanage", "storagectl", config['vm']['hostname'],
+                    "--name", "SATA", "--add", "sata", "--bootable", "on"])
+
+    return vbox_home
+
+
+def __attach_media(avium, vbox_home, ks_server, disk_limit=None):
+    config = avium.get_config()
+
+    # Add disk(s)
+    disk_path = [None] * 2
+    disk_path[0] = os.path.join(vbox_home, r'disk1.vdi')
+    if 'managed' == config['vm']['node_type']:
+        disk_path[1] = os.path.join(vbox_home, r'disk2.vdi')
+
+    index = 0
+    for dp in disk_path:
+        if dp is None:
+            continue
+        with disk_limit or contextlib.nullcontext():
+            subprocess.call(["vboxmanage", "createmedium", "disk",
+                             "--filename", dp, "--size",
+                             str(config['vm']['hd_size']), "--variant",
+                             "Standard"])
+        subprocess.call(["vboxmanage", "storageattach",
+                         config['vm']['hostname'],
+                         "--storagectl", "SATA", "--port", str(index),
+                         "--type", "hdd", "--medium", dp])
+        index += 1
+
+    if config['iso']['required']:
+        mode = config['iso'].get('mode', 'remaster')
+        iso_key = {'seed': r'seed_iso', 'http': r'http_iso'}.get(
+            mode, r'custom_iso')
+
+        # Add iso path
+        if 'centos_7' == config['iso']['distro']:
+            iso_path = os.path.join(config['app']['fs']['wd_path'], r'iso',
+                                    config['centos_7'][iso_key])
+        elif 'centos_8' == config['iso']['distro']:
+            iso_path = os.path.join(config['app']['fs']['wd_path'], r'iso',
+                                    config['centos_8'][iso_key])
 
-    hi_raw = re.split('=', re.search('macaddress1=.*',
-                                     stdout.decode()).group(0))
+        # Attach iso installer
+        subprocess.call(["vboxmanage", "storageattach",
+                         config['vm']['hostname'], "--storagectl", "SATA",
+                         "--port", "2", "--type", "dvddrive",
+                         "--medium", iso_path])
 
-    hi_formatted = hi_raw[1].strip('""')
+        if 'seed' == mode:
+            # The per-VM files are on a seed iso kept with the VM
+            seed_path = isoutils.build_seed_iso(
+                avium, os.path.join(vbox_home, r'seed.iso'))
+
+            # Attach seed iso
+            subprocess.call(["vboxmanage", "storageattach",
+                             config['vm']['hostname'], "--storagectl",
+                             "SATA", "--port", "3", "--type", "dvddrive",
+                             "--medium", seed_path])
+        elif 'http' == mode:
+            # The per-VM files are served to the VM's host-only interface
+            ks_server.register(avium, mac=__get_hostonly_mac_host(
+                config['vm']['hostname']))
+
+    invalidate_vm_info(config['vm']['hostname'])
+
+
+def __provision_member(member, ks_server, disk_limit, start_limit, timeout,
+                       address_timeout):
+    # Runs on a fleet worker, so errors are returned rather than raised
+    config = member.get_config()
+    result = {'hostname': config['vm']['hostname'], 'state': None,
+              'stages': {}, 'seconds': 0.0, 'error': None}
+    start = time.monotonic()
+    stage = 'create'
 
-    return hi_formatted
+    try:
+        stage_start = time.monotonic()
+        if config['vm'].get('golden_image', {}).get('enabled', False):
+            stage = 'clone'
+            clone_vm(member)
+            result['hostname'] = config['vm']['hostname']
+            result['stages']['clone'] = time.monotonic() - stage_start
+        else:
+            __check_ks_server(config, ks_server)
+            vbox_home = __create_vm(member)
+            result['hostname'] = config['vm']['hostname']
+            result['stages']['create'] = time.monotonic() - stage_start
+
+            stage, stage_start = 'attach', time.monotonic()
+            __attach_media(member, vbox_home, ks_server, disk_limit)
+            result['stages']['attach'] = time.monotonic() - stage_start
+
+        stage, stage_start = 'start', time.monotonic()
+        with start_limit:
+            started = start_vm(config['vm']['hostname'], timeout)
+        result['state'] = started.state
+        result['stages']['start'] = time.monotonic() - stage_start
+        if not started.reached:
+            raise RuntimeError(started.error)
+
+        stage, stage_start = 'record', time.monotonic()
+        hostonly_ipv4 = None
+        if config['app']['dnsmasq']['enabled']:
+            # The DHCP record needs the address the guest reports. A wait
+            # only sees a change, so an address already reported is read,
+            # and read again should it arrive just before the wait.
+            hostonly_ipv4 = get_guest_property(config['vm']['hostname'],
+                                               HOSTONLY_IPV4_PROPERTY)
+            if hostonly_ipv4 is None:
+                found = wait_guest_property(config['vm']['hostname'],
+                                            HOSTONLY_IPV4_PROPERTY,
+                                            address_timeout)
+                hostonly_ipv4 = found['value'] if found is not None else \
+                    get_guest_property(config['vm']['hostname'],
+                                       HOSTONLY_IPV4_PROPERTY)
+        save_vm_record(member, hostonly_ipv4)
+        save_dhcp_record(member)
+        result['stages']['record'] = time.monotonic() - stage_start
+    except SystemExit as err:
+        result['error'] = stage + ' exited with status ' + str(err.code)
+    except Exception as err:
+        result['error'] = stage + ': ' + \
+            (str(err).strip() or type(err).__name__)
+
+    result['seconds'] = time.monotonic() - start
+
+    return result
+
+
+def __wanted_states(states):
+    return (states,) if isinstance(states, str) else tuple(states)
+
+
+def __state_result(vm_name, wanted, state, start, deadline):
+    # The StateResult once the wait is over, else None
+    now = time.monotonic()
+
+    if state in wanted:
+        return StateResult(vm_name, wanted, state, 'reached', now - start)
+    if state in FAILED_STATES:
+        return StateResult(vm_name, wanted, state, 'failed', now - start,
+                           'Virtual machine, ' + vm_name + ' is in ' +
+                           state + ' state.')
+    if now >= deadline:
+        return StateResult(vm_name, wanted, state, 'timeout', now - start,
+                           'Virtual machine, ' + vm_name + ' is still ' +
+                           state + ' after ' + str(round(now - start)) +
+                           ' s.')
+
+    return None
+
+
+def __vm_record(name):
+    return {'name': name, 'uuid': None, 'state': None, 'memory': None,
+            'cpus': None, 'nics': [], 'macs': []}
+
+
+def __parse_nic(index, value):
+    # MAC: 080027ABCDEF, Attachment: Host-only Interface 'vboxnet0', ...
+    fields = dict(field.split(': ', 1) for field in value.split(', ')
+                  if ': ' in field)
+
+    return {'index': index, 'mac': fields.get('MAC'),
+            'attachment': fields.get('Attachment')}
 
 
 def __mount_share(config):
@@ -487,3 +1355,6 @@ def __update_etc_fstab(config):
 
 
 __logger = logging.getLogger(__name__)
+__vm_infos = {}
+__vm_info_aliases = {}
+__vm_info_lock = threading.Lock()
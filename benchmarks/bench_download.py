@@ -0,0 +1,65 @@
+# Name: bench_download.py
+# Author: Michael Konrad,
+# Purpose: Compare the response iteration download loop with the large
+#          buffer download engine against a local HTTP stand-in
+# Date: 17-10-2026
+
+import argparse
+import os
+import tempfile
+import time
+
+import requests
+
+from avmutils import avmnetutils as netutils
+from tests.httpserver import StandInServer
+
+
+def iterate_response(file_name, url):
+    # The download loop used before the download engine
+    file_stream = requests.get(url, stream=True)
+
+    with open(file_name, 'wb') as local_file:
+        for data in file_stream:
+            local_file.write(data)
+
+
+def timed(func, *args):
+    start = time.monotonic()
+    func(*args)
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mib', type=int, default=512,
+                        help='size of the served file in MiB')
+    parser.add_argument('--chunk-mib', type=int, default=4,
+                        help='download engine buffer size in MiB')
+    args = parser.parse_args()
+
+    chunk_size = args.chunk_mib * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'bench.iso')
+        with open(source, 'wb') as data:
+            for _ in range(args.size_mib):
+                data.write(os.urandom(1024 * 1024))
+
+        target = os.path.join(tmp, 'out.iso')
+
+        with StandInServer(tmp) as server:
+            url = server.url('bench.iso')
+
+            iterated = timed(iterate_response, target, url)
+            engine = timed(netutils.dlf, target, url, chunk_size)
+
+    print("File size:          {0} MiB".format(args.size_mib))
+    print("Response iteration: {0:.2f} s, {1:.1f} MiB/s".format(
+        iterated, args.size_mib / iterated))
+    print("Download engine:    {0:.2f} s, {1:.1f} MiB/s".format(
+        engine, args.size_mib / engine))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Name: bench_render.py
+# Author: Michael Konrad,
+# Purpose: Compare sequential re.sub passes with the single pass template
+#          engine when rendering a large kickstart template for many VMs
+# Date: 17-10-2026
+
+import argparse
+import os
+import re
+import time
+
+import yaml
+
+from avmutils import avmtplutils as tplutils
+
+
+def sequential(template, replacements):
+    # The rendering loop used before the template engine
+    for key, value in replacements:
+        template = re.sub(key, value, template)
+    return template
+
+
+def single_pass(template, replacements):
+    return tplutils.render(template, replacements)[0]
+
+
+def timed(func, templates):
+    start = time.monotonic()
+    for template, replacements in templates:
+        func(template, replacements)
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=20000,
+                        help='lines in the kickstart template')
+    parser.add_argument('--vms', type=int, default=200,
+                        help='number of VMs to render the template for')
+    args = parser.parse_args()
+
+    config_path = os.path.join(os.path.dirname(__file__), os.pardir,
+                               r'tests', r'config.yaml')
+    with open(config_path) as config_file:
+        kickstart = yaml.safe_load(config_file)['kickstart']
+
+    keys = [kickstart['username_key'], kickstart['fullname_key'],
+            kickstart['disk_use_key'], kickstart['disk_part_key'],
+            kickstart['disk_add_key'], kickstart['package_key']]
+    line = '# %post step {0} for template_username on the {1} disk\n'
+    body = ''.join(line.format(index, keys[index % len(keys)])
+                   for index in range(args.lines))
+
+    templates = []
+    for vm in range(args.vms):
+        values = ['user' + str(vm), 'User ' + str(vm),
+                  kickstart['disk_use_value'], kickstart['disk_part_value'],
+                  kickstart['disk_add_value'], kickstart['package_managed']]
+        templates.append((body, list(zip(keys, values))))
+
+    assert sequential(*templates[0]) == single_pass(*templates[0])
+
+    before = timed(sequential, templates)
+    after = timed(single_pass, templates)
+
+    print("Template:           {0} lines, {1} KiB".format(
+        args.lines, len(body) // 1024))
+    print("VMs:                {0}".format(args.vms))
+    print("Sequential re.sub:  {0:.2f} s".format(before))
+    print("Single pass engine: {0:.2f} s".format(after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Name: bench_vm_list.py
+# Author: Michael Konrad,
+# Purpose: Compare listing VMs with a showvminfo call per VM with the
+#          single vboxmanage list -l vms inventory against a stand-in
+#          vboxmanage
+# Date: 17-10-2026
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from avmutils import avmvmutils as vmutils
+from tests import fakevbox
+
+
+def fan_out():
+    # The listing used before the inventory query, a showvminfo per VM
+    vm_out = subprocess.Popen(["vboxmanage", "list", "vms"],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+    stdout, stderr = vm_out.communicate()
+
+    return [(name, vmutils.get_vm_state(name)) for name in
+            [line.split(' ')[0].strip('"')
+             for line in stdout.decode().split('\n') if line]]
+
+
+def inventory():
+    return [(vm['name'], vm['state']) for vm in vmutils.vm_inventory()]
+
+
+def timed(func):
+    start = time.monotonic()
+    result = func()
+    return time.monotonic() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vms', type=int, default=200,
+                        help='number of VMs the stand-in reports')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as wd:
+        fakevbox.install(wd, args.vms)
+        os.environ['PATH'] = wd + os.pathsep + os.environ['PATH']
+
+        before, listed = timed(fan_out)
+        after, records = timed(inventory)
+
+    assert listed == records
+
+    print("VMs:                {0}".format(args.vms))
+    print("showvminfo per VM:  {0:.2f} s".format(before))
+    print("Bulk inventory:     {0:.2f} s".format(after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Name: conftest.py
+# Author: Michael Konrad,
+# Purpose: Shared test fixtures
+# Date: 17-10-2026
+
+import hashlib
+import os
+import pytest
+
+from avmutils import avmnetutils
+
+
+@pytest.fixture(autouse=True)
+def digest_cache(tmp_path, monkeypatch):
+    # Keep the persistent digest cache of each test in its tmp directory
+    path = str(tmp_path / 'digests.yaml')
+    monkeypatch.setattr(avmnetutils, '__digest_cache', path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def mirror_cache(tmp_path, monkeypatch):
+    # Keep the persistent mirror rankings of each test in its tmp directory
+    path = str(tmp_path / 'mirrors.yaml')
+    monkeypatch.setattr(avmnetutils, '__mirror_cache', path)
+    return path
+
+
+class StandInMirror:
+    """
+    The directory a stand-in mirror serves, path, and the directory its
+    files are downloaded to, dest.
+    """
+
+    def __init__(self, tmp_path):
+        self.path = tmp_path / 'mirror'
+        self.dest = tmp_path / 'dest'
+        self.path.mkdir()
+        self.dest.mkdir()
+
+    def add(self, name='test.iso', size=0, payload=None):
+        """
+        Add a file of size random bytes, or payload, to the mirror and
+        return its content and sha256 digest.
+        """
+        payload = os.urandom(size) if payload is None else payload
+        (self.path / name).write_bytes(payload)
+        return payload, hashlib.sha256(payload).hexdigest()
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    # A stand-in mirror directory and a download directory in tmp_path
+    return StandInMirror(tmp_path)
+
+
+class FakeAvium:
+
+    def __init__(self, conf_home, config):
+        self.conf_home = conf_home
+        self.config = config
+
+    def get_conf_home(self):
+        return self.conf_home
+
+    def get_config(self):
+        return self.config
+
+
+@pytest.fixture
+def avium(tmp_path):
+    # An avium application with a kickstart template, a runner and a
+    # public key in tmp_path
+    local = tmp_path / 'local'
+    local.mkdir()
+    (local / 'ks.cfg').write_text('user template_username\n')
+    (local / 'runner.py').write_text('print("first")\n')
+    (tmp_path / 'avium.pub').write_text('ssh-ed25519 AAAA avium\n')
+    config = {'app': {'avmutils': {'wheel_name': 'avmutils.whl'},
+                      'fs': {'wd_path': str(tmp_path)}},
+              'iso': {'distro': 'centos_7', 'mode': 'remaster',
+                      'seed_label': 'AVIUMSEED'},
+              'isolinux': {},
+              'centos_7': {'kickstart': 'ks.cfg'},
+              'vm': {'node_type': 'none', 'hostname': 'avium01'},
+              'virtualbox': {'enabled': False},
+              'user': {'username': 'avium', 'fullname': 'Avium',
+                       'public_key': str(tmp_path / 'avium.pub')},
+              'kickstart': {'username_key': 'template_username',
+                            'fullname_key': 'template_fullname',
+                            'disk_use_key': 'only-use', 'disk_use_value': '',
+                            'disk_part_key': 'clearpart',
+                            'disk_part_value': '', 'disk_add_key': 'disk',
+                            'disk_add_value': '', 'package_key': 'yum',
+                            'package_none': '',
+                            'asset_url_key': 'template_asset_url'}}
+    return FakeAvium(str(tmp_path), config)
@@ -0,0 +1,301 @@
+# Name: fakevbox.py
+# Author: Michael Konrad,
+# Purpose: A stand-in vboxmanage executable that reports a number of
+#          generated VMs
+# Date: 17-10-2026
+
+import os
+import stat
+import sys
+
+# The stand-in, written out with the number of VMs it reports. VM i is
+# named vm0000i, every third VM is powered off and the others run. When
+# FAKE_VBOX_LOG is set every call's arguments are appended to that file.
+# When FAKE_VBOX_STATE is set it names a JSON file with the states and
+# guest properties of VMs, by name, that replace the generated ones.
+# createvm and clonevm then register a VM, powered off, snapshot take
+# adds a snapshot and startvm sets the state of a VM to running in it.
+# guestproperty set sets a guest property of a VM in it, guestproperty
+# wait only reports a property that changes while it waits.
+# storageattach records the medium of a SATA port, a snapshot keeps the
+# media of its VM and a clone starts with those of its snapshot.
+# createvm fails for names starting with bad.
+SCRIPT = r'''#!{python}
+import fcntl
+import fnmatch
+import json
+import os
+import sys
+import time
+import uuid
+
+COUNT = {count}
+HUMAN_STATES = {{'poweroff': 'powered off',
+                'gurumeditation': 'guru meditation'}}
+
+
+def load_state():
+    try:
+        with open(os.environ['FAKE_VBOX_STATE']) as state_file:
+            return json.load(state_file)
+    except (KeyError, OSError, ValueError):
+        return {{}}
+
+
+def update_state(change):
+    # Several calls may run at once, each changes the file under a lock
+    with open(os.environ['FAKE_VBOX_STATE'] + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_state()
+        change(state)
+        # Readers do not lock, so the file is replaced rather than written
+        with open(os.environ['FAKE_VBOX_STATE'] + '.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(os.environ['FAKE_VBOX_STATE'] + '.tmp',
+                   os.environ['FAKE_VBOX_STATE'])
+
+
+def vm(index, name=None):
+    name = name or 'vm{{0:05d}}'.format(index)
+    return {{'name': name,
+            'uuid': str(uuid.uuid5(uuid.NAMESPACE_DNS, name)),
+            'state': STATES.get(name, 'poweroff' if index % 3 == 0
+                                else 'running'),
+            'memory': 1024 * (1 + index % 4),
+            'cpus': 1 + index % 2,
+            'macs': ['080027{{0:06X}}'.format(2 * index),
+                     '080027{{0:06X}}'.format(2 * index + 1)]}}
+
+
+def long_info(info):
+    state = HUMAN_STATES.get(info['state'], info['state']) + \
+        ' (since 2026-10-17T08:00:00.000000000)'
+    return '\n'.join([
+        'Name:                        ' + info['name'],
+        'Groups:                      /',
+        'Guest OS:                    Red Hat (64-bit)',
+        'UUID:                        ' + info['uuid'],
+        'Config file:                 /vms/' + info['name'] + '.vbox',
+        'Hardware UUID:               ' + info['uuid'],
+        'Memory size                  ' + str(info['memory']) + 'MB',
+        'Number of CPUs:              ' + str(info['cpus']),
+        'State:                       ' + state,
+        '',
+        'NIC 1:                       MAC: ' + info['macs'][0] +
+        ', Attachment: NAT, Cable connected: on, Trace: off (file: none)',
+        'NIC 2:                       MAC: ' + info['macs'][1] +
+        ", Attachment: Host-only Interface 'vboxnet0', Cable connected: on",
+        'NIC 3:                       disabled',
+        '',
+        'USB Device Filters:',
+        '',
+        'Index:                       0',
+        'Active:                      yes',
+        'Name:                        Smart card reader',
+        'VendorId:                    076b',
+        'ProductId:                   3021',
+        'Revision:                    ',
+        'Manufacturer:                ',
+        'Product:                     ',
+        'Remote:                      0',
+        'Serial Number:               ',
+        '',
+        'Bandwidth groups:            <none>',
+        '',
+        'Shared folders:',
+        '',
+        "Name: 'share', Host path: '/srv/share' (machine mapping), writable",
+        '',
+        'Snapshots:',
+        '',
+        '   Name: base (UUID: ' + info['uuid'] + ') *',
+        '', ''])
+
+
+def machine_info(info):
+    media = {{'SATA-0-0': '/vms/' + info['name'] + '/disk1.vdi',
+              'SATA-1-0': 'none', 'SATA-2-0': 'emptydrive'}}
+    media.update(load_state().get('media', {{}}).get(info['name'], {{}}))
+    return '\n'.join([
+        'name="' + info['name'] + '"',
+        'UUID="' + info['uuid'] + '"',
+        'memory=' + str(info['memory']),
+        'cpus=' + str(info['cpus']),
+        'VMState="' + info['state'] + '"',
+        'description="first line',
+        'second line"',
+        'storagecontrollername0="SATA"'] +
+        ['"' + slot + '"="' + media[slot] + '"' for slot in sorted(media)] +
+        ['"SATA-ImageUUID-0-0"="' + info['uuid'][::-1] + '"',
+        'nic1="nat"',
+        'nictype1="82540EM"',
+        'macaddress1="' + info['macs'][0] + '"',
+        'cableconnected1="on"',
+        'nic2="hostonly"',
+        'nictype2="virtio"',
+        'hostonlyadapter2="vboxnet0"',
+        'macaddress2="' + info['macs'][1] + '"',
+        'cableconnected2="on"',
+        'nic3="none"'] +
+        ['SnapshotName' + '-1' * index + '="' + snapshot + '"'
+         for index, snapshot in enumerate(
+             load_state().get('snapshots', {{}}).get(info['name'], []))] +
+        [''])
+
+
+args = sys.argv[1:]
+STATES = load_state().get('states', {{}})
+vms = [vm(index) for index in range(COUNT)] + \
+    [vm(COUNT + index, name) for index, name in
+     enumerate(load_state().get('created', []))]
+
+if os.environ.get('FAKE_VBOX_LOG'):
+    with open(os.environ['FAKE_VBOX_LOG'], 'a') as log:
+        log.write(' '.join(args) + '\n')
+
+if ['--version'] == args:
+    sys.stdout.write('7.0.10r158379\n')
+elif ['list', 'vms'] == args:
+    for info in vms:
+        sys.stdout.write('"' + info['name'] + '" {{' + info['uuid'] + '}}\n')
+elif ['list', '-l', 'vms'] == args:
+    for info in vms:
+        sys.stdout.write(long_info(info))
+elif args[:1] == ['createvm'] and os.environ.get('FAKE_VBOX_STATE'):
+    name = args[args.index('--name') + 1]
+    if name.startswith('bad'):
+        sys.stdout.write('VBoxManage: error: Could not create ' + name +
+                         '\n')
+        sys.exit(1)
+    update_state(lambda state: (
+        state.setdefault('created', []).append(name),
+        state.setdefault('states', {{}}).update({{name: 'poweroff'}})))
+    sys.stdout.write("Virtual machine '" + name + "' is created and "
+                     "registered.\nSettings file: '/vms/" + name + '/' +
+                     name + ".vbox'\n")
+elif args[:1] == ['clonevm'] and os.environ.get('FAKE_VBOX_STATE'):
+    name = args[args.index('--name') + 1]
+    snapshot = args[args.index('--snapshot') + 1]
+    if snapshot not in load_state().get('snapshots', {{}}).get(args[1], []):
+        sys.stdout.write('VBoxManage: error: Could not find a snapshot '
+                         'named ' + snapshot + '\n')
+        sys.exit(1)
+    update_state(lambda state: (
+        state.setdefault('created', []).append(name),
+        state.setdefault('states', {{}}).update({{name: 'poweroff'}}),
+        state.setdefault('media', {{}}).update({{name: dict(
+            state.get('snapshot_media', {{}}).get(args[1], {{}}).get(
+                snapshot, {{}}))}})))
+elif args[:1] == ['snapshot'] and args[2:3] == ['take']:
+    update_state(lambda state: (
+        state.setdefault('snapshots', {{}}).setdefault(
+            args[1], []).append(args[3]),
+        state.setdefault('snapshot_media', {{}}).setdefault(
+            args[1], {{}}).update({{args[3]: dict(
+                state.get('media', {{}}).get(args[1], {{}}))}})))
+elif args[:1] == ['storageattach'] and os.environ.get('FAKE_VBOX_STATE'):
+    slot = 'SATA-' + args[args.index('--port') + 1] + '-' + (
+        args[args.index('--device') + 1] if '--device' in args else '0')
+    update_state(lambda state: state.setdefault('media', {{}}).setdefault(
+        args[1], {{}}).update({{slot: args[args.index('--medium') + 1]}}))
+elif args[:1] == ['startvm'] and os.environ.get('FAKE_VBOX_STATE'):
+    update_state(lambda state: state.setdefault('states', {{}}).update(
+        {{args[1]: 'running'}}))
+elif args[:1] in (['modifyvm'], ['storagectl'], ['createmedium'],
+                  ['storageattach']):
+    pass
+elif args[:2] == ['guestproperty', 'set'] and \
+        os.environ.get('FAKE_VBOX_STATE'):
+    update_state(lambda state: state.setdefault('properties', {{}}).setdefault(
+        args[2], {{}}).update({{args[3]: args[4]}}))
+elif args[:2] == ['guestproperty', 'get']:
+    value = load_state().get('properties', {{}}).get(args[2], {{}}).get(
+        args[3])
+    sys.stdout.write('No value set!\n' if value is None else
+                     'Value: ' + value + '\n')
+elif args[:2] == ['guestproperty', 'wait']:
+    # Like VirtualBox, only a property that changes once the wait has
+    # started ends it
+    deadline = time.monotonic() + int(args[args.index('--timeout') + 1]) / \
+        1000.0
+    before = load_state().get('properties', {{}}).get(args[2], {{}})
+    while time.monotonic() < deadline:
+        properties = load_state().get('properties', {{}}).get(args[2], {{}})
+        found = sorted(name for name in properties
+                       if fnmatch.fnmatch(name, args[3]) and
+                       properties[name] != before.get(name))
+        if found:
+            sys.stdout.write('Name: ' + found[0] + ', value: ' +
+                             properties[found[0]] + ', flags: \n')
+            sys.exit(0)
+        time.sleep(0.05)
+    sys.stdout.write('Time out or interruption while waiting for a '
+                     'notification.\n')
+    sys.exit(1)
+elif args and 'showvminfo' == args[0]:
+    found = [info for info in vms if args[1] in (info['name'], info['uuid'])]
+    if not found:
+        sys.stderr.write('VBoxManage: error: Could not find a registered '
+                         'machine named ' + args[1] + '\n')
+        sys.exit(1)
+    if '--machinereadable' in args:
+        sys.stdout.write(machine_info(found[0]))
+    else:
+        sys.stdout.write(long_info(found[0]))
+else:
+    sys.exit(2)
+'''
+
+
+def install(directory, count):
+    """
+    Write a vboxmanage stand-in reporting count VMs to directory and
+    return its path. It runs in place of vboxmanage once directory is put
+    first on the PATH.
+    """
+    path = os.path.join(str(directory), 'vboxmanage')
+
+    with open(path, 'w') as script:
+        script.write(SCRIPT.format(python=sys.executable, count=count))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+    return path
+
+
+# The guest's side of a VM, written out with its name: a VBoxControl
+# stand-in that gets the guest properties the host set for that VM in
+# FAKE_VBOX_STATE, and a hostnamectl stand-in. Both append their
+# arguments to FAKE_VBOX_LOG, after their own name.
+GUEST_SCRIPT = r'''#!{python}
+import json
+import os
+import sys
+
+args = sys.argv[1:]
+if os.environ.get('FAKE_VBOX_LOG'):
+    with open(os.environ['FAKE_VBOX_LOG'], 'a') as log:
+        log.write(' '.join([os.path.basename(sys.argv[0])] + args) + '\n')
+
+if os.path.basename(sys.argv[0]) == 'VBoxControl' and \
+        args[:2] == ['guestproperty', 'get']:
+    with open(os.environ['FAKE_VBOX_STATE']) as state_file:
+        value = json.load(state_file).get('properties', {{}}).get(
+            {name!r}, {{}}).get(args[2])
+    if value is None:
+        sys.stdout.write('No value set!\n')
+        sys.exit(1)
+    sys.stdout.write('Value: ' + value + '\n')
+'''
+
+
+def install_guest(directory, name):
+    """
+    Write the VBoxControl and hostnamectl stand-ins of the guest of the
+    VM name to directory, which is put first on the PATH in its place.
+    """
+    for command in ('VBoxControl', 'hostnamectl'):
+        path = os.path.join(str(directory), command)
+        with open(path, 'w') as script:
+            script.write(GUEST_SCRIPT.format(python=sys.executable,
+                                             name=name))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
@@ -0,0 +1,179 @@
+# Name: httpserver.py
+# Author: Michael Konrad,
+# Purpose: A local HTTP stand-in for the download mirrors used in tests
+#          and benchmarks
+# Date: 17-10-2026
+
+import gzip
+import os
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_HEAD(self):
+        self.__send(head_only=True)
+
+    def do_GET(self):
+        self.__send(head_only=False)
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send(self, head_only):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+        time.sleep(self.server.latency)
+        path = os.path.join(self.server.root, self.path.lstrip('/'))
+
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        if self.server.gzip and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            self.__send_gzip(path, head_only)
+            return
+
+        size = os.path.getsize(path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        etag = '"{0}-{1}"'.format(size, mtime_ns)
+        last_modified = formatdate(mtime_ns // 10 ** 9, usegmt=True)
+        start, end = self.__requested_range(size, etag)
+
+        if self.__not_modified(etag, last_modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return
+
+        if start is None:
+            self.send_response(200)
+            start, end = 0, size - 1
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {0}-{1}/{2}'.format(start, end, size))
+
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if not head_only:
+            with open(path, 'rb') as data:
+                data.seek(start)
+                self.__write_body(data, end - start + 1)
+
+    def __send_gzip(self, path, head_only):
+        # The whole file, compressed, ranges are not applied to it
+        with open(path, 'rb') as data:
+            body = gzip.compress(data.read())
+
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if not head_only:
+            self.wfile.write(body)
+
+    def __not_modified(self, etag, last_modified):
+        # If-None-Match takes precedence over If-Modified-Since
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return if_none_match == etag
+
+        return self.headers.get('If-Modified-Since') == last_modified
+
+    def __requested_range(self, size, etag):
+        # Only a single "bytes=<start>-[<end>]" range is supported
+        requested = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range')
+
+        if not self.server.ranges or not requested.startswith('bytes='):
+            return None, None
+        if if_range is not None and if_range != etag:
+            return None, None
+
+        first, last = requested[len('bytes='):].split('-', 1)
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+        return start, end
+
+    def __write_body(self, data, length):
+        remaining = length
+        if self.server.fail_after is not None:
+            # Simulate a dropped connection part way through the body
+            remaining = min(remaining, self.server.fail_after)
+            self.close_connection = True
+
+        while remaining > 0:
+            block = data.read(min(remaining, 64 * 1024))
+            if not block:
+                break
+            if self.server.rate is not None:
+                time.sleep(len(block) / self.server.rate)
+            self.wfile.write(block)
+            remaining -= len(block)
+
+
+class StandInServer:
+    """
+    A threaded HTTP server that serves the files of a local directory on
+    an ephemeral port of the loopback interface.
+
+    :param root: the directory to serve
+    :param ranges: set to False to ignore Range requests
+    :param fail_after: close every response after this many body bytes
+    :param latency: seconds to wait before answering each request
+    :param rate: throttle every response to this many bytes per second
+    :param gzip: compress the response for clients that accept gzip
+    """
+
+    def __init__(self, root, ranges=True, fail_after=None, latency=0.0,
+                 rate=None, gzip=False):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.root = root
+        self.httpd.ranges = ranges
+        self.httpd.fail_after = fail_after
+        self.httpd.latency = latency
+        self.httpd.rate = rate
+        self.httpd.gzip = gzip
+        self.httpd.connections = 0
+        self.httpd.requests = []
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    def url(self, name=''):
+        host, port = self.httpd.server_address
+        return 'http://{0}:{1}/{2}'.format(host, port, name)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
@@ -0,0 +1,72 @@
+# Name: test_avmcacheutils.py
+# Author: Michael Konrad,
+# Purpose: A set of methods to test the content addressed file cache
+# Date: 17-10-2026
+
+import hashlib
+import os
+
+from avmutils import avmcacheutils as cacheutils
+
+
+def test_store_and_materialize(tmp_path):
+    # Store a verified file, materialize it into another directory and
+    # assert the cache recognizes the materialized file without hashing
+    payload = os.urandom(4096)
+    digest = hashlib.sha256(payload).hexdigest()
+    source = tmp_path / 'test.iso'
+    target = tmp_path / 'target.iso'
+    source.write_bytes(payload)
+
+    cache = cacheutils.ContentCache(str(tmp_path / 'cache'), 1024 * 1024)
+    cache.store(str(source), 'http://mirror/test.iso', digest)
+    cache.materialize(cache.lookup(digest), str(target))
+
+    assert target.read_bytes() == payload
+    assert cache.lookup(hashlib.sha256(b'other').hexdigest()) is None
+
+
+def test_lru_eviction(tmp_path):
+    # Fill the cache past its budget and assert the least recently used
+    # file is evicted while a recently looked up file is kept
+    cache = cacheutils.ContentCache(str(tmp_path / 'cache'), 10 * 1024)
+    digests = []
+
+    for index in range(3):
+        payload = os.urandom(4096)
+        digests.append(hashlib.sha256(payload).hexdigest())
+        source = tmp_path / ('file' + str(index))
+        source.write_bytes(payload)
+        cache.store(str(source), 'http://mirror/' + str(index),
+                    digests[index])
+        os.utime(cache.object_path(digests[index]), (index, index))
+        if index == 1:
+            # Use the first file so the second becomes the oldest
+            cache.lookup(digests[0])
+
+    assert cache.lookup(digests[0]) is not None
+    assert cache.lookup(digests[1]) is None
+    assert cache.lookup(digests[2]) is not None
+    assert cache.size() <= 10 * 1024
+
+
+def test_store_leaves_source(tmp_path):
+    # Assert storing hard links the caller's file into the cache without
+    # changing it, not even its modification time once it is looked up,
+    # and that a file larger than the budget is kept until the next store
+    payload = os.urandom(8192)
+    digest = hashlib.sha256(payload).hexdigest()
+    source = tmp_path / 'test.iso'
+    source.write_bytes(payload)
+    os.chmod(str(source), 0o0600)
+    os.utime(str(source), (1, 1))
+
+    cache = cacheutils.ContentCache(str(tmp_path / 'cache'), 4096)
+    obj = cache.store(str(source), 'http://mirror/test.iso', digest)
+
+    assert os.path.samefile(str(source), obj)
+    assert cache.contains(str(source), digest)
+    assert os.stat(str(source)).st_mode & 0o0777 == 0o0600
+    assert cache.lookup(digest) == obj
+    assert os.stat(str(source)).st_mtime == 1
+    assert open(obj, 'rb').read() == payload
@@ -0,0 +1,319 @@
+# Name: test_avmisoutils.py
+# Author: Michael Konrad,
+# Purpose: A set of methods to test the iso customization methods
+# Date: 17-10-2026
+
+import os
+import pycdlib
+import pytest
+import tracemalloc
+
+from io import BytesIO
+
+from avmutils import avmisoutils as isoutils
+from avmutils import avmvmutils as vmutils
+from tests.httpserver import StandInServer
+
+
+def __make_mirror(tmp_path):
+    # A mirror directory with a minimal base iso and its checksum file
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    base = pycdlib.PyCdlib()
+    base.new(interchange_level=3, rock_ridge='1.09')
+    base.add_directory('/ISOLINUX', rr_name='isolinux')
+    isolinux = b'timeout 600\nlabel linux\n  menu default\n'
+    base.add_fp(BytesIO(isolinux), len(isolinux),
+                '/ISOLINUX/ISOLINUX.CFG;1', rr_name='isolinux.cfg')
+    base.write(str(mirror / 'base.iso'))
+    base.close()
+    (mirror / 'sha256sum.txt').write_text(
+        isoutils.netutils.file_digest(str(mirror / 'base.iso')) +
+        '  base.iso\n')
+    return mirror
+
+
+def __configure_build(tmp_path, config):
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'dl').mkdir()
+    config['app']['download'] = {
+        'digest_cache': str(tmp_path / 'digests.yaml'),
+        'mirror_cache': str(tmp_path / 'mirrors.yaml')}
+    config['iso']['local_path'] = str(tmp_path / 'out')
+    config['isolinux'] = {'timeout_key': 'timeout 600',
+                          'timeout_value': 'timeout 20',
+                          'menu_key': 'menu default',
+                          'menu_value': '#menu default',
+                          'label_key': 'label linux',
+                          'label_7_value': 'label kickstart'}
+
+
+def test_add_avmutils_streams_payload(tmp_path, monkeypatch):
+    # Add a binary wheel to a new iso, assert it is read back byte for
+    # byte and that it never has to fit in memory while the iso is built
+    wheel_dir = tmp_path / 'avmutils'
+    wheel_dir.mkdir()
+    payload = os.urandom(8 * 1024 * 1024)
+    (wheel_dir / 'avmutils.whl').write_bytes(payload)
+    config = {'app': {'avmutils': {'wheel_name': 'avmutils.whl'},
+                      'fs': {'wd_path': str(tmp_path)}}}
+    monkeypatch.chdir(tmp_path)
+
+    iso = pycdlib.PyCdlib()
+    iso.new(rock_ridge='1.09')
+    iso.add_directory('/LOCAL', rr_name='local')
+
+    tracemalloc.start()
+    getattr(isoutils, '__add_avmutils')(config, iso)
+    iso.write(str(tmp_path / 'custom.iso'))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    iso.close()
+
+    assert peak < len(payload) // 2
+
+    iso.open(str(tmp_path / 'custom.iso'))
+    extracted = BytesIO()
+    iso.get_file_from_iso_fp(extracted, iso_path='/LOCAL/AVMUTILS.WHL;1')
+    iso.close()
+
+    assert extracted.getvalue() == payload
+
+
+def test_build_key(tmp_path, avium):
+    # Assert the build key is stable for unchanged inputs and changes
+    # with the base iso, the rendered kickstart and the runner
+    config = avium.get_config()
+    local = tmp_path / 'local'
+    base_iso = tmp_path / 'base.iso'
+    base_iso.write_bytes(b'base')
+
+    key = isoutils.build_key(avium, str(base_iso))
+    assert key == isoutils.build_key(avium, str(base_iso))
+
+    config['user']['username'] = 'other'
+    renamed = isoutils.build_key(avium, str(base_iso))
+    assert renamed != key
+
+    (local / 'runner.py').write_text('print("second")\n')
+    assert isoutils.build_key(avium, str(base_iso)) not in (key, renamed)
+
+    base_iso.write_bytes(b'rebased')
+    os.utime(str(base_iso), ns=(1, 1))
+    assert isoutils.build_key(avium, str(base_iso)) not in (key, renamed)
+
+
+def test_isolinux_without_ks_location(tmp_path, avium):
+    # Assert seed and http modes refuse a label value they cannot point
+    # at their kickstart file
+    config = avium.get_config()
+    __configure_build(tmp_path, config)
+    config['app']['ks_server'] = {'host': '192.168.56.1', 'port': 8080}
+    replacements = getattr(isoutils, '__isolinux_replacements')
+
+    for mode in ('seed', 'http'):
+        config['iso']['mode'] = mode
+        with pytest.raises(RuntimeError, match='inst.ks'):
+            replacements(config)
+
+
+def test_render_kickstart_seal(tmp_path, avium):
+    # Assert the seal commands, and the unit that applies each clone's
+    # hostname, are only rendered into the kickstart file of the golden
+    # image
+    config = avium.get_config()
+    config['kickstart'].update({'seal_key': 'template_seal',
+                                'seal_value': 'truncate -s 0 '
+                                              '/etc/machine-id'})
+    (tmp_path / 'local' / 'ks.cfg').write_text('%post\ntemplate_seal\n')
+
+    assert isoutils.render_kickstart(avium) == '%post\n\n'
+
+    config['vm']['golden_image'] = {'enabled': True}
+    rendered = isoutils.render_kickstart(avium)
+    assert rendered.startswith('%post\ntruncate -s 0 /etc/machine-id\n')
+    assert 'avmvmutils.apply_clone_hostname()' in rendered
+    assert rendered.endswith('systemctl enable ' +
+                             vmutils.CLONE_HOSTNAME_UNIT + '\n')
+
+
+def test_build_seed_iso(tmp_path, avium):
+    # Build a seed iso, assert it is labeled for the installer, holds the
+    # rendered kickstart and per-VM files and is only a few KB, and that
+    # per-VM changes leave the seed mode build key alone
+    config = avium.get_config()
+    config['iso']['mode'] = 'seed'
+    base_iso = tmp_path / 'base.iso'
+    base_iso.write_bytes(b'base')
+    seed_path = str(tmp_path / 'seed.iso')
+
+    key = isoutils.build_key(avium, str(base_iso))
+    assert isoutils.build_seed_iso(avium, seed_path) == seed_path
+    assert os.path.getsize(seed_path) < 512 * 1024
+
+    iso = pycdlib.PyCdlib()
+    iso.open(seed_path)
+    assert iso.pvd.volume_identifier.decode().strip() == 'AVIUMSEED'
+    kickstart = BytesIO()
+    iso.get_file_from_iso_fp(kickstart, iso_path='/KS.CFG;1')
+    pubkey = BytesIO()
+    iso.get_file_from_iso_fp(pubkey, iso_path='/LOCAL/PUBKEY.PUB;1')
+    iso.close()
+
+    assert kickstart.getvalue() == b'user avium\n'
+    assert pubkey.getvalue() == b'ssh-ed25519 AAAA avium\n'
+
+    config['user']['username'] = 'other'
+    (tmp_path / 'local' / 'runner.py').write_text('print("second")\n')
+    assert isoutils.build_key(avium, str(base_iso)) == key
+
+
+def test_build_many(tmp_path, avium):
+    # Build two variants of one distro from a stand-in mirror in build
+    # processes, assert the distribution iso is downloaded once and an
+    # unsupported distro is reported instead of exiting
+    mirror = __make_mirror(tmp_path)
+
+    config = avium.get_config()
+    __configure_build(tmp_path, config)
+    config['kickstart']['package_admin'] = 'ipa-server'
+    config['kickstart']['package_managed'] = 'docker-ce'
+
+    with StandInServer(str(mirror)) as server:
+        config['centos_7'].update({'iso_url': server.url(''),
+                                   'iso_file': 'base.iso',
+                                   'checksum_file': 'sha256sum.txt',
+                                   'local_path': str(tmp_path / 'dl')})
+        results = isoutils.build_many(
+            avium, [('centos_7', 'admin'),
+                    ('centos_7', 'managed', {'user': {'username': 'other'}}),
+                    ('centos_9', 'admin')], workers=2)
+        requests = server.httpd.requests
+
+    assert [result['error'] is None for result in results] == \
+        [True, True, False]
+    assert 'centos_9' in results[2]['error']
+    assert results[0]['path'].endswith('centos7_ks_admin.iso')
+    assert all(result['seconds'] > 0 and 'write' in result['stages']
+               for result in results[:2])
+    assert len([path for command, path in requests
+                if path.endswith('base.iso')]) == 1
+
+    iso = pycdlib.PyCdlib()
+    iso.open(results[1]['path'])
+    kickstart = BytesIO()
+    iso.get_file_from_iso_fp(kickstart, iso_path='/KS.CFG;1')
+    iso.close()
+
+    assert kickstart.getvalue() == b'user other\n'
+    assert config['user']['username'] == 'avium'
+
+
+def test_build_pipeline(tmp_path, avium):
+    # Build from a slow stand-in mirror, assert every stage is timed and
+    # the patched iso holds the rendered files
+    mirror = __make_mirror(tmp_path)
+    config = avium.get_config()
+    __configure_build(tmp_path, config)
+    timings = {}
+
+    with StandInServer(str(mirror), latency=0.3) as server:
+        config['centos_7'].update({'iso_url': server.url(''),
+                                   'iso_file': 'base.iso',
+                                   'checksum_file': 'sha256sum.txt',
+                                   'local_path': str(tmp_path / 'dl')})
+        custom_path = isoutils.build_custom_centos_iso(avium,
+                                                       timings=timings)
+
+    assert custom_path.endswith('centos7_ks.iso')
+    assert {'download_distro', 'prepare', 'open', 'key', 'vbox_guest',
+            'write', 'total'} == set(timings)
+    assert timings['download_distro'] >= 0.3
+
+    iso = pycdlib.PyCdlib()
+    iso.open(custom_path)
+    kickstart = BytesIO()
+    iso.get_file_from_iso_fp(kickstart, iso_path='/KS.CFG;1')
+    isolinux = BytesIO()
+    iso.get_file_from_iso_fp(isolinux, iso_path='/ISOLINUX/ISOLINUX.CFG;1')
+    iso.close()
+
+    assert kickstart.getvalue() == b'user avium\n'
+    assert isolinux.getvalue().startswith(b'timeout 20\nlabel kickstart\n')
+
+
+def test_build_pipeline_error(tmp_path, avium):
+    # Fail the build while the distribution iso downloads and assert the
+    # download has finished by the time the error is raised
+    mirror = __make_mirror(tmp_path)
+    config = avium.get_config()
+    __configure_build(tmp_path, config)
+    config['iso']['mode'] = 'seed'
+
+    with StandInServer(str(mirror), latency=0.3) as server:
+        config['centos_7'].update({'iso_url': server.url(''),
+                                   'iso_file': 'base.iso',
+                                   'checksum_file': 'sha256sum.txt',
+                                   'local_path': str(tmp_path / 'dl')})
+        with pytest.raises(RuntimeError, match='inst.ks'):
+            isoutils.build_custom_centos_iso(avium)
+
+        assert (tmp_path / 'dl' / 'base.iso').read_bytes() == \
+            (mirror / 'base.iso').read_bytes()
+
+
+def test_rebuild_reuses_build(tmp_path, avium):
+    # Build the custom iso twice from the same inputs and assert the
+    # second build writes nothing, the iso is the cached build itself
+    mirror = __make_mirror(tmp_path)
+    config = avium.get_config()
+    __configure_build(tmp_path, config)
+    config['app']['build_cache'] = {'enabled': True, 'max_size_mb': 64,
+                                    'path': str(tmp_path / 'builds')}
+    first, second = {}, {}
+
+    custom_path = isoutils.build_custom_centos_iso(
+        avium, iso_path=str(mirror / 'base.iso'), timings=first)
+    built = os.stat(custom_path)
+    assert isoutils.build_custom_centos_iso(
+        avium, iso_path=str(mirror / 'base.iso'),
+        timings=second) == custom_path
+    rebuilt = os.stat(custom_path)
+
+    assert 'write' in first and 'write' not in second
+    assert (rebuilt.st_ino, rebuilt.st_mtime_ns) == \
+        (built.st_ino, built.st_mtime_ns)
+
+
+def test_build_cache_budget(tmp_path, avium):
+    # Build three variants into a build cache with room for two and
+    # assert the least recently used build is evicted and built again
+    mirror = __make_mirror(tmp_path)
+    config = avium.get_config()
+    __configure_build(tmp_path, config)
+    config['app']['build_cache'] = {'enabled': True, 'max_size_mb': 64,
+                                    'path': str(tmp_path / 'builds')}
+    paths = []
+
+    for index, username in enumerate(('first', 'second', 'third')):
+        config['user']['username'] = username
+        paths.append(isoutils.build_custom_centos_iso(
+            avium, iso_path=str(mirror / 'base.iso'),
+            custom_iso=username + '.iso'))
+        os.utime(paths[index], (index, index))
+        if index == 0:
+            config['app']['build_cache']['max_size_mb'] = \
+                2.5 * os.path.getsize(paths[0]) / 1024 / 1024
+
+    cached = [path for path in (tmp_path / 'builds' / 'objects').rglob('*')
+              if path.is_file() and path.suffix != '.yaml']
+
+    assert len(cached) == 2
+    assert not [path for path in cached
+                if os.path.samefile(str(path), paths[0])]
+
+    timings = {}
+    config['user']['username'] = 'first'
+    isoutils.build_custom_centos_iso(avium, iso_path=str(mirror / 'base.iso'),
+                                     custom_iso='first.iso', timings=timings)
+    assert 'write' in timings
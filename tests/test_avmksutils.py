@@ -0,0 +1,65 @@
+# Name: test_avmksutils.py
+# Author: Michael Konrad,
+# Purpose: A set of methods to test the kickstart server
+# Date: 17-10-2026
+
+import os
+import requests
+
+from avmutils import avmksutils as ksutils
+
+MAC = {'X-RHN-Provisioning-MAC-0': 'eth0 08:00:27:ab:cd:ef'}
+
+
+def test_kickstart_server(tmp_path, avium):
+    # Register a VM by its VirtualBox MAC, fetch its rendered kickstart
+    # file and wheel as anaconda would and assert unknown VMs get nothing
+    wheel_dir = tmp_path / 'avmutils'
+    wheel_dir.mkdir()
+    wheel = os.urandom(3 * 1024 * 1024 + 7)
+    (wheel_dir / 'avmutils.whl').write_bytes(wheel)
+    (tmp_path / 'local' / 'ks.cfg').write_text(
+        'user template_username\nurl template_asset_url/runner.py\n')
+
+    with ksutils.KickstartServer('127.0.0.1') as server:
+        server.register(avium, mac='080027ABCDEF')
+
+        ks = requests.get(server.url('ks.cfg'), headers=MAC)
+        assert ks.status_code == 200
+        assert ks.text == 'user avium\nurl ' + server.url('local') + \
+            '/runner.py\n'
+
+        whl = requests.get(server.url('local/avmutils.whl'), headers=MAC)
+        assert whl.content == wheel
+
+        assert requests.get(server.url('local/missing'),
+                            headers=MAC).status_code == 404
+        assert requests.get(server.url('ks.cfg')).status_code == 404
+
+        server.register(avium, ip='127.0.0.1')
+        assert requests.get(server.url('local/runner.py')).text == \
+            'print("first")\n'
+
+
+def test_kickstart_server_cache(tmp_path, avium):
+    # Assert a rendered kickstart file is served from the cache until the
+    # VM is registered again or its template changes, and that it renders
+    # the configuration the VM was registered with
+    config = avium.get_config()
+    template = tmp_path / 'local' / 'ks.cfg'
+
+    with ksutils.KickstartServer('127.0.0.1') as server:
+        server.register(avium, mac='08:00:27:ab:cd:ef')
+        url = server.url('ks.cfg')
+        assert requests.get(url, headers=MAC).text == 'user avium\n'
+
+        config['user']['username'] = 'cached'
+        assert requests.get(url, headers=MAC).text == 'user avium\n'
+
+        template.write_text('login template_username\n')
+        os.utime(str(template), ns=(1, 1))
+        assert requests.get(url, headers=MAC).text == 'login avium\n'
+
+        config['user']['username'] = 'registered'
+        server.register(avium, mac='08:00:27:ab:cd:ef')
+        assert requests.get(url, headers=MAC).text == 'login registered\n'
@@ -3,9 +3,19 @@
 # Purpose: A set of methods to test the utility methods
 # Date: 02-10-2021
 
+import asyncio
+import hashlib
 import os
+import pytest
+import subprocess
+import sys
+import time
+import tracemalloc
+import yaml
 
+from avmutils import avmcacheutils as cacheutils
 from avmutils import avmnetutils as lentils
+from tests.httpserver import StandInServer
 
 
 def test_download_file():
@@ -36,3 +46,422 @@ def test_verify_hash():
 
     assert lentils.verify_hash(loc, vbox_guest_iso, vbox_guest_sha,
                                hash_ver)
+
+
+def test_download_file_stand_in(mirror):
+    # Download a file larger than the read buffer from a local stand-in
+    # mirror and assert it arrives intact with its throughput reported
+    payload = mirror.add(size=3 * 1024 * 1024 + 17)[0]
+
+    with StandInServer(str(mirror.path)) as server:
+        stats = lentils.download_file(str(mirror.dest),
+                                      server.url('test.iso'),
+                                      chunk_size=1024 * 1024)
+
+    assert (mirror.dest / 'test.iso').read_bytes() == payload
+    assert stats['bytes'] == len(payload)
+    assert stats['throughput'] > 0
+
+
+def test_download_file_identity(mirror):
+    # Download a compressible file from a mirror that gzips responses for
+    # clients that accept it, with a read buffer smaller than the file,
+    # and assert it is requested and written byte for byte
+    payload = mirror.add(payload=b'avium' * (512 * 1024))[0]
+
+    with StandInServer(str(mirror.path), gzip=True) as server:
+        stats = lentils.download_file(str(mirror.dest),
+                                      server.url('test.iso'),
+                                      chunk_size=64 * 1024)
+
+    assert (mirror.dest / 'test.iso').read_bytes() == payload
+    assert stats['bytes'] == len(payload)
+
+
+def test_download_file_checksum(mirror):
+    # Verify a download against a checksum manifest while it streams and
+    # assert a download with the wrong digest is removed
+    dest = mirror.dest
+    payload, digest = mirror.add(size=1024 * 1024 + 5)
+    (mirror.path / 'SHA256SUMS').write_text(digest + ' *test.iso\n')
+
+    with StandInServer(str(mirror.path)) as server:
+        stats = lentils.download_file(str(dest), server.url('test.iso'),
+                                      checksum_url=server.url('SHA256SUMS'))
+        assert stats['digest'] == digest
+
+        with pytest.raises(RuntimeError):
+            lentils.download_file(str(dest), server.url('test.iso'),
+                                  overwrite=True, digest='0' * 64)
+
+    # The rejected download never replaces the verified file
+    assert (dest / 'test.iso').read_bytes() == payload
+    assert not (dest / 'test.iso.part').exists()
+
+
+def test_download_file_resume(mirror):
+    # Interrupt a download part way through, assert only the .part file
+    # is left behind, then resume it with a Range request
+    dest = mirror.dest
+    payload, digest = mirror.add(size=2 * 1024 * 1024)
+
+    with StandInServer(str(mirror.path), fail_after=1024 * 1024) as server:
+        with pytest.raises(RuntimeError):
+            lentils.download_file(str(dest), server.url('test.iso'))
+
+        assert not (dest / 'test.iso').exists()
+        assert (dest / 'test.iso.part').exists()
+
+        server.httpd.fail_after = None
+        stats = lentils.download_file(str(dest), server.url('test.iso'),
+                                      digest=digest)
+
+    assert stats['bytes'] == len(payload) - 1024 * 1024
+    assert (dest / 'test.iso').read_bytes() == payload
+    assert not (dest / 'test.iso.part').exists()
+    assert not (dest / 'test.iso.part.yaml').exists()
+
+
+def test_download_file_segmented(mirror, monkeypatch):
+    # Download a file in segments through a server that drops every
+    # response part way, relying on per-segment retries, without a second
+    # pass over the file for the digest, then assert a server without
+    # Range support falls back to a single stream
+    dest = mirror.dest
+    payload, digest = mirror.add(size=2 * 1024 * 1024 + 3)
+    monkeypatch.setattr(lentils, 'MIN_SEGMENT_SIZE', 256 * 1024)
+    hash_file = getattr(lentils, '__hash_file_multi')
+
+    with StandInServer(str(mirror.path), fail_after=200 * 1024) as server:
+        monkeypatch.setattr(lentils, '__hash_file_multi', None)
+        stats = lentils.download_file(str(dest), server.url('test.iso'),
+                                      digest=digest, segments=4, retries=3)
+        monkeypatch.setattr(lentils, '__hash_file_multi', hash_file)
+
+    assert stats['digest'] == digest
+    assert (dest / 'test.iso').read_bytes() == payload
+
+    with StandInServer(str(mirror.path), ranges=False) as server:
+        stats = lentils.download_file(str(dest), server.url('test.iso'),
+                                      overwrite=True, segments=4)
+
+    assert stats['digest'] == digest
+    assert (dest / 'test.iso').read_bytes() == payload
+
+
+def test_download_file_ignored_range(mirror):
+    # Assert the range probe of a server that ignores ranges does not read
+    # the whole file into memory before the single stream fallback
+    mirror.add(size=32 * 1024 * 1024)
+
+    with StandInServer(str(mirror.path), ranges=False) as server:
+        tracemalloc.start()
+        try:
+            lentils.download_file(str(mirror.dest), server.url('test.iso'),
+                                  segments=4)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    assert peak < 16 * 1024 * 1024
+    assert (mirror.dest / 'test.iso').stat().st_size == 32 * 1024 * 1024
+
+
+def test_session_reuses_connections(mirror):
+    # Assert consecutive downloads from one host share a keep-alive
+    # connection of the pooled session
+    mirror.add(size=64 * 1024)
+    mirror.add('SHA256SUMS', size=64)
+    lentils.configure_session(pool_size=2, retries=1)
+
+    with StandInServer(str(mirror.path)) as server:
+        lentils.download_file(str(mirror.dest), server.url('test.iso'))
+        lentils.download_file(str(mirror.dest), server.url('SHA256SUMS'))
+        connections = server.httpd.connections
+
+    assert connections == 1
+
+
+def test_download_file_cache(tmp_path, mirror):
+    # Download a verified file through the cache, then assert a second
+    # working directory is served from the cache with the mirror gone
+    centos_8 = tmp_path / 'centos_8'
+    centos_8.mkdir()
+    payload, digest = mirror.add(size=256 * 1024)
+    cache = cacheutils.ContentCache(str(tmp_path / 'cache'), 1024 * 1024)
+
+    with StandInServer(str(mirror.path)) as server:
+        url = server.url('test.iso')
+        assert lentils.download_file(str(mirror.dest), url, digest=digest,
+                                     cache=cache) is not None
+
+    assert lentils.download_file(str(centos_8), url, digest=digest,
+                                 cache=cache) is None
+    assert (centos_8 / 'test.iso').read_bytes() == payload
+
+
+def test_download_file_revalidate(mirror):
+    # Assert an unchanged file is revalidated with a 304 and a changed
+    # file on the mirror is downloaded again
+    dest = mirror.dest
+    mirror.add('plug.vim', payload=b'first')
+
+    with StandInServer(str(mirror.path)) as server:
+        url = server.url('plug.vim')
+        stats = lentils.download_file(str(dest), url, revalidate=True)
+        assert stats['etag']
+        assert (dest / 'plug.vim.http.yaml').exists()
+
+        assert lentils.download_file(str(dest), url, revalidate=True) is None
+
+        mirror.add('plug.vim', payload=b'second')
+        os.utime(str(mirror.path / 'plug.vim'), ns=(1, 1))
+        stats = lentils.download_file(str(dest), url, revalidate=True)
+
+    assert stats['bytes'] == len(b'second')
+    assert (dest / 'plug.vim').read_bytes() == b'second'
+
+
+def test_rank_mirrors(tmp_path, mirror):
+    # Rank a fast, a throttled, a slow to answer and a broken stand-in
+    # mirror and assert the ranking is reused until it expires
+    mirror.add(size=512 * 1024)
+
+    with StandInServer(str(mirror.path)) as fast, \
+            StandInServer(str(mirror.path), rate=1024 * 1024) as throttled, \
+            StandInServer(str(mirror.path), latency=0.3) as distant, \
+            StandInServer(str(tmp_path)) as broken:
+        urls = [broken.url('test.iso'), throttled.url('test.iso'),
+                distant.url('test.iso'), fast.url('test.iso')]
+        ranked = lentils.rank_mirrors(urls, sample_size=256 * 1024)
+
+        assert ranked == [fast.url('test.iso'), distant.url('test.iso'),
+                          throttled.url('test.iso'), broken.url('test.iso')]
+
+        connections = fast.httpd.connections
+        assert lentils.rank_mirrors(urls) == ranked
+        assert fast.httpd.connections == connections
+        assert lentils.rank_mirrors(urls, ttl=0) == ranked
+
+
+def test_download_file_failover(mirror):
+    # Drop the first mirror part way through a download and assert the
+    # next mirror resumes it rather than starting again
+    payload, digest = mirror.add(size=2 * 1024 * 1024)
+
+    with StandInServer(str(mirror.path),
+                       fail_after=1024 * 1024) as failing, \
+            StandInServer(str(mirror.path)) as backup:
+        stats = lentils.download_file(
+            str(mirror.dest), failing.url('test.iso'), digest=digest,
+            mirrors=[backup.url('test.iso')])
+
+    assert stats['url'] == backup.url('test.iso')
+    assert stats['bytes'] == len(payload) - 1024 * 1024
+    assert (mirror.dest / 'test.iso').read_bytes() == payload
+
+
+def test_download_file_manifest_failover(tmp_path, mirror):
+    # Assert the checksum manifest is taken from the next mirror when the
+    # first mirror does not serve it
+    primary = tmp_path / 'primary'
+    primary.mkdir()
+    payload, digest = mirror.add(size=64 * 1024)
+    (primary / 'test.iso').write_bytes(payload)
+    (mirror.path / 'SHA256SUMS').write_text(digest + '  test.iso\n')
+
+    with StandInServer(str(primary)) as first, \
+            StandInServer(str(mirror.path)) as second:
+        stats = lentils.download_file(
+            str(mirror.dest), first.url('test.iso'),
+            checksum_url=first.url('SHA256SUMS'),
+            mirrors=[second.url('test.iso')])
+
+    assert stats['url'] == first.url('test.iso')
+    assert stats['digest'] == digest
+    assert (mirror.dest / 'SHA256SUMS').is_file()
+
+
+def test_file_digest_cache(tmp_path, monkeypatch):
+    # Assert an unchanged file's digest comes from the digest cache, that
+    # changing the file invalidates it and that force hashes it again
+    iso = tmp_path / 'test.iso'
+    iso.write_bytes(b'first')
+    hashed = []
+    hash_file = getattr(lentils, '__hash_file_multi')
+
+    def counting_hash(path, hash_vers,
+                      chunk_size=lentils.DEFAULT_CHUNK_SIZE):
+        hashed.append(path)
+        return hash_file(path, hash_vers, chunk_size)
+
+    monkeypatch.setattr(lentils, '__hash_file_multi', counting_hash)
+
+    first = lentils.file_digest(str(iso))
+    assert lentils.file_digest(str(iso)) == first
+    assert len(hashed) == 1
+
+    lentils.file_digest(str(iso), force=True)
+    assert len(hashed) == 2
+
+    iso.write_bytes(b'second')
+    assert lentils.file_digest(str(iso)) == \
+        hashlib.sha256(b'second').hexdigest()
+    assert len(hashed) == 3
+
+
+def test_file_digest_cache_shared(tmp_path, digest_cache):
+    # Hash files from several processes at once, assert none of their
+    # digests is lost and that a deleted file's digest is pruned
+    paths = []
+    for index in range(6):
+        paths.append(str(tmp_path / ('file' + str(index))))
+        with open(paths[-1], 'wb') as hf:
+            hf.write(os.urandom(1024))
+    script = ('import sys\n'
+              'from avmutils import avmnetutils as lentils\n'
+              'lentils.configure_digest_cache(sys.argv[1])\n'
+              'for path in sys.argv[2:]:\n'
+              '    lentils.file_digest(path)\n')
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    workers = [subprocess.Popen([sys.executable, '-c', script, digest_cache] +
+                                paths[index::3], cwd=root)
+               for index in range(3)]
+    for worker in workers:
+        assert worker.wait(timeout=60) == 0
+
+    with open(digest_cache) as dc:
+        assert sorted(yaml.safe_load(dc)) == sorted(paths)
+
+    os.remove(paths[0])
+    lentils.file_digest(paths[1], force=True)
+    with open(digest_cache) as dc:
+        assert sorted(yaml.safe_load(dc)) == sorted(paths[1:])
+
+
+def test_file_digests(tmp_path):
+    # Compute several digests in one pass, including an empty file, and
+    # assert an md5 checksum file verifies
+    payload = os.urandom(3 * 1024 * 1024 + 1)
+    iso = tmp_path / 'test.iso'
+    empty = tmp_path / 'empty.iso'
+    iso.write_bytes(payload)
+    empty.write_bytes(b'')
+    hash_vers = ['md5', 'sha1', 'sha256', 'sha512', 'blake2b']
+
+    digests = lentils.file_digests(str(iso), hash_vers)
+    for hash_ver in hash_vers:
+        assert digests[hash_ver] == hashlib.new(hash_ver, payload).hexdigest()
+
+    assert lentils.file_digests(str(empty), ['sha256'])['sha256'] == \
+        hashlib.sha256(b'').hexdigest()
+
+    (tmp_path / 'MD5SUMS').write_text(digests['md5'] + ' test.iso\n')
+    assert lentils.verify_hash(str(tmp_path), 'test.iso', 'MD5SUMS', 'md5')
+
+
+def test_read_manifest(tmp_path):
+    # Parse both checksum line forms, match names containing regex
+    # characters exactly and assert a changed manifest is parsed again
+    sha = hashlib.sha256(b'iso').hexdigest()
+    other = hashlib.sha256(b'other').hexdigest()
+    manifest = tmp_path / 'CHECKSUM'
+    manifest.write_text('-----BEGIN PGP SIGNED MESSAGE-----\n'
+                        'Hash: SHA256\n\n'
+                        '# CentOS-8.4.2105-x86_64-boot.iso: 10 bytes\n'
+                        'SHA256 (CentOS-8.4.2105-x86_64-boot.iso) = ' +
+                        sha + '\n' + other + '  CentOS-8+extras.iso\n')
+
+    index = lentils.read_manifest(str(manifest))
+    assert index['CentOS-8.4.2105-x86_64-boot.iso'] == ('sha256', sha)
+    assert index['CentOS-8+extras.iso'] == ('sha256', other)
+    assert 'CentOS-8x4.2105-x86_64-boot.iso' not in index
+
+    manifest.write_text(sha + ' *renamed.iso\n')
+    os.utime(str(manifest), ns=(1, 1))
+    assert list(lentils.read_manifest(str(manifest))) == ['renamed.iso']
+
+
+def test_verify_many(tmp_path):
+    # Verify a good, a corrupt and a missing file concurrently on threads
+    # and processes without changing the working directory
+    cwd = os.getcwd()
+    good = tmp_path / 'good.iso'
+    bad = tmp_path / 'bad.iso'
+    good.write_bytes(b'good')
+    bad.write_bytes(b'corrupt')
+    manifest = tmp_path / 'SHA256SUMS'
+    manifest.write_text(hashlib.sha256(b'good').hexdigest() + '  good.iso\n' +
+                        hashlib.sha256(b'bad').hexdigest() + '  bad.iso\n')
+    jobs = [(str(good), str(manifest), 'sha256'),
+            (str(bad), str(manifest), 'sha256'),
+            (str(tmp_path / 'missing.iso'), str(manifest), 'sha256')]
+
+    for processes in (False, True):
+        results = lentils.verify_many(jobs, processes=processes)
+
+        assert [result['verified'] for result in results] == \
+            [True, False, False]
+        assert results[1]['error'] == 'checksum mismatch'
+        assert all(result['seconds'] >= 0 for result in results)
+
+    assert os.getcwd() == cwd
+
+
+def test_download_many(mirror):
+    # Download several files concurrently, watch the progress from
+    # another task and assert a missing file fails without stopping the
+    # others
+    dest = mirror.dest
+    payloads = {}
+    for index in range(3):
+        payloads['file' + str(index)] = mirror.add(
+            'file' + str(index), size=512 * 1024)[0]
+
+    with StandInServer(str(mirror.path)) as server:
+        jobs = [(server.url(name), str(dest)) for name in payloads]
+        jobs.append({'url': server.url('missing'), 'loc': str(dest)})
+        manager = lentils.DownloadManager(max_downloads=2, per_host=2)
+
+        async def watch_and_run():
+            watcher = asyncio.ensure_future(manager.wait_progress())
+            results = await manager.run(jobs)
+            return results, await watcher
+
+        results, snapshot = asyncio.run(watch_and_run())
+
+    assert [result['error'] is None for result in results] == \
+        [True, True, True, False]
+    assert manager.progress[server.url('file0')]['state'] == 'done'
+    assert manager.progress[server.url('missing')]['state'] == 'failed'
+    assert snapshot
+    for name, payload in payloads.items():
+        assert (dest / name).read_bytes() == payload
+
+
+def test_download_many_hosts(tmp_path):
+    # Saturate one host and assert a job on another host starts at once
+    # rather than waiting behind the jobs queued for the busy host
+    slow = tmp_path / 'slow'
+    fast = tmp_path / 'fast'
+    dest = tmp_path / 'dest'
+    for directory in (slow, fast, dest):
+        directory.mkdir()
+    for index in range(4):
+        (slow / ('slow' + str(index))).write_bytes(os.urandom(256 * 1024))
+    (fast / 'fast').write_bytes(os.urandom(1024))
+
+    with StandInServer(str(slow), rate=256 * 1024) as busy, \
+            StandInServer(str(fast)) as idle:
+        jobs = [(busy.url('slow' + str(index)), str(dest))
+                for index in range(4)]
+        jobs.append((idle.url('fast'), str(dest)))
+        start = time.time()
+        results = lentils.download_many(jobs, max_downloads=4, per_host=2)
+
+    assert all(result['error'] is None for result in results)
+    assert (dest / 'fast').stat().st_mtime - start < 0.5
+    assert max((dest / ('slow' + str(index))).stat().st_mtime
+               for index in range(4)) - start >= 1.5
@@ -0,0 +1,74 @@
+# Name: test_avmtplutils.py
+# Author: Michael Konrad,
+# Purpose: A set of methods to test the template rendering methods
+# Date: 17-10-2026
+
+import os
+import re
+import yaml
+
+from avmutils import avmtplutils as tplutils
+
+
+def test_render_matches_sequential_substitution():
+    # Render isolinux.cfg with the configured keys in one pass and assert
+    # it matches the sequential re.sub passes, escapes included
+    config_path = os.path.join(os.path.dirname(__file__), 'config.yaml')
+    with open(config_path) as config_file:
+        isolinux = yaml.safe_load(config_file)['isolinux']
+    template = ('default vesamenu.c32\ntimeout 600\n\nlabel linux\n'
+                '  menu label ^Install CentOS 7\n  menu default\n')
+    replacements = [(isolinux['timeout_key'], isolinux['timeout_value']),
+                    (isolinux['menu_key'], isolinux['menu_value']),
+                    (isolinux['label_key'], isolinux['label_7_value'])]
+
+    expected = template
+    for key, value in replacements:
+        expected = re.sub(key, value, expected)
+
+    rendered, matched = tplutils.render(template, replacements)
+
+    assert rendered == expected
+    assert 'CentOS\\x207' in rendered
+    assert matched == {'timeout 600': 1, 'menu default': 1, 'label linux': 1}
+
+
+def test_render_reports_and_caches():
+    # Assert keys are matched once per occurrence, in order of
+    # precedence, replaced text is not searched again and the compiled
+    # template is reused with other values
+    replacements = [('user_key', 'admin_key'), ('admin_key', 'root'),
+                    ('user_k', 'never'), ('missing', 'x')]
+
+    rendered, matched = tplutils.render('user_key admin_key user_key',
+                                        replacements)
+
+    assert rendered == 'admin_key root admin_key'
+    assert matched == {'user_key': 2, 'admin_key': 1, 'user_k': 0,
+                       'missing': 0}
+    keys = tuple(key for key, value in replacements)
+    template = tplutils.compile_template('user_key admin_key user_key', keys)
+    assert template is tplutils.compile_template(
+        'user_key admin_key user_key', keys)
+    assert template.render(['a', 'b', 'c', 'd']) == 'a b a'
+    assert tplutils.render('text', []) == ('text', {})
+
+
+def test_render_uncombinable_keys():
+    # Assert lookbehind keys, keys with inline flags or groups and values
+    # that refer to groups or the match render as sequential re.sub does
+    template = 'x=foo y=foo\nlabel linux\nlabel rescue\nmenu default\n'
+    replacements = [(r'(?<=x=)foo', 'bar'),
+                    (r'(?m)^menu default$', '#menu default'),
+                    (r'label (\w+)', r'label \1_ks'),
+                    (r'y=\w+', r'[\g<0>]')]
+
+    expected = template
+    for key, value in replacements:
+        expected = re.sub(key, value, expected)
+
+    rendered, matched = tplutils.render(template, replacements)
+
+    assert rendered == expected
+    assert matched == {r'(?<=x=)foo': 1, r'(?m)^menu default$': 1,
+                       r'label (\w+)': 2, r'y=\w+': 1}
@@ -0,0 +1,317 @@
+# Name: test_avmvmutils.py
+# Author: Michael Konrad,
+# Purpose: A set of methods to test the virtual machine methods
+# Date: 17-10-2026
+
+import asyncio
+import json
+import os
+import pytest
+import threading
+import time
+import yaml
+
+from avmutils import avmvmutils as vmutils
+from tests import fakevbox
+
+
+@pytest.fixture
+def fake_vbox(tmp_path, monkeypatch):
+    # Put a stand-in vboxmanage first on the PATH, see fakevbox. Called
+    # with the number of VMs it reports and, optionally, the state of
+    # VMs, it returns the log its calls are appended to.
+    def install(count=0, state=None):
+        fakevbox.install(tmp_path, count)
+        monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep +
+                           os.environ['PATH'])
+        monkeypatch.setenv('FAKE_VBOX_LOG', str(tmp_path / 'calls.log'))
+        if state is not None:
+            (tmp_path / 'state.json').write_text(json.dumps(state))
+            monkeypatch.setenv('FAKE_VBOX_STATE',
+                               str(tmp_path / 'state.json'))
+        vmutils.invalidate_vm_info()
+        return tmp_path / 'calls.log'
+
+    return install
+
+
+@pytest.fixture
+def vm_config(tmp_path, avium):
+    # The configuration of VMs created from the iso and recorded in
+    # tmp_path, without dnsmasq
+    (tmp_path / 'db').mkdir()
+    (tmp_path / 'vm_info.yaml').write_text('vm:\n  hostname: template\n')
+    config = avium.get_config()
+    config['app']['dnsmasq'] = {'enabled': False}
+    config['iso']['required'] = False
+    config['vm'].update({'record': 'vm_info.yaml', 'ostype': 'RedHat_64',
+                         'ram': 1024, 'vram': 16, 'cpu': 1,
+                         'hd_size': 1000, 'frontend': 'headless',
+                         'nic1': 'hostonly', 'nic2': 'nat',
+                         'hostonlynet': 'vboxnet0',
+                         'dns_domain': '.avium.test', 'purpose': 'lab'})
+    return config
+
+
+def test_vm_inventory(fake_vbox):
+    # List the VMs of a stand-in vboxmanage with one bulk call and assert
+    # every record matches what showvminfo reports for the VM and that
+    # the named USB device filter of each VM is not taken for a VM
+    fake_vbox(12)
+
+    vms = vmutils.vm_inventory()
+
+    assert [vm['name'] for vm in vms] == \
+        ['vm{0:05d}'.format(index) for index in range(12)]
+    for vm in vms[:4]:
+        assert vm['state'] == vmutils.get_vm_state(vm['name'])
+    assert vms[1] == {
+        'name': 'vm00001', 'uuid': vms[1]['uuid'], 'state': 'running',
+        'memory': 2048, 'cpus': 2,
+        'nics': [{'index': 1, 'mac': '080027000002', 'attachment': 'NAT'},
+                 {'index': 2, 'mac': '080027000003',
+                  'attachment': "Host-only Interface 'vboxnet0'"}],
+        'macs': ['080027000002', '080027000003']}
+    assert vms[0]['state'] == 'poweroff'
+    assert len(set(vm['uuid'] for vm in vms)) == 12
+
+
+def test_parse_vm_list_streams():
+    # Assert a VM is yielded as soon as the next one starts, without
+    # reading the rest of the output
+    def lines():
+        yield 'Name:            first\n'
+        yield 'UUID:            1\n'
+        yield 'State:           saved (since 2026-10-17)\n'
+        yield 'Name:            second\n'
+        raise AssertionError('read past the second VM')
+
+    vms = vmutils.parse_vm_list(lines())
+    first = next(vms)
+
+    assert (first['name'], first['uuid'], first['state']) == \
+        ('first', '1', 'saved')
+
+
+def test_vm_info_cache(fake_vbox):
+    # Read a VM twice within the TTL and after invalidating it, assert
+    # showvminfo runs once per read that is not served from the cache,
+    # whether the VM is read by name or UUID, and the state, NICs and
+    # disks are parsed from its output
+    log = fake_vbox(3)
+
+    info = vmutils.get_vm_info('vm00001')
+    assert vmutils.get_vm_state('vm00001') == 'running'
+    assert vmutils.get_vm_info('vm00001') is info
+    assert len(log.read_text().splitlines()) == 1
+
+    vmutils.invalidate_vm_info('vm00001')
+    assert vmutils.get_vm_info('vm00001') is not info
+    vmutils.get_vm_info('vm00001', ttl=0)
+    assert len(log.read_text().splitlines()) == 3
+
+    # Read by UUID it is the same cached VM, invalidated by its name
+    info = vmutils.get_vm_info('vm00001')
+    assert vmutils.get_vm_info(info.get('UUID')) is info
+    vmutils.invalidate_vm_info('vm00001')
+    assert vmutils.get_vm_info(info.get('UUID')) is not info
+    assert vmutils.get_vm_info('vm00001') is not info
+    assert len(log.read_text().splitlines()) == 4
+
+    assert info.macs == ['080027000002', '080027000003']
+    assert info.nics[1] == {'index': 2, 'attachment': 'hostonly',
+                            'mac': '080027000003', 'adapter': 'vboxnet0',
+                            'type': 'virtio', 'cable': True}
+    assert info.disks == [{'controller': 'SATA', 'port': 0, 'device': 0,
+                           'path': '/vms/vm00001/disk1.vdi',
+                           'uuid': info.get('UUID')[::-1]}]
+    assert info.get('description') == 'first line\nsecond line'
+    assert info.get('memory') == '2048'
+
+
+def test_wait_for_states(tmp_path, fake_vbox):
+    # Wait for VMs of a stand-in vboxmanage, assert a start is reached,
+    # a stuck VM fails without exiting, a wait times out after a few
+    # backed off polls and wait_many watches every VM with one call per
+    # poll
+    log = fake_vbox(6, {'states': {'vm00001': 'gurumeditation'},
+                        'properties': {'vm00002': {
+                            '/VirtualBox/GuestInfo/Net/0/V4/IP':
+                            '192.168.56.102'}}})
+    state = tmp_path / 'state.json'
+
+    started = vmutils.start_vm('vm00000')
+    assert (started.reached, started.state) == (True, 'running')
+
+    stuck = vmutils.wait_for_state('vm00001', 'running', timeout=5)
+    assert (stuck.outcome, stuck.state) == ('failed', 'gurumeditation')
+    assert 'gurumeditation' in stuck.error
+
+    log.write_text('')
+    waited = vmutils.wait_for_state('vm00004', ['poweroff', 'saved'],
+                                    timeout=1.0, interval=0.1)
+    assert (waited.outcome, waited.state) == ('timeout', 'running')
+    assert 0.9 < waited.seconds < 2.0
+    assert len(log.read_text().splitlines()) <= 5
+
+    log.write_text('')
+    results = asyncio.run(vmutils.wait_many(
+        ['vm00000', 'vm00001', 'vm00002', 'missing'], 'running',
+        timeout=5))
+    assert [result.outcome for result in results] == \
+        ['reached', 'failed', 'reached', 'failed']
+    assert log.read_text().splitlines() == ['list -l vms']
+
+    # A property already set is read, a wait only sees it change
+    assert vmutils.get_guest_property(
+        'vm00002', '/VirtualBox/GuestInfo/Net/0/V4/IP') == '192.168.56.102'
+    assert vmutils.get_guest_property('vm00003', '/Missing') is None
+    assert vmutils.wait_guest_property(
+        'vm00002', '/VirtualBox/GuestInfo/Net/*', timeout=0.3) is None
+
+    def change_address():
+        time.sleep(0.3)
+        changed = json.loads(state.read_text())
+        changed['properties']['vm00002'][
+            '/VirtualBox/GuestInfo/Net/0/V4/IP'] = '192.168.56.103'
+        (tmp_path / 'changed.json').write_text(json.dumps(changed))
+        os.replace(str(tmp_path / 'changed.json'), str(state))
+
+    changer = threading.Thread(target=change_address)
+    changer.start()
+    assert vmutils.wait_guest_property(
+        'vm00002', '/VirtualBox/GuestInfo/Net/*', timeout=5) == {
+            'name': '/VirtualBox/GuestInfo/Net/0/V4/IP',
+            'value': '192.168.56.103', 'flags': ''}
+    changer.join()
+    assert vmutils.wait_guest_property('vm00003', timeout=0.2) is None
+
+
+def test_create_vm_http_without_server(fake_vbox, avium):
+    # Assert an http mode VM is refused before anything is created when
+    # there is no kickstart server to register it with
+    log = fake_vbox()
+    config = avium.get_config()
+    config['iso'].update({'required': True, 'mode': 'http'})
+
+    with pytest.raises(RuntimeError, match='kickstart server'):
+        vmutils.create_vm(avium)
+
+    assert not log.exists()
+
+
+def test_provision_fleet(tmp_path, fake_vbox, vm_config, avium):
+    # Provision three VMs, one of which cannot be created, on a stand-in
+    # vboxmanage and assert the others run and are recorded with the
+    # timings of every stage while the failure is reported
+    fake_vbox(state={})
+    vm_config['app']['fleet'] = {'workers': 3, 'max_starts': 1}
+
+    results = vmutils.provision_fleet(avium, [
+        {'hostname': 'node01', 'node_type': 'managed'},
+        {'hostname': 'bad02'},
+        {'hostname': 'node03'}])
+
+    assert [result['hostname'] for result in results] == \
+        ['node01', 'bad02', 'node03']
+    assert [result['state'] for result in results] == \
+        ['running', None, 'running']
+    assert results[1]['error'].startswith('create')
+    for result in results[::2]:
+        assert result['error'] is None
+        assert set(result['stages']) == {'create', 'attach', 'start',
+                                         'record'}
+    with open(str(tmp_path / 'db' / 'node01.yaml')) as record:
+        assert yaml.safe_load(record)['vm']['hostonly_mac'] == \
+            vmutils.get_vm_info('node01').macs[0]
+    assert vm_config['vm']['hostname'] == 'avium01'
+
+
+def test_provision_fleet_dhcp(tmp_path, fake_vbox, vm_config, avium):
+    # Provision two VMs with dnsmasq enabled and assert the one whose
+    # guest reports its host-only address gets a DHCP record while the
+    # other is recorded without one
+    fake_vbox(state={'properties': {'node01': {
+        vmutils.HOSTONLY_IPV4_PROPERTY: '192.168.56.101'}}})
+    (tmp_path / 'dhcp').mkdir()
+    vm_config['app'].update({'dnsmasq': {'enabled': True},
+                             'fleet': {'address_timeout': 0.5}})
+
+    results = vmutils.provision_fleet(avium, [{'hostname': 'node01'},
+                                              {'hostname': 'node03'}])
+
+    assert [result['error'] for result in results] == [None, None]
+    mac = vmutils.get_vm_info('node01').macs[0]
+    assert (tmp_path / 'dhcp' / 'node01').read_text() == \
+        ':'.join(mac[i:i + 2] for i in range(0, 12, 2)) + \
+        ',192.168.56.101,node01'
+    assert not (tmp_path / 'dhcp' / 'node03').exists()
+    with open(str(tmp_path / 'db' / 'node03.yaml')) as record:
+        assert 'hostonly_ipv4' not in yaml.safe_load(record)['vm']
+
+
+def test_provision_fleet_golden_image(tmp_path, monkeypatch, fake_vbox,
+                                      vm_config, avium):
+    # Snapshot an installed golden image, provision two linked clones of
+    # it and assert each is cloned from the snapshot with new MACs, its
+    # hostname for the guest and no installer medium, started and
+    # recorded without being created from the iso, and that a clone's
+    # guest takes its hostname on first boot
+    log = fake_vbox(state={
+        'created': ['golden'], 'states': {'golden': 'poweroff'},
+        'media': {'golden': {'SATA-2-0': '/iso/centos7_ks.iso',
+                             'SATA-3-0': '/vms/golden/seed.iso'}}})
+    vm_config['vm']['golden_image'] = {'enabled': True, 'base_vm': 'golden',
+                                       'snapshot': 'base'}
+
+    assert vmutils.build_golden_image(avium)['created'] is True
+    assert vmutils.build_golden_image(avium)['created'] is False
+
+    results = vmutils.provision_fleet(avium, [{'hostname': 'clone01'},
+                                              {'hostname': 'clone02'}])
+
+    assert [result['error'] for result in results] == [None, None]
+    assert set(results[0]['stages']) == {'clone', 'start', 'record'}
+    calls = log.read_text().splitlines()
+    assert 'clonevm golden --snapshot base --options link --name clone01 ' \
+        '--register' in calls
+    assert not [call for call in calls if call.startswith('createvm')]
+    macs = [vmutils.get_vm_info(name).macs[0]
+            for name in ('golden', 'clone01', 'clone02')]
+    assert len(set(macs)) == 3
+    assert 'modifyvm golden --boot1 disk --boot2 none' in calls
+    for name in ('clone01', 'clone02'):
+        assert vmutils.get_guest_property(
+            name, vmutils.HOSTNAME_PROPERTY) == name
+    clone = vmutils.get_vm_info('clone01')
+    assert [disk['port'] for disk in clone.disks] == [0]
+    assert (clone.get('SATA-2-0'), clone.get('SATA-3-0')) == \
+        ('emptydrive', 'emptydrive')
+
+    guest = tmp_path / 'guest'
+    guest.mkdir()
+    fakevbox.install_guest(guest, 'clone01')
+    monkeypatch.setenv('PATH', str(guest) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setattr(vmutils.socket, 'gethostname',
+                        lambda: 'localhost.localdomain')
+    assert vmutils.apply_clone_hostname() == 'clone01'
+    assert 'hostnamectl set-hostname clone01' in \
+        log.read_text().splitlines()
+    monkeypatch.setattr(vmutils.socket, 'gethostname', lambda: 'clone01')
+    assert vmutils.apply_clone_hostname() is None
+
+
+def test_golden_image_waits_for_install(fake_vbox, avium):
+    # Assert an existing base VM that is still installing is not
+    # snapshotted and the build fails once the install times out
+    log = fake_vbox(state={'created': ['golden'],
+                           'states': {'golden': 'running'}})
+    avium.get_config()['vm']['golden_image'] = {
+        'enabled': True, 'base_vm': 'golden', 'snapshot': 'base',
+        'install_timeout': 0.5}
+
+    with pytest.raises(RuntimeError, match='did not finish'):
+        vmutils.build_golden_image(avium)
+
+    assert not [call for call in log.read_text().splitlines()
+                if call.startswith('snapshot')]